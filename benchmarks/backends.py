@@ -0,0 +1,75 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Inference throughput of every backend of utils.backends at a given batch size on the current machine. Backends are
+checked for parity with keras first, and the fastest one is reported as the 'inference_backend' to configure.
+
+Usage: python -m benchmarks.backends [--model MNIST] [--original] [--batch-size 32] [--batches 20] [--threads 1 4]
+"""
+
+import argparse
+import time
+import numpy as np
+from models.model import EfficientCapsNet, CapsNet
+from utils.backends import KerasBackend, XLABackend, TFLiteBackend, check_parity
+
+
+def throughput(backend, X, batches):
+    backend.predict(X) # tracing, compilation and tensor allocation
+    start = time.perf_counter()
+    for _ in range(batches):
+        backend.predict(X)
+    return batches * len(X) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--original', action='store_true', help='original CapsNet (MNIST only)')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--threads', type=int, nargs='+', default=[None], help='TFLite thread counts to try')
+    args = parser.parse_args()
+
+    model_class = CapsNet if args.original else EfficientCapsNet
+    model = model_class(args.model, mode='test', config_path=args.config)
+    X = np.random.rand(args.batch_size, *model.model.input_shape[1:]).astype('float32')
+
+    reference = KerasBackend(model.model, args.batch_size, verbose=0)
+    candidates = [('keras', {}, reference), ('xla', {}, XLABackend(model.model, args.batch_size))]
+    for threads in args.threads:
+        candidates.append(('tflite', {'tflite_threads': threads}, TFLiteBackend(model.model, args.batch_size, threads)))
+
+    results = []
+    print(f"{'backend':<10}{'options':<26}{'max error':>12}{'img/s':>10}")
+    for name, options, backend in candidates:
+        try:
+            error = check_parity(backend, reference, X)
+        except AssertionError as e:
+            print(f"{name:<10}{str(options):<26}  parity failed: {e}")
+            continue
+        speed = throughput(backend, X, args.batches)
+        results.append((speed, name, options))
+        print(f"{name:<10}{str(options):<26}{error:>12.1e}{speed:>10.1f}")
+
+    speed, name, options = max(results, key=lambda r: r[0])
+    print(f"fastest at batch size {args.batch_size}: \"inference_backend\": \"{name}\"" +
+          ''.join(f", \"{k}\": {v if v is not None else 'null'}" for k, v in options.items()) +
+          f", \"inference_batch_size\": {args.batch_size}")
+
+
+if __name__ == '__main__':
+    main()
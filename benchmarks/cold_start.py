@@ -0,0 +1,81 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Cold-start time to first prediction in a fresh Python process: build the graph from the models package and load the
+.h5 weights ('h5') vs load the exported SavedModel ('saved_model'). Weights are random.
+
+Usage: python -m benchmarks.cold_start [--model MNIST] [--runs 3] [--config config.json]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+H5_SCRIPT = """
+import numpy as np
+from models.model import EfficientCapsNet
+model = EfficientCapsNet('{model}', mode='test', config_path='{config}', custom_path='{path}', verbose=False)
+model.load_graph_weights()
+model.predict(np.zeros([1] + model.config['{model}_INPUT_SHAPE'], dtype=np.float32))
+"""
+
+SAVED_MODEL_SCRIPT = """
+import numpy as np
+from utils.export import load
+model = load('{path}', warmup={warmup})
+model.classify(np.zeros([1] + list(model.input_shape), dtype=np.float32))
+"""
+
+
+def cold_start(script, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2'))
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    from models.model import EfficientCapsNet
+    config = os.path.abspath(args.config)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        h5_path = os.path.join(tmp_dir, 'weights.h5')
+        export_dir = os.path.join(tmp_dir, 'saved_model')
+        model = EfficientCapsNet(args.model, mode='test', config_path=args.config, verbose=False)
+        model.model.save_weights(h5_path)
+        model.export(export_dir)
+
+        h5 = cold_start(H5_SCRIPT.format(model=args.model, config=config, path=h5_path), args.runs)
+        saved_model = cold_start(SAVED_MODEL_SCRIPT.format(path=export_dir, warmup=True), args.runs)
+        saved_model_no_warmup = cold_start(SAVED_MODEL_SCRIPT.format(path=export_dir, warmup=False), args.runs)
+    print(f"{'h5 + build_graph':<18}{h5:>8.2f} s")
+    print(f"{'saved_model':<18}{saved_model:>8.2f} s (warmup included)")
+    print(f"{'saved_model':<18}{saved_model_no_warmup:>8.2f} s (no warmup)")
+
+
+if __name__ == '__main__':
+    main()
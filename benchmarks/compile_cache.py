@@ -0,0 +1,97 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Restart latency of an 'xla_buckets' worker without compile cache, with an empty one and with a warm one. Every case runs
+in a fresh Python process that builds the model, loads its weights (random ones, saved by the first case), creates the
+backend (tracing or loading the traced functions) and serves a first batch-1 request, then one request per bucket, then
+a steady-state batch-1 request. The cache is enabled on CPU too ('compile_cache_cpu'), where it is expected to be
+slower than tracing again: it is meant for GPU workers.
+
+Usage: python -m benchmarks.compile_cache [--model MNIST] [--config config.json] [--cache-dir compile_cache_benchmark]
+                                          [--xla-devices GPU]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+SCRIPT = """
+import json, os, time
+start = time.perf_counter()
+import numpy as np
+from models.model import EfficientCapsNet
+model = EfficientCapsNet('{model}', mode='test', config_path='{config}', custom_path='{weights}')
+if not os.path.exists('{weights}'):
+    model.model.save_weights('{weights}')
+model.load_graph_weights()
+built = time.perf_counter()
+backend = model.get_backend()
+ready = time.perf_counter()
+x = np.random.rand(1, *model.model.input_shape[1:]).astype('float32')
+backend.predict(x)
+first = time.perf_counter()
+for bucket in backend.buckets:
+    backend.predict(np.repeat(x, bucket, axis=0))
+buckets = time.perf_counter()
+backend.predict(x)
+steady = time.perf_counter()
+print(json.dumps({{'build': built - start, 'backend': ready - built, 'first request': first - ready,
+                  'all buckets': buckets - first, 'steady request': steady - buckets}}))
+"""
+
+
+def run(model, config_path, weights_path):
+    script = SCRIPT.format(model=model, config=config_path, weights=weights_path)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                            env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2'))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--cache-dir', default='compile_cache_benchmark')
+    parser.add_argument('--xla-devices', default='GPU', help="device types whose XLA executables are persisted")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    config['inference_backend'] = 'xla_buckets'
+    cache_dir = os.path.abspath(args.cache_dir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cache in [('no cache', None), ('empty cache', cache_dir), ('warm cache', cache_dir)]:
+            config_path = os.path.join(tmp, 'config.json')
+            with open(config_path, 'w') as f:
+                json.dump(dict(config, compile_cache_dir=cache, compile_cache_xla_devices=args.xla_devices,
+                               compile_cache_cpu=True), f)
+            results.append((name, run(args.model, config_path, os.path.join(tmp, 'weights.h5'))))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    columns = list(results[0][1])
+    print(f"{'case':<14}" + ''.join(f'{c + " [s]":>20}' for c in columns))
+    for name, times in results:
+        print(f"{name:<14}" + ''.join(f'{times[c]:>20.3f}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
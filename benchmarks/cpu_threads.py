@@ -0,0 +1,107 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Sweep of the threading settings of utils.cpu_config on the current host. Every combination of intra-op threads,
+inter-op threads and tf.data private threadpool size runs in a fresh process (thread pools are fixed once TensorFlow
+starts) and measures either inference throughput of the test graph ('predict') or training throughput on the MNIST
+train pipeline fed with random images ('train'). The fastest setting is printed as configuration keys.
+
+Usage: python -m benchmarks.cpu_threads [--workload predict] [--intra 1 4 8] [--inter 1 2] [--data 0 2]
+                                        [--affinity 0-7] [--batches 20] [--config config.json]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from utils.cpu_config import THREADING_KEYS
+
+SCRIPT = """
+import json, time
+import numpy as np
+from models.model import EfficientCapsNet
+workload, batches = '{workload}', {batches}
+model = EfficientCapsNet('MNIST', mode='test' if workload == 'predict' else 'train', config_path='{config}')
+if workload == 'predict':
+    X = np.random.rand(model.config['inference_batch_size'], *model.model.input_shape[1:]).astype('float32')
+    model.predict(X)
+    start = time.perf_counter()
+    for _ in range(batches):
+        model.predict(X)
+    samples = batches * len(X)
+else:
+    from utils import pre_process_mnist
+    from utils.cpu_config import data_options
+    from utils.tools import marginLoss, reconstructionLoss
+    batch_size = model.config['batch_size']
+    X = np.random.rand(batch_size * (batches + 5), 28, 28, 1).astype('float32')
+    y = np.eye(10, dtype='float32')[np.random.randint(0, 10, len(X))]
+    dataset, _ = pre_process_mnist.generate_tf_data(X, y, X[:batch_size], y[:batch_size], batch_size)
+    dataset = dataset.with_options(data_options(model.config))
+    model.model.compile(optimizer='adam', loss=[marginLoss, reconstructionLoss], loss_weights=[1., 0.392])
+    model.model.fit(dataset.take(5), verbose=0)
+    start = time.perf_counter()
+    model.model.fit(dataset.skip(5).take(batches), verbose=0)
+    samples = batches * batch_size
+print(json.dumps({{'throughput': samples / (time.perf_counter() - start)}}))
+"""
+
+
+def run(workload, batches, config_path):
+    script = SCRIPT.format(workload=workload, batches=batches, config=config_path)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                            env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2'))
+    return json.loads(output.stdout.strip().splitlines()[-1])['throughput']
+
+
+def main():
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workload', default='predict', choices=['predict', 'train'])
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--intra', type=int, nargs='+', default=sorted({1, max(1, n_cpus // 2), n_cpus}))
+    parser.add_argument('--inter', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--data', type=int, nargs='+', default=[0, max(1, n_cpus // 4)],
+                        help='tf.data private threadpool sizes, 0 shares the TensorFlow pool')
+    parser.add_argument('--affinity', default=None, help='cpu_affinity of every run (Ex. "0-7" for one socket)')
+    parser.add_argument('--batches', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    data_threads = args.data if args.workload == 'train' else [0] # tf.data is not used by 'predict'
+
+    results = []
+    print(f"{n_cpus} schedulable cores, workload '{args.workload}'")
+    print(f"{'intra':>6}{'inter':>6}{'data':>6}{'samples/s':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for intra, inter, data in itertools.product(args.intra, args.inter, data_threads):
+            setting = dict(zip(THREADING_KEYS, [intra, inter, data or None, args.affinity]))
+            config_path = os.path.join(tmp, 'config.json')
+            with open(config_path, 'w') as f:
+                json.dump(dict(config, **setting), f)
+            throughput = run(args.workload, args.batches, config_path)
+            results.append((throughput, setting))
+            print(f"{intra:>6}{inter:>6}{data:>6}{throughput:>12.1f}")
+
+    throughput, setting = max(results, key=lambda r: r[0])
+    print(f"recommended ({throughput:.1f} samples/s): " + ', '.join(f'"{k}": {json.dumps(v)}' for k, v in setting.items()))
+
+
+if __name__ == '__main__':
+    main()
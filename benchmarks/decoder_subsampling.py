@@ -0,0 +1,107 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Train step time of Efficient-CapsNet with the reconstruction loss computed on a fraction of the batch
+('decoder_fraction') and/or once every k steps ('decoder_every'). Step times are measured on synthetic cached batches.
+With --epochs the settings are also trained on the real dataset and the final test accuracy is reported.
+
+Usage: python -m benchmarks.decoder_subsampling [--model MNIST] [--steps 200] [--epochs 0] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from models.model import EfficientCapsNet
+from utils.dataset import Dataset
+from utils.tools import marginLoss, reconstructionLoss, multiAccuracy
+
+SETTINGS = [(1., 1), (0.5, 1), (0.25, 1), (1., 4), (0.25, 4)]
+
+
+def build(model_name, config, work_dir, fraction, every, epochs=None):
+    with open(config) as json_data_file:
+        config = json.load(json_data_file)
+    config.update(decoder_fraction=fraction, decoder_every=every)
+    if epochs is not None:
+        config['epochs'] = epochs
+    config_path = os.path.join(work_dir, f'config_{fraction}_{every}.json')
+    with open(config_path, 'w') as json_data_file:
+        json.dump(config, json_data_file)
+    return EfficientCapsNet(model_name, mode='train', config_path=config_path, verbose=False)
+
+
+def step_time(model_name, config, work_dir, steps, fraction, every):
+    model = build(model_name, config, work_dir, fraction, every)
+    batch_size = model.config['batch_size']
+    input_shape = model.config[f'{model_name}_INPUT_SHAPE']
+    n_classes = model.model.output_shape[0][-1]
+
+    X = np.random.rand(batch_size, *input_shape).astype('float32')
+    y = tf.keras.utils.to_categorical(np.random.randint(n_classes, size=batch_size), num_classes=n_classes)
+    if model_name == 'MULTIMNIST':
+        dataset = tf.data.Dataset.from_tensors(((X, y, y), (y, X, X))).repeat()
+        loss, loss_weights = [marginLoss, reconstructionLoss, reconstructionLoss], [1., model.config['lmd_gen']/2, model.config['lmd_gen']/2]
+    else:
+        dataset = tf.data.Dataset.from_tensors(((X, y), (y, X))).repeat()
+        loss, loss_weights = [marginLoss, reconstructionLoss], [1., model.config['lmd_gen']]
+
+    model.model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=model.config['lr']), loss=loss, loss_weights=loss_weights)
+    model.model.fit(dataset, epochs=1, steps_per_epoch=steps, verbose=0) # tracing
+    start = time.perf_counter()
+    model.model.fit(dataset, epochs=1, steps_per_epoch=steps, verbose=0)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def test_accuracy(model_name, config, work_dir, epochs, fraction, every):
+    model = build(model_name, config, work_dir, fraction, every, epochs)
+    model.tb_path = os.path.join(work_dir, f'logs_{fraction}_{every}')
+    model.model_path_new_train = os.path.join(work_dir, f'weights_{fraction}_{every}.h5')
+    model.train()
+
+    test_model = EfficientCapsNet(model_name, mode='test', config_path=model.config_path, verbose=False)
+    test_model.model.load_weights(model.model_path_new_train)
+    dataset = Dataset(model_name, model.config_path)
+    y_pred = test_model.model.predict(dataset.X_test, batch_size=model.config['batch_size'])[0]
+    if model_name == 'MULTIMNIST':
+        return float(multiAccuracy(dataset.y_test, y_pred))
+    return float(np.mean(np.argmax(y_pred, 1) == np.argmax(dataset.y_test, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--epochs', type=int, default=0, help='if > 0, train every setting and report the test accuracy')
+    args = parser.parse_args()
+
+    print(f"{'fraction':>10}{'every':>7}{'ms/step':>10}{'speedup':>9}" + (f"{'test acc':>10}" if args.epochs else ''))
+    baseline = None
+    with tempfile.TemporaryDirectory() as work_dir: # configurations, logs and weights of the runs
+        for fraction, every in SETTINGS:
+            ms = step_time(args.model, args.config, work_dir, args.steps, fraction, every)
+            baseline = baseline or ms
+            row = f"{fraction:>10}{every:>7}{ms:>10.1f}{baseline/ms:>8.2f}x"
+            if args.epochs:
+                row += f"{test_accuracy(args.model, args.config, work_dir, args.epochs, fraction, every):>10.4f}"
+            print(row)
+
+
+if __name__ == '__main__':
+    main()
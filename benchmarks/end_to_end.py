@@ -0,0 +1,189 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+End-to-end comparison of every graph variant: Efficient-CapsNet MNIST, SMALLNORB and MULTIMNIST and the original
+CapsNet on MNIST with 1 to 5 routing iterations. For each variant the test and train graphs are built and the benchmark
+reports parameters (full graph and capsule network only), analytic FLOPs per image (utils.model_analysis) of the test
+forward pass and of a train step, single-image latency, peak throughput over the batch sizes, train step time at the
+configured batch_size and peak memory of inference and training. The FLOPs counted by the TensorFlow profiler are kept
+in the JSON results as a cross-check. Each graph is measured in a fresh process. Weights are loaded from the .h5 files
+when they exist and are random otherwise, which does not change the timings. The MNIST rows are then compared with
+Efficient-CapsNet.
+
+Usage: python -m benchmarks.end_to_end [--variants efficient_MNIST original_MNIST_r3] [--batch-sizes 32 128 256]
+                                       [--runs 20] [--train-steps 10] [--output end_to_end.json] [--config config.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from models.model import EfficientCapsNet, CapsNet
+from utils.tools import PeakMemory, marginLoss, reconstructionLoss
+
+VARIANTS = {f'efficient_{name}': (EfficientCapsNet, name, {}) for name in ('MNIST', 'SMALLNORB', 'MULTIMNIST')}
+VARIANTS.update({f'original_MNIST_r{r}': (CapsNet, 'MNIST', {'n_routing': r}) for r in range(1, 6)})
+
+
+def profiler_flops(model, batch_size=1, train=False):
+    """
+    Floating point operations per image counted by the TensorFlow profiler on the graph of a forward pass of model or,
+    with train, of a forward pass in training mode and the gradients of all trainable variables
+    """
+    specs = [tf.TensorSpec([batch_size] + list(i.shape[1:]), i.dtype) for i in model.inputs]
+
+    @tf.function
+    def function(*x):
+        if not train:
+            return model(list(x) if len(x) > 1 else x[0], training=False)
+        with tf.GradientTape() as tape:
+            loss = tf.add_n([tf.reduce_sum(o) for o in model(list(x), training=True)])
+        return tape.gradient(loss, model.trainable_variables)
+
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    graph = function.get_concrete_function(*specs).graph
+    return tf.compat.v1.profiler.profile(graph=graph, options=options).total_float_ops / batch_size
+
+
+def median_time(function, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def load_weights(model):
+    if not os.path.exists(model.model_path):
+        return 'random'
+    try:
+        model.load_graph_weights()
+        return 'h5'
+    except Exception:
+        return 'random'
+
+
+def benchmark_test(model, batch_sizes, runs):
+    forward = tf.function(lambda x: model.model(x, training=False), reduce_retracing=True)
+    input_shape = model.model.input_shape[1:]
+    x = tf.random.uniform((1,) + input_shape)
+    forward(x) # tracing
+    result = {'latency_ms': 1000 * median_time(lambda: [o.numpy() for o in forward(x)], runs)}
+
+    throughput = {}
+    with PeakMemory() as memory:
+        for batch_size in batch_sizes:
+            x = tf.random.uniform((batch_size,) + input_shape)
+            forward(x)
+            throughput[batch_size] = batch_size / median_time(lambda: [o.numpy() for o in forward(x)], max(runs // 4, 3))
+    result['throughput'] = {str(k): v for k, v in throughput.items()}
+    result['peak_batch'], result['peak_images_per_s'] = max(throughput.items(), key=lambda item: item[1])
+    result['test_peak_mb'] = memory.peak_mb
+    return result
+
+
+def benchmark_train(model, steps):
+    batch_size = model.config['batch_size']
+    X = np.random.rand(batch_size, *model.model.input_shape[0][1:]).astype('float32')
+    y = [tf.keras.utils.to_categorical(np.random.randint(i.shape[-1], size=batch_size), i.shape[-1]) for i in model.model.inputs[1:]]
+    targets = [y[0]] + [np.random.rand(batch_size, *o.shape[1:]).astype('float32') for o in model.model.outputs[1:]]
+    model.model.compile(optimizer=tf.keras.optimizers.Adam(model.config['lr']),
+                        loss=[marginLoss] + [reconstructionLoss] * (len(model.model.outputs) - 1))
+    with PeakMemory() as memory:
+        model.model.train_on_batch([X] + y, targets) # tracing
+        step_time = median_time(lambda: model.model.train_on_batch([X] + y, targets), steps)
+    return {'train_step_ms': 1000 * step_time, 'train_images_per_s': batch_size / step_time, 'train_peak_mb': memory.peak_mb}
+
+
+def run_test(variant, config, batch_sizes, runs):
+    cls, model_name, kwargs = VARIANTS[variant]
+    model = cls(model_name, mode='test', config_path=config, **kwargs)
+    result = {
+        'weights': load_weights(model),
+        'params': model.model.count_params(),
+        'capsnet_params': model.get_capsnet().count_params(),
+        'test_flops': model.analyze(1)['flops'],
+        'profiler_test_flops': profiler_flops(model.model)
+    }
+    result.update(benchmark_test(model, batch_sizes, runs))
+    return result
+
+
+def run_train(variant, config, steps):
+    cls, model_name, kwargs = VARIANTS[variant]
+    model = cls(model_name, mode='train', config_path=config, **kwargs)
+    result = {'train_flops': model.analyze(1)['train_step_flops'], 'profiler_train_flops': profiler_flops(model.model, train=True)}
+    result.update(benchmark_train(model, steps))
+    return result
+
+
+def isolated(function, *args):
+    """
+    Result of function(*args) computed in a fresh process, so that the peak memory of a variant is not hidden by memory
+    the allocator kept from the previous ones
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 128, 256])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--train-steps', type=int, default=10)
+    parser.add_argument('--output', default=None, help='JSON results file')
+    args = parser.parse_args()
+
+    results = []
+    for variant in args.variants:
+        result = {'variant': variant}
+        result.update(isolated(run_test, variant, args.config, args.batch_sizes, args.runs))
+        result.update(isolated(run_train, variant, args.config, args.train_steps))
+        results.append(result)
+        print(f"{variant} done", flush=True)
+
+    print(f"\n{'variant':<22}{'weights':>8}{'params':>11}{'capsnet':>10}{'MFLOPs test':>13}{'MFLOPs train step':>19}"
+          f"{'latency [ms]':>14}{'peak img/s':>12}{'batch':>7}{'train step [ms]':>17}{'MB test':>9}{'MB train':>10}")
+    for r in results:
+        print(f"{r['variant']:<22}{r['weights']:>8}{r['params']:>11,}{r['capsnet_params']:>10,}{r['test_flops']/1e6:>13.1f}"
+              f"{r['train_flops']/1e6:>19.1f}{r['latency_ms']:>14.3f}{r['peak_images_per_s']:>12.1f}{r['peak_batch']:>7}"
+              f"{r['train_step_ms']:>17.2f}{r['test_peak_mb']:>9.1f}{r['train_peak_mb']:>10.1f}")
+
+    reference = next((r for r in results if r['variant'] == 'efficient_MNIST'), None)
+    originals = [r for r in results if r['variant'].startswith('original_MNIST')]
+    if reference and originals:
+        print(f"\nrelative to efficient_MNIST (x times)")
+        print(f"{'variant':<22}{'capsnet params':>16}{'FLOPs':>8}{'latency':>9}{'throughput':>12}{'train step':>12}")
+        for r in originals:
+            print(f"{r['variant']:<22}{r['capsnet_params']/reference['capsnet_params']:>16.1f}"
+                  f"{r['test_flops']/reference['test_flops']:>8.1f}{r['latency_ms']/reference['latency_ms']:>9.2f}"
+                  f"{reference['peak_images_per_s']/r['peak_images_per_s']:>12.2f}"
+                  f"{r['train_step_ms']/reference['train_step_ms']:>12.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'tensorflow': tf.__version__, 'results': results}, f, indent=1)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Total throughput of training (and predicting with) M Efficient-CapsNet models as one EfficientCapsNetEnsemble, in a
+single process with a single input pipeline, against M separate processes that train an EfficientCapsNet each at the
+same time, as when seeds are trained in parallel. Train throughput is given in member images/s (images/s times the
+number of networks trained on them) over the generate_tf_data train pipeline, on the real dataset when it is cached
+locally, synthetic images otherwise. Predict throughput compares the averaged forward pass of the ensemble with M
+sequential forward passes of single networks (capsule networks only, random weights).
+
+Usage: python -m benchmarks.ensemble [--dataset MNIST] [--members 2 4] [--steps 20] [--samples 2048]
+                                     [--config config.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+import numpy as np
+import tensorflow as tf
+from benchmarks.end_to_end import median_time
+from benchmarks.input_pipeline import load_data
+from utils import pre_process_mnist, pre_process_multimnist, pre_process_smallnorb
+from utils.tools import marginLoss, reconstructionLoss
+
+
+def train_pipeline(model_name, config, config_path, n_samples):
+    (X_train, y_train, X_test, y_test), _ = load_data(model_name, config, config_path, n_samples)
+    if model_name == 'MULTIMNIST':
+        dataset_train, _ = pre_process_multimnist.generate_tf_data(X_train, y_train, X_test, y_test, config['batch_size'],
+                                                                   config['shift_multimnist'])
+    else:
+        module = pre_process_mnist if model_name == 'MNIST' else pre_process_smallnorb
+        dataset_train, _ = module.generate_tf_data(X_train, y_train, X_test, y_test, config['batch_size'],
+                                                   config.get('input_parallel_calls', 16))
+    return dataset_train.repeat()
+
+
+def train_images_per_s(model_name, config_path, n_members, steps, n_samples, barrier=None):
+    """
+    Images/s of keras fit on the train pipeline of a single network (n_members=0) or of an ensemble of n_members. With
+    barrier, the timed steps start when all the processes waiting on it are ready
+    """
+    from models.ensemble_graph import member_targets
+    from models.model import EfficientCapsNet, EfficientCapsNetEnsemble
+    if n_members:
+        model = EfficientCapsNetEnsemble(model_name, mode='train', config_path=config_path, n_members=n_members)
+    else:
+        model = EfficientCapsNet(model_name, mode='train', config_path=config_path)
+    dataset = train_pipeline(model_name, model.config, config_path, n_samples)
+    if n_members:
+        dataset = member_targets(dataset, n_members)
+
+    lmd = model.config['lmd_gen']
+    if model_name == 'MULTIMNIST':
+        loss, loss_weights = [marginLoss, reconstructionLoss, reconstructionLoss], [1., lmd/2, lmd/2]
+    else:
+        loss, loss_weights = [marginLoss, reconstructionLoss], [1., lmd]
+    model.model.compile(optimizer=tf.keras.optimizers.Adam(model.config['lr']), loss=loss * max(n_members, 1),
+                        loss_weights=loss_weights * max(n_members, 1))
+    model.model.fit(dataset, epochs=1, steps_per_epoch=3, verbose=0) # tracing
+    if barrier is not None:
+        barrier.wait()
+    start = time.perf_counter()
+    model.model.fit(dataset, epochs=1, steps_per_epoch=steps, verbose=0)
+    return steps * model.config['batch_size'] / (time.perf_counter() - start)
+
+
+def separate_processes(model_name, config_path, n_processes, steps, n_samples):
+    """
+    Sum of the images/s of n_processes processes training a network each at the same time
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager, context.Pool(n_processes) as pool:
+        barrier = manager.Barrier(n_processes)
+        results = [pool.apply_async(train_images_per_s, (model_name, config_path, 0, steps, n_samples, barrier))
+                   for _ in range(n_processes)]
+        return sum(result.get() for result in results)
+
+
+def ensemble_process(model_name, config_path, n_members, steps, n_samples):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(train_images_per_s, (model_name, config_path, n_members, steps, n_samples))
+
+
+def predict_images_per_s(model_name, config_path, members, batch_size, runs):
+    """
+    Images/s of the averaged forward pass of an ensemble of each size in members and of as many sequential forward
+    passes of a single network
+    """
+    from models.model import EfficientCapsNet, EfficientCapsNetEnsemble
+    single = EfficientCapsNet(model_name, mode='test', config_path=config_path)
+    X = np.random.rand(batch_size, *single.model.input_shape[1:]).astype('float32')
+    single.classify_batch(X) # tracing
+    seconds = median_time(lambda: single.classify_batch(X), runs)
+    results = {}
+    for n_members in members:
+        ensemble = EfficientCapsNetEnsemble(model_name, mode='test', config_path=config_path, n_members=n_members)
+        ensemble.classify_batch(X) # tracing
+        results[n_members] = (batch_size / median_time(lambda: ensemble.classify_batch(X), runs), batch_size / (n_members * seconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default='MNIST', choices=['MNIST', 'SMALLNORB', 'MULTIMNIST'])
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--members', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--steps', type=int, default=20, help='timed train steps')
+    parser.add_argument('--samples', type=int, default=2048, help='samples of the train pipeline')
+    parser.add_argument('--predict-batch', type=int, default=64)
+    parser.add_argument('--runs', type=int, default=10, help='timed predict calls')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    print(f"{args.dataset} ensembles (batch_size {config['batch_size']}, {multiprocessing.cpu_count()} CPUs)")
+
+    single = ensemble_process(args.dataset, args.config, 0, args.steps, args.samples)
+    print(f"{'M':>3}{'ensemble member img/s':>23}{'M processes member img/s':>26}{'speedup':>9}"
+          f"{'ensemble predict img/s':>24}{'M x single predict img/s':>26}{'speedup':>9}")
+    print(f"{1:>3}{single:>23.1f}{single:>26.1f}{1:>9.2f}")
+    predict = predict_images_per_s(args.dataset, args.config, args.members, args.predict_batch, args.runs)
+    for n_members in args.members:
+        ensemble = n_members * ensemble_process(args.dataset, args.config, n_members, args.steps, args.samples)
+        separate = separate_processes(args.dataset, args.config, n_members, args.steps, args.samples)
+        ensemble_predict, separate_predict = predict[n_members]
+        print(f"{n_members:>3}{ensemble:>23.1f}{separate:>26.1f}{ensemble/separate:>9.2f}"
+              f"{ensemble_predict:>24.1f}{separate_predict:>26.1f}{ensemble_predict/separate_predict:>9.2f}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Import and construction time of the models package, each measured in a fresh Python process, and the optional heavy
+dependencies it loaded.
+
+Usage: python -m benchmarks.import_time [--runs 3] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+HEAVY_MODULES = ['tensorflow_addons', 'tensorflow_datasets', 'cv2', 'matplotlib', 'pandas', 'ipywidgets', 'tqdm']
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'modules': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+CASES = [
+    ('import tensorflow', "import tensorflow"),
+    ('import utils', "import utils"),
+    ('from models import EfficientCapsNet', "from models import EfficientCapsNet"),
+    ("EfficientCapsNet('MNIST')", "from models import EfficientCapsNet; EfficientCapsNet('MNIST', config_path='{config}')"),
+    ("EfficientCapsNet('SMALLNORB')", "from models import EfficientCapsNet; EfficientCapsNet('SMALLNORB', config_path='{config}')"),
+    ("CapsNet('MNIST')", "from models import CapsNet; CapsNet('MNIST', config_path='{config}')"),
+]
+
+
+def measure(statement, runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)],
+                                check=True, capture_output=True, text=True, env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2'))
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+    return np.median(times), result['modules']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    config = os.path.abspath(args.config)
+    print(f"{'case':<38}{'time [s]':>10}  heavy modules loaded")
+    for name, statement in CASES:
+        elapsed, modules = measure(statement.format(config=config), args.runs)
+        print(f"{name:<38}{elapsed:>10.2f}  {', '.join(modules) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Throughput of the input pipelines of the pre_process modules without a model attached. For each dataset it reports the
+cost per element of every augmentation stage alone (MNIST: rotate, shift, squish, erase; SMALLNORB: random crop,
+brightness, contrast; MULTIMNIST: synthesis of train, validation and test samples), then the elements/s of the full
+generate_tf_data train and test pipelines for several num_parallel_calls (-1 is AUTOTUNE). The images/s of a train
+step of Efficient-CapsNet are given as the rate the train pipeline has to sustain. The real datasets are used when
+they are cached locally, synthetic images of the same shape otherwise.
+
+Usage: python -m benchmarks.input_pipeline [--datasets MNIST SMALLNORB MULTIMNIST] [--samples 4096]
+                                           [--parallel-calls 1 2 4 8 16 -1] [--no-model] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from utils import pre_process_mnist, pre_process_multimnist, pre_process_smallnorb
+
+STAGES = {
+    'MNIST': [('rotate', pre_process_mnist.image_rotate_random), ('shift', pre_process_mnist.image_shift_rand),
+              ('squish', pre_process_mnist.image_squish_random), ('erase', pre_process_mnist.image_erase_random),
+              ('generator', pre_process_mnist.generator)],
+    'SMALLNORB': [('random crop', pre_process_smallnorb.random_patches),
+                  ('brightness', pre_process_smallnorb.random_brightness),
+                  ('contrast', pre_process_smallnorb.random_contrast), ('generator', pre_process_smallnorb.generator)],
+}
+
+
+def is_cached(model_name, config):
+    if model_name == 'SMALLNORB':
+        data_dir = os.environ.get('TFDS_DATA_DIR', os.path.expanduser('~/tensorflow_datasets'))
+        return os.path.isdir(os.path.join(data_dir, 'smallnorb'))
+    keras_home = os.environ.get('KERAS_HOME', os.path.expanduser('~/.keras'))
+    return os.path.exists(os.path.join(keras_home, 'datasets', config['mnist_path']))
+
+
+def synthetic_digits(n, size, rng):
+    # a bright blob in the middle of a black background, so that the shift augmentation finds the digit margins
+    X = np.zeros((n, size, size), dtype=np.uint8)
+    X[:, 6:size-6, 8:size-8] = rng.randint(0, 256, (n, size-12, size-16)) * (rng.rand(n, size-12, size-16) > 0.5)
+    return X, rng.randint(10, size=n)
+
+
+def load_data(model_name, config, config_path, n_samples):
+    """
+    (X_train, y_train, X_test, y_test) as fed to generate_tf_data and the data source ('real' or 'synthetic')
+    """
+    if is_cached(model_name, config):
+        from utils.dataset import Dataset
+        dataset = Dataset(model_name, config_path)
+        X_test = dataset.X_test_patch if model_name == 'SMALLNORB' else dataset.X_test
+        return (dataset.X_train[:n_samples], dataset.y_train[:n_samples], X_test[:n_samples], dataset.y_test[:n_samples]), 'real'
+
+    rng = np.random.RandomState(0)
+    if model_name == 'SMALLNORB':
+        shape = (n_samples, config['scale_smallnorb'], config['scale_smallnorb'], 2)
+        X, y = pre_process_smallnorb.standardize(rng.rand(*shape), rng.randint(pre_process_smallnorb.N_CLASSES, size=n_samples))
+        X_test, y_test = pre_process_smallnorb.test_patches(X, y, config)
+        return (X.astype('float32'), y.numpy(), X_test.astype('float32'), y_test.numpy()), 'synthetic'
+    X, y = synthetic_digits(n_samples, pre_process_mnist.MNIST_IMG_SIZE, rng)
+    if model_name == 'MULTIMNIST':
+        X, y = pre_process_multimnist.pre_process(pre_process_multimnist.pad_dataset(X, config['pad_multimnist']), y)
+    else:
+        X, y = pre_process_mnist.pre_process(X, y)
+    return (X, y, X, y), 'synthetic'
+
+
+def elements_per_s(dataset, max_elements=None):
+    """
+    Elements/s of an iteration over dataset (batches are counted by their size), after the first element
+    """
+    batched = tf.nest.flatten(dataset.element_spec)[0].shape.rank == 4 # images
+    iterator = iter(dataset)
+    next(iterator)
+    start, n = time.perf_counter(), 0
+    for element in iterator:
+        n += len(tf.nest.flatten(element)[0]) if batched else 1
+        if max_elements and n >= max_elements:
+            break
+    return n / (time.perf_counter() - start)
+
+
+def reduce_per_s(dataset):
+    """
+    Elements/s of dataset counted by Dataset.reduce. The iteration stays in the runtime: batching the stages and
+    iterating from Python instead starves the stages that run Python code (tf.py_function) and hides the others
+    """
+    dataset.take(10).reduce(0, lambda n, _: n + 1) # tracing
+    start = time.perf_counter()
+    n = int(dataset.reduce(0, lambda n, _: n + 1))
+    return n / (time.perf_counter() - start)
+
+
+def stage_costs(model_name, X, y, config, n_elements):
+    """
+    Microseconds per element of every augmentation stage, run alone and sequentially on top of the source
+    """
+    if model_name == 'MULTIMNIST':
+        shift = config['shift_multimnist']
+        n_multi = min(config['n_overlay_multimnist'], len(X) // 2) # overlays are drawn without replacement
+        sources = [('train synthesis', pre_process_multimnist.multi_mnist_generator(X, y, shift), 1),
+                   ('validation synthesis', pre_process_multimnist.multi_mnist_generator_validation(X, y, shift), 1),
+                   (f'test synthesis (x{n_multi})', pre_process_multimnist.multi_mnist_generator_test(X, y, shift, n_multi), n_multi)]
+        costs = []
+        for name, generator, images in sources:
+            iterator = generator()
+            next(iterator)
+            n = max(n_elements // images, 3)
+            start = time.perf_counter()
+            for _ in range(n):
+                next(iterator)
+            costs.append((name, 1e6 * (time.perf_counter() - start) / (n * images)))
+        return costs
+
+    source = tf.data.Dataset.from_tensor_slices((X, y)).take(n_elements)
+    base = 1e6 / reduce_per_s(source)
+    costs = [('source', base)]
+    for name, stage in STAGES[model_name]:
+        costs.append((name, 1e6 / reduce_per_s(source.map(stage)) - base))
+    return costs
+
+
+def model_images_per_s(model_name, config_path):
+    from benchmarks.end_to_end import benchmark_train
+    from models.model import EfficientCapsNet
+    model = EfficientCapsNet(model_name, mode='train', config_path=config_path)
+    return benchmark_train(model, 10)['train_images_per_s']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', nargs='+', default=['MNIST', 'SMALLNORB', 'MULTIMNIST'])
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--samples', type=int, default=4096, help='samples per epoch of the pipelines')
+    parser.add_argument('--stage-elements', type=int, default=1000, help='elements timed per stage')
+    parser.add_argument('--parallel-calls', type=int, nargs='+', default=[1, 2, 4, 8, 16, -1])
+    parser.add_argument('--no-model', action='store_true', help='do not measure the train step of the model')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    batch_size = config['batch_size']
+
+    for model_name in args.datasets:
+        (X_train, y_train, X_test, y_test), source = load_data(model_name, config, args.config, args.samples)
+        print(f"\n{model_name} ({source} data, {len(X_train)} samples, batch_size {batch_size})")
+        print(f"{'stage':<28}{'us/element':>12}{'elements/s':>12}")
+        for name, cost in stage_costs(model_name, X_train, y_train, config, args.stage_elements):
+            print(f"{name:<28}{cost:>12.1f}{1e6 / cost if cost > 0 else float('inf'):>12.0f}")
+
+        print(f"{'pipeline':<28}{'parallel':>12}{'elements/s':>12}")
+        if model_name == 'MULTIMNIST':
+            dataset_train, dataset_test = pre_process_multimnist.generate_tf_data(X_train, y_train, X_test, y_test, batch_size,
+                                                                                  config['shift_multimnist'])
+            print(f"{'train':<28}{'-':>12}{elements_per_s(dataset_train, args.samples):>12.0f}")
+            print(f"{'test':<28}{'-':>12}{elements_per_s(dataset_test):>12.0f}")
+        else:
+            module = pre_process_mnist if model_name == 'MNIST' else pre_process_smallnorb
+            for parallel_calls in args.parallel_calls:
+                dataset_train, dataset_test = module.generate_tf_data(X_train, y_train, X_test, y_test, batch_size, parallel_calls)
+                print(f"{'train':<28}{parallel_calls:>12}{elements_per_s(dataset_train):>12.0f}")
+                print(f"{'test':<28}{parallel_calls:>12}{elements_per_s(dataset_test):>12.0f}")
+
+        if not args.no_model:
+            print(f"{'model train step':<28}{'':>12}{model_images_per_s(model_name, args.config):>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Microbenchmarks of the capsule layers (Squash, SquashHinton, PrimaryCaps, FCCaps, DigitCaps with 1/3/5 routing
+iterations, Length, Mask and double Mask) across batch sizes, capsule counts and dimensions. Every case runs a compiled
+forward pass (and, with --backward, forward and gradients) and reports median and p90 wall time, throughput and peak
+memory. Results are written as JSON; the compare mode flags the cases of a new file that are slower (or use more memory)
+than in a baseline file by more than a threshold, and exits with status 1 if there is any.
+
+Usage: python -m benchmarks.layers [--layers FCCaps DigitCaps] [--batch-sizes 1 16 64] [--runs 50] [--backward]
+                                   [--output layers.json]
+       python -m benchmarks.layers --compare baseline.json new.json [--threshold 0.1] [--memory-threshold 0.2]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from utils import layers, layers_hinton
+from utils.tools import PeakMemory
+
+# layer name -> (factory(params), input shape without batch(params), grid of params)
+CASES = {
+    'Squash': (lambda p: layers.Squash(), lambda p: (p['N'], p['D']),
+               [{'N': n, 'D': d} for n in (16, 128, 1152) for d in (8, 16)]),
+    'SquashHinton': (lambda p: layers.SquashHinton(), lambda p: (p['N'], p['D']),
+                     [{'N': n, 'D': d} for n in (16, 128, 1152) for d in (8, 16)]),
+    # kernel as large as the feature map, as in the Efficient-CapsNet stems
+    'PrimaryCaps': (lambda p: layers.PrimaryCaps(F=p['N']*p['D'], K=p['HW'], N=p['N'], D=p['D']),
+                    lambda p: (p['HW'], p['HW'], p['N']*p['D']),
+                    [{'HW': 9, 'N': 16, 'D': 8}, {'HW': 9, 'N': 32, 'D': 8}, {'HW': 9, 'N': 16, 'D': 16}]),
+    'FCCaps': (lambda p: layers.FCCaps(p['N'], p['D']), lambda p: (p['N_in'], p['D_in']),
+               [{'N_in': n_in, 'D_in': 8, 'N': 10, 'D': 16} for n_in in (16, 32, 128, 1152)] +
+               [{'N_in': 16, 'D_in': 8, 'N': n, 'D': d} for n, d in ((5, 16), (10, 32))]),
+    'DigitCaps': (lambda p: layers_hinton.DigitCaps(p['C'], p['L'], routing=p['routing']),
+                  lambda p: (p['HW'], p['HW'], p['C_in'], p['L_in']),
+                  [{'HW': hw, 'C_in': 32, 'L_in': 8, 'C': 10, 'L': 16, 'routing': r} for hw in (3, 6) for r in (1, 3, 5)]),
+    'Length': (lambda p: layers.Length(), lambda p: (p['N'], p['D']),
+               [{'N': n, 'D': d} for n in (10, 1152) for d in (8, 16)]),
+    'Mask': (lambda p: layers.Mask(), lambda p: (p['N'], p['D']),
+             [{'N': 10, 'D': d} for d in (16, 32)]),
+    'MaskDouble': (lambda p: DoubleMask(), lambda p: (p['N'], p['D']),
+                   [{'N': 10, 'D': d} for d in (16, 32)]),
+}
+
+
+class DoubleMask(layers.Mask):
+    def call(self, inputs, **kwargs):
+        return super(DoubleMask, self).call(inputs, double_mask=True)
+
+
+def make_function(layer, x, backward):
+    layer(x[:1]) # build
+    if not backward:
+        return tf.function(lambda x: layer(x, training=False))
+
+    @tf.function
+    def forward_backward(x):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            loss = tf.add_n([tf.reduce_sum(o) for o in tf.nest.flatten(layer(x, training=True))])
+        return tape.gradient(loss, [x] + layer.trainable_variables)
+    return forward_backward
+
+
+def sync(outputs):
+    for output in tf.nest.flatten(outputs):
+        if output is not None:
+            output.numpy()
+
+
+def measure(name, params, batch_size, runs, backward):
+    factory, input_shape, _ = CASES[name]
+    x = tf.random.uniform((batch_size,) + tuple(input_shape(params)))
+    function = make_function(factory(params), x, backward)
+    sync(function(x)) # tracing
+    times = []
+    with PeakMemory() as memory:
+        for _ in range(runs):
+            start = time.perf_counter()
+            sync(function(x))
+            times.append(time.perf_counter() - start)
+    return {
+        'layer': name,
+        'params': params,
+        'batch': batch_size,
+        'mode': 'backward' if backward else 'forward',
+        'ms': 1000 * float(np.median(times)),
+        'ms_p90': 1000 * float(np.percentile(times, 90)),
+        'samples_per_s': batch_size / float(np.median(times)),
+        'peak_mb': memory.peak_mb
+    }
+
+
+def case_key(result):
+    return (result['layer'], json.dumps(result['params'], sort_keys=True), result['batch'], result['mode'])
+
+
+def compare(baseline_path, new_path, threshold, memory_threshold):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    regressions = 0
+    print(f"{'layer':<14}{'params':<66}{'batch':>6}{'mode':>10}{'base ms':>10}{'new ms':>10}{'ratio':>8}  flag")
+    for result in new:
+        base = baseline.get(case_key(result))
+        if base is None:
+            continue
+        ratio = result['ms'] / base['ms']
+        flags = []
+        if ratio > 1 + threshold:
+            flags.append('SLOWER')
+        if result['peak_mb'] > max(base['peak_mb'], 1.) * (1 + memory_threshold) + 1.:
+            flags.append(f"MEMORY {base['peak_mb']:.1f}->{result['peak_mb']:.1f} MB")
+        regressions += bool(flags)
+        print(f"{result['layer']:<14}{json.dumps(result['params']):<66}{result['batch']:>6}{result['mode']:>10}"
+              f"{base['ms']:>10.3f}{result['ms']:>10.3f}{ratio:>8.2f}  {' '.join(flags)}")
+    missing = set(baseline) - {case_key(r) for r in new}
+    print(f"{regressions} regression(s), {len(missing)} baseline case(s) not in {new_path}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--backward', action='store_true', help='measure forward and gradients too')
+    parser.add_argument('--output', default='layers.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged as regression')
+    parser.add_argument('--memory-threshold', type=float, default=0.2, help='relative peak memory growth flagged')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold, args.memory_threshold) else 0)
+
+    results = []
+    print(f"{'layer':<14}{'params':<66}{'batch':>6}{'mode':>10}{'ms':>10}{'samples/s':>12}{'peak MB':>9}")
+    for name in args.layers:
+        for params in CASES[name][2]:
+            for batch_size in args.batch_sizes:
+                for backward in ([False, True] if args.backward else [False]):
+                    result = measure(name, params, batch_size, args.runs, backward)
+                    results.append(result)
+                    print(f"{name:<14}{json.dumps(params):<66}{batch_size:>6}{result['mode']:>10}{result['ms']:>10.3f}"
+                          f"{result['samples_per_s']:>12.1f}{result['peak_mb']:>9.1f}")
+
+    meta = {'tensorflow': tf.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'gpus': len(tf.config.list_physical_devices('GPU')), 'time': time.time()}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f"{len(results)} results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
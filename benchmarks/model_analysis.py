@@ -0,0 +1,67 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Analytic FLOPs, parameters and memory (utils.model_analysis) of the train and test graphs of the model variants,
+without running them: the per-layer table of every graph (with --layers) and the totals of all of them, Ex. to size
+an instance for a batch size or to vet a new architecture before training it. With --check, the FLOPs of the test
+graphs are compared with the count of the TensorFlow profiler. The profiler has no FLOP count for the Einsum op (0
+FLOPs), so the check does not cover the einsums of FCCaps (votes and agreement), whose analytic count is not validated.
+
+Usage: python -m benchmarks.model_analysis [--variants efficient_MNIST original_MNIST_r3] [--batch-size 16] [--layers]
+                                           [--check] [--output analysis.json] [--config config.json]
+"""
+
+import argparse
+import json
+from benchmarks.end_to_end import VARIANTS, profiler_flops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-size', type=int, default=None, help="default: 'batch_size' in the configuration file")
+    parser.add_argument('--layers', action='store_true', help='print the per-layer tables')
+    parser.add_argument('--check', action='store_true', help='compare with the FLOPs of the TensorFlow profiler')
+    parser.add_argument('--output', default=None, help='JSON file of the analyses')
+    args = parser.parse_args()
+
+    from utils.model_analysis import format_layers, format_totals
+    analyses, checks = {}, {}
+    for variant in args.variants:
+        cls, model_name, kwargs = VARIANTS[variant]
+        for mode in ('test', 'train'):
+            model = cls(model_name, mode=mode, config_path=args.config, **kwargs)
+            analyses[f'{variant} {mode}'] = model.analyze(args.batch_size)
+            if args.layers:
+                print(f"\n{variant} {mode}\n{format_layers(analyses[f'{variant} {mode}'])}")
+            if args.check and mode == 'test':
+                checks[variant] = profiler_flops(model.model)
+
+    print(f"\n{format_totals(analyses)}")
+    if checks:
+        print(f"\n{'variant':<28}{'analytic MFLOPs':>17}{'profiler MFLOPs':>17}{'error':>8}")
+        for variant, flops in checks.items():
+            analytic = analyses[f'{variant} test']['flops']
+            print(f"{variant:<28}{analytic/1e6:>17.2f}{flops/1e6:>17.2f}{analytic/flops - 1:>8.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(analyses, f, indent=1)
+        print(f"analyses written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
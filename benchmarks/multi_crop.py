@@ -0,0 +1,82 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Accuracy and throughput of the multi-crop evaluation of Efficient-CapsNet on smallNORB (Model.classify_crops) for
+several numbers of crops, with and without flips, next to the center crop evaluation of Model.evaluate (full graph with
+decoder through the inference backend). Times are also given relative to the center crop through classify_crops, that
+is the cost of the extra crops alone. The test set is used when it is cached locally and the weights in bin/ exist;
+otherwise random images are timed and accuracy is not reported.
+
+Usage: python -m benchmarks.multi_crop [--crops 1 5 9] [--samples 2048] [--runs 3] [--config config.json]
+"""
+
+import argparse
+import json
+import numpy as np
+from benchmarks.end_to_end import load_weights, median_time
+from benchmarks.input_pipeline import is_cached
+from models.model import EfficientCapsNet
+from utils import pre_process_smallnorb
+
+
+def accuracy(y_pred, y):
+    return float(np.mean(np.argmax(y_pred, 1) == np.argmax(y, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--crops', type=int, nargs='+', default=[1, 5, 9])
+    parser.add_argument('--samples', type=int, default=2048, help='test images')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    model = EfficientCapsNet('SMALLNORB', mode='test', config_path=args.config)
+    weights = load_weights(model)
+    if weights == 'h5' and is_cached('SMALLNORB', config):
+        from utils.dataset import Dataset
+        dataset = Dataset('SMALLNORB', args.config)
+        X, y = np.asarray(dataset.X_test[:args.samples]), np.asarray(dataset.y_test[:args.samples])
+        source = 'test set'
+    else:
+        rng = np.random.RandomState(0)
+        X = rng.randn(args.samples, config['scale_smallnorb'], config['scale_smallnorb'], 2).astype('float32')
+        y, source = None, 'random images'
+    X_patch, _ = pre_process_smallnorb.test_patches(X, None, config)
+    print(f"SMALLNORB multi-crop evaluation ({source}, {weights} weights, {len(X)} images, "
+          f"inference_batch_size {config.get('inference_batch_size', 32)})")
+
+    rows = []
+    model.predict(X_patch[:config.get('inference_batch_size', 32)]) # tracing
+    seconds = median_time(lambda: model.predict(X_patch), args.runs)
+    rows.append(('evaluate center crop', 1, seconds, y is not None and accuracy(model.predict(X_patch)[0], y)))
+    for n_crops in sorted(set(args.crops) | {1}):
+        for flip in (False, True):
+            model.classify_crops(X[:1], n_crops, flip) # tracing
+            seconds = median_time(lambda: model.classify_crops(X, n_crops, flip), args.runs)
+            rows.append((f"crops {n_crops}{' + flips' if flip else ''}", n_crops * (1 + flip), seconds,
+                         y is not None and accuracy(model.classify_crops(X, n_crops, flip), y)))
+
+    evaluate, center = rows[0][2], next(seconds for name, _, seconds, _ in rows if name == 'crops 1')
+    print(f"{'evaluation':<22}{'views':>6}{'images/s':>10}{'x evaluate':>12}{'x center crop':>15}{'accuracy':>10}")
+    for name, views, seconds, acc in rows:
+        print(f"{name:<22}{views:>6}{len(X)/seconds:>10.1f}{seconds/evaluate:>12.2f}{seconds/center:>15.2f}"
+              f"{f'{acc:.2%}' if y is not None else '-':>10}")
+
+
+if __name__ == '__main__':
+    main()
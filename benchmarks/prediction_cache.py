@@ -0,0 +1,98 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Model.classify on a stream of requests where a fraction of the samples are exact duplicates of earlier ones, without
+prediction cache, with the in-memory tier and with the on-disk tier (a second model instance that shares the directory,
+as a restarted or another worker would). Cached scores are checked against the uncached ones.
+
+Usage: python -m benchmarks.prediction_cache [--model MNIST] [--requests 500] [--request-size 4] [--duplicates 0.5]
+                                             [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from models.model import EfficientCapsNet
+
+
+def make_stream(n_requests, request_size, duplicates, input_shape, seed=0):
+    rng = np.random.RandomState(seed)
+    seen, stream = [], []
+    for _ in range(n_requests):
+        request = []
+        for _ in range(request_size):
+            if seen and rng.rand() < duplicates:
+                request.append(seen[rng.randint(len(seen))])
+            else:
+                seen.append(rng.rand(*input_shape).astype('float32'))
+                request.append(seen[-1])
+        stream.append(np.stack(request))
+    return stream
+
+
+def run(model, stream):
+    model.classify_batch(stream[0]) # tracing
+    scores, times = [], []
+    for X in stream:
+        start = time.perf_counter()
+        scores.append(model.classify(X))
+        times.append(time.perf_counter() - start)
+    return np.concatenate(scores), np.array(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--request-size', type=int, default=4)
+    parser.add_argument('--duplicates', type=float, default=0.5, help='probability that a sample was already seen')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        weights_path = os.path.join(tmp, 'weights.h5')
+        cases = [('no cache', {'prediction_cache_size': 0}),
+                 ('memory', {'prediction_cache_size': 100000}),
+                 ('disk (written)', {'prediction_cache_size': 100000, 'prediction_cache_dir': os.path.join(tmp, 'cache')}),
+                 ('disk (shared)', {'prediction_cache_size': 100000, 'prediction_cache_dir': os.path.join(tmp, 'cache')})]
+        stream, reference = None, None
+        print(f"{'case':<16}{'mean [ms]':>11}{'p50 [ms]':>10}{'p99 [ms]':>10}{'hit rate':>10}{'max error':>12}")
+        for name, options in cases:
+            config_path = os.path.join(tmp, 'config.json')
+            with open(config_path, 'w') as f:
+                json.dump(dict(config, **options), f)
+            model = EfficientCapsNet(args.model, mode='test', config_path=config_path, custom_path=weights_path)
+            if not os.path.exists(weights_path):
+                model.model.save_weights(weights_path)
+            model.load_graph_weights()
+            if stream is None:
+                stream = make_stream(args.requests, args.request_size, args.duplicates, model.model.input_shape[1:])
+
+            scores, times = run(model, stream)
+            reference = scores if reference is None else reference
+            cache = model.get_prediction_cache()
+            hit_rate = cache.stats()['hit_rate'] if cache is not None else 0.
+            print(f"{name:<16}{times.mean():>11.3f}{np.percentile(times, 50):>10.3f}{np.percentile(times, 99):>10.3f}"
+                  f"{hit_rate:>10.1%}{np.max(np.abs(scores - reference)):>12.1e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Peak training memory and train step time with and without 'recompute_capsules', which recomputes the FCCaps and
+DigitCaps intermediates in the backward pass instead of keeping them, at several batch sizes. Every run is a fresh
+process (synthetic batches, random weights); the analytic train memory of utils.model_analysis is printed next to the
+measured peak.
+
+Usage: python -m benchmarks.recompute [--variants efficient_SMALLNORB original_MNIST_r3] [--batch-sizes 16 64 128]
+                                      [--steps 5] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from benchmarks.end_to_end import VARIANTS, benchmark_train, isolated
+
+
+def run(variant, config_path, batch_size, steps):
+    cls, model_name, kwargs = VARIANTS[variant]
+    model = cls(model_name, mode='train', config_path=config_path, **kwargs)
+    model.config['batch_size'] = batch_size
+    result = benchmark_train(model, steps)
+    result['estimated_mb'] = model.analyze(batch_size)['train_bytes'] / 2**20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', nargs='+', default=['efficient_MNIST', 'efficient_SMALLNORB', 'original_MNIST_r3'],
+                        choices=list(VARIANTS))
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64, 128])
+    parser.add_argument('--steps', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_paths = {}
+        for recompute in (False, True):
+            config_paths[recompute] = os.path.join(tmp, f'config_{recompute}.json')
+            with open(config_paths[recompute], 'w') as f:
+                json.dump(dict(config, recompute_capsules=recompute), f)
+
+        print(f"{'variant':<22}{'batch':>6}{'recompute':>11}{'step [ms]':>11}{'peak MB':>9}{'estimated MB':>14}")
+        for variant in args.variants:
+            for batch_size in args.batch_sizes:
+                for recompute in (False, True):
+                    r = isolated(run, variant, os.path.abspath(config_paths[recompute]), batch_size, args.steps)
+                    print(f"{variant:<22}{batch_size:>6}{str(recompute):>11}{r['train_step_ms']:>11.1f}"
+                          f"{r['train_peak_mb']:>9.1f}{r['estimated_mb']:>14.1f}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Single-sample request throughput of per-request keras 'predict' calls vs the micro-batching InferenceServer, with
+concurrent clients. Weights are random.
+
+Usage: python -m benchmarks.serving [--model MNIST] [--requests 1000] [--clients 32] [--max-batch 64] [--max-wait-ms 5]
+"""
+
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from models.model import EfficientCapsNet
+from utils.serving import InferenceServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    args = parser.parse_args()
+
+    model = EfficientCapsNet(args.model, mode='test', config_path=args.config, verbose=False)
+    input_shape = model.config[f'{args.model}_INPUT_SHAPE']
+    X = np.random.rand(args.requests, *input_shape).astype('float32')
+
+    model.predict(X[:1])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        list(executor.map(lambda i: model.predict(X[i:i+1]), range(args.requests)))
+    predict_throughput = args.requests / (time.perf_counter() - start)
+
+    server = InferenceServer(model, port=0, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms).start()
+    url = f'http://{server.host}:{server.port}'
+
+    def request(i):
+        data = json.dumps({'inputs': X[i:i+1].tolist()}).encode()
+        with urllib.request.urlopen(urllib.request.Request(url + '/predict', data=data)) as response:
+            return json.loads(response.read())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        list(executor.map(request, range(args.requests)))
+    server_throughput = args.requests / (time.perf_counter() - start)
+    with urllib.request.urlopen(url + '/stats') as response:
+        stats = json.loads(response.read())
+    server.stop()
+
+    print(f"{'per-request predict':<22}{predict_throughput:>10.1f} req/s")
+    print(f"{'micro-batching server':<22}{server_throughput:>10.1f} req/s (mean batch {stats['mean_batch_size']:.1f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Median latency of the preprocessing, encoder, routing and decoder stages (Model.profile_stages) and p50/p95/p99 of
+Model.classify for several batch sizes, with instrumentation enabled. The recorded metrics can be written as JSON or in
+the Prometheus text format, Ex. to compare them before and after a model update.
+
+Usage: python -m benchmarks.stage_latency [--model MNIST] [--original] [--batch-sizes 1 32 256] [--runs 20]
+                                          [--output metrics.json | metrics.prom] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+from models.model import EfficientCapsNet, CapsNet
+
+STAGES = ['preprocessing', 'encoder', 'routing', 'decoder']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--original', action='store_true', help='original CapsNet (MNIST only)')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', default=None, help='metrics file, Prometheus text if it ends with .prom')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = dict(json.load(f), instrumentation=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(config, f)
+        model = (CapsNet if args.original else EfficientCapsNet)(args.model, mode='test', config_path=config_path)
+
+    print(f"{'batch':>6}" + ''.join(f'{s + " [ms]":>20}' for s in STAGES) + f"{'classify p50/p95/p99 [ms]':>30}")
+    for batch_size in args.batch_sizes:
+        X = np.random.rand(batch_size, *model.model.input_shape[1:]).astype('float32')
+        stages = model.profile_stages(X, args.runs)
+        model.classify_batch(X) # tracing
+        model.instrumentation.histograms.pop('classify', None)
+        for _ in range(args.runs):
+            model.classify(X)
+        summary = model.instrumentation.to_dict()['classify']
+        print(f"{batch_size:>6}" + ''.join(f'{stages[s]:>20.3f}' for s in STAGES) +
+              f"{summary['p50_ms']:>12.3f}{summary['p95_ms']:>9.3f}{summary['p99_ms']:>9.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(model.get_metrics('prometheus' if args.output.endswith('.prom') else 'json'))
+        print(f"metrics written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Training throughput of keras 'fit' vs the custom TrainEngine on MNIST at the configured batch_size.
+Batches are synthetic and cached in memory so that only the train step is measured.
+
+Usage: python -m benchmarks.train_engine [--steps 200] [--config config.json]
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from models.model import EfficientCapsNet
+from utils.engine import TrainEngine
+from utils.tools import marginLoss, reconstructionLoss
+
+
+def synthetic_mnist(batch_size):
+    X = np.random.rand(batch_size, 28, 28, 1).astype('float32')
+    y = tf.keras.utils.to_categorical(np.random.randint(10, size=batch_size), num_classes=10)
+    return tf.data.Dataset.from_tensors(((X, y), (y, X))).repeat()
+
+
+def run(engine, config, steps, steps_per_execution=1, jit_compile=False):
+    model = EfficientCapsNet('MNIST', mode='train', config_path=config, verbose=False)
+    dataset = synthetic_mnist(model.config['batch_size'])
+    optimizer = tf.keras.optimizers.Adam(learning_rate=model.config['lr'])
+    loss, loss_weights = [marginLoss, reconstructionLoss], [1., model.config['lmd_gen']]
+
+    if engine == 'keras':
+        model.model.compile(optimizer=optimizer, loss=loss, loss_weights=loss_weights,
+                            metrics={'Efficient_CapsNet': 'accuracy'}, steps_per_execution=steps_per_execution,
+                            jit_compile=jit_compile)
+        fit = lambda epochs: model.model.fit(dataset, epochs=epochs, steps_per_epoch=steps, verbose=0)
+    else:
+        trainer = TrainEngine(model.model, optimizer, loss, loss_weights, 'accuracy',
+                              steps_per_execution=steps_per_execution, jit_compile=jit_compile)
+        fit = lambda epochs: trainer.fit(dataset, epochs=epochs, steps_per_epoch=steps, verbose=0)
+
+    fit(1) # tracing and compilation
+    start = time.perf_counter()
+    fit(1)
+    elapsed = time.perf_counter() - start
+    return steps * model.config['batch_size'] / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--steps', type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.config) as json_data_file:
+        batch_size = json.load(json_data_file)['batch_size']
+
+    settings = [('keras', 1, False), ('custom', 1, False), ('custom', 10, False), ('custom', 1, True), ('custom', 10, True)]
+    print(f"{'engine':<8}{'steps/exec':>12}{'xla':>6}{'img/s':>12}")
+    for engine, steps_per_execution, jit_compile in settings:
+        throughput = run(engine, args.config, args.steps, steps_per_execution, jit_compile)
+        print(f"{engine:<8}{steps_per_execution:>12}{str(jit_compile):>6}{throughput:>12.1f}")
+    print(f"batch_size: {batch_size}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Batch-1 latency and batch-256 throughput of the test graph with keras, dynamic-shape XLA and bucketed XLA
+('xla_buckets'), plus the total time of a stream of batches with random sizes (compilations included), where
+dynamic-shape XLA recompiles for every new batch size. The number of XLA fusions of a bucket is reported as well.
+
+Usage: python -m benchmarks.xla_buckets [--model MNIST] [--runs 100] [--stream 30] [--config config.json]
+"""
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from models.model import EfficientCapsNet
+from utils.backends import KerasBackend, XLABackend, XLABucketBackend
+
+
+def latency_ms(backend, X, runs):
+    backend.predict(X)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        backend.predict(X)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+def throughput(backend, X, runs):
+    backend.predict(X)
+    start = time.perf_counter()
+    for _ in range(runs):
+        backend.predict(X)
+    return runs * len(X) / (time.perf_counter() - start)
+
+
+def stream_s(backend, sizes, input_shape):
+    start = time.perf_counter()
+    for size in sizes:
+        backend.predict(np.random.rand(size, *input_shape).astype('float32'))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--stream', type=int, default=30, help='number of batches with random sizes')
+    args = parser.parse_args()
+
+    model = EfficientCapsNet(args.model, mode='test', config_path=args.config)
+    input_shape = model.model.input_shape[1:]
+    X_1 = np.random.rand(1, *input_shape).astype('float32')
+    X_256 = np.random.rand(256, *input_shape).astype('float32')
+    buckets = model.config.get('xla_buckets', [1, 8, 32, 128, 256])
+
+    backends = [KerasBackend(model.model, 256, verbose=0), XLABackend(model.model, 256), XLABucketBackend(model.model, 256, buckets)]
+    sizes = np.random.RandomState(0).randint(1, 257, size=args.stream)
+    print(f"{'backend':<14}{'batch 1 [ms]':>14}{'batch 256 [img/s]':>20}{f'{args.stream} random batches [s]':>26}")
+    for backend in backends:
+        print(f"{backend.name:<14}{latency_ms(backend, X_1, args.runs):>14.2f}"
+              f"{throughput(backend, X_256, max(1, args.runs // 10)):>20.1f}{stream_s(backend, sizes, input_shape):>26.2f}")
+
+    hlo = backends[-1].function.experimental_get_compiler_ir(tf.constant(X_1))(stage='optimized_hlo')
+    print(f"buckets: {buckets}, XLA fusions in the batch-1 executable: {hlo.count('fused_computation')}")
+
+
+if __name__ == '__main__':
+    main()
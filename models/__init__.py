@@ -1,2 +1,2 @@
-from models.model import EfficientCapsNet, CapsNet
-
+from models.model import EfficientCapsNet, EfficientCapsNetEnsemble, CapsNet
+from models.registry import ModelRegistry
@@ -15,10 +15,10 @@
 
 import numpy as np
 import tensorflow as tf
-from utils.layers import PrimaryCaps, FCCaps, Length, Mask
+from utils.layers import PrimaryCaps, FCCaps, Length, Mask, DecoderSubsample
 
 
-def efficient_capsnet_graph(input_shape):
+def efficient_capsnet_graph(input_shape, recompute=False):
     """
     Efficient-CapsNet graph architecture.
 
@@ -26,6 +26,8 @@ def efficient_capsnet_graph(input_shape):
     ----------   
     input_shape: list
         network input shape
+    recompute: bool
+        recompute the FCCaps intermediates in the backward pass instead of keeping them
     """
     inputs = tf.keras.Input(input_shape)
     
@@ -39,7 +41,7 @@ def efficient_capsnet_graph(input_shape):
     x = tf.keras.layers.BatchNormalization()(x)
     x = PrimaryCaps(128, 9, 16, 8)(x)
     
-    digit_caps = FCCaps(10,16)(x)
+    digit_caps = FCCaps(10,16, recompute=recompute)(x)
     
     digit_caps_len = Length(name='length_capsnet_output')(digit_caps)
 
@@ -65,7 +67,7 @@ def generator_graph(input_shape):
     return tf.keras.Model(inputs=inputs, outputs=x, name='Generator')
 
 
-def build_graph(input_shape, mode, verbose):
+def build_graph(input_shape, mode, verbose, decoder_fraction=1., decoder_every=1, recompute=False):
     """
     Efficient-CapsNet graph architecture with reconstruction regularizer. The network can be initialize with different modalities.
 
@@ -76,12 +78,18 @@ def build_graph(input_shape, mode, verbose):
     mode: str
         working mode ('train', 'test' & 'play')
     verbose: bool
+    decoder_fraction: float
+        fraction of the batch reconstructed in training (see DecoderSubsample)
+    decoder_every: int
+        the decoder runs once every decoder_every train steps on average (see DecoderSubsample)
+    recompute: bool
+        recompute the capsule intermediates in the backward pass to bound the training memory (see FCCaps)
     """
     inputs = tf.keras.Input(input_shape)
     y_true = tf.keras.layers.Input(shape=(10,))
     noise = tf.keras.layers.Input(shape=(10, 16))
 
-    efficient_capsnet = efficient_capsnet_graph(input_shape)
+    efficient_capsnet = efficient_capsnet_graph(input_shape, recompute)
 
     if verbose:
         efficient_capsnet.summary()
@@ -100,7 +108,12 @@ def build_graph(input_shape, mode, verbose):
         generator.summary()
         print("\n\n")
 
-    x_gen_train = generator(masked_by_y)
+    # the reconstruction branch of the train graph can be computed on a subset of the batch and of the steps
+    generator_train = generator
+    if decoder_fraction < 1 or decoder_every > 1:
+        generator_train = DecoderSubsample(generator, decoder_fraction, decoder_every, name='Generator_subsample')
+
+    x_gen_train = generator_train(masked_by_y)
     x_gen_eval = generator(masked)
     x_gen_play = generator(masked_noised_y)
 
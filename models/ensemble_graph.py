@@ -0,0 +1,69 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import tensorflow as tf
+
+
+def average(tensors, name=None):
+    return tensors[0] if len(tensors) == 1 else tf.keras.layers.Average(name=name)(tensors)
+
+
+def capsnet_graph(capsnets):
+    """
+    Capsule networks of the ensemble members averaged into a single network without decoder. Its outputs are the
+    averaged digit capsules and their averaged lengths, the ensemble class scores.
+
+    Parameters
+    ----------
+    capsnets: list
+        capsule networks of the members
+    """
+    inputs = tf.keras.Input(capsnets[0].input_shape[1:])
+    capsnets = [tf.keras.Model(capsnet.inputs, capsnet.outputs, name=f'member_{i}') for i, capsnet in enumerate(capsnets)]
+    outputs = [capsnet(inputs) for capsnet in capsnets]
+    digit_caps = average([o[0] for o in outputs])
+    digit_caps_len = average([o[1] for o in outputs], name='length_ensemble_output')
+    return tf.keras.Model(inputs=inputs, outputs=[digit_caps, digit_caps_len], name='Efficient_CapsNet_Ensemble_capsnet')
+
+
+def build_graph(members, mode):
+    """
+    Ensemble graph of members, networks built by the same build_graph, sharing their inputs. In 'train' mode the outputs
+    are those of every member in turn, so that each member keeps its own losses and is trained independently of the
+    others. In the other modes every output is averaged over the members.
+
+    Parameters
+    ----------
+    members: list
+        networks of the ensemble members, with the same inputs and outputs
+    mode: str
+        model modality (Ex. 'test')
+    """
+    inputs = [tf.keras.Input(i.shape[1:], dtype=i.dtype) for i in members[0].inputs]
+    members = [tf.keras.Model(member.inputs, member.outputs, name=f'member_{i}') for i, member in enumerate(members)]
+    outputs = [member(inputs if len(inputs) > 1 else inputs[0]) for member in members]
+
+    if mode == 'train':
+        return tf.keras.models.Model(inputs, [o for member_outputs in outputs for o in member_outputs], name='Efficient_CapsNet_Ensemble')
+    outputs = [average(list(o), name=f'ensemble_output_{k}') for k, o in enumerate(zip(*outputs))]
+    return tf.keras.models.Model(inputs, outputs, name='Efficient_CapsNet_Ensemble')
+
+
+def member_targets(dataset, n_members):
+    """
+    dataset of (inputs, targets) elements with the targets repeated for the n_members members of a 'train' ensemble
+    graph, so that the members share a single input pipeline
+    """
+    return dataset.map(lambda x, y: (x, tuple(y) * n_members))
@@ -15,14 +15,22 @@
 
 import numpy as np
 import tensorflow as tf
-from utils.layers import PrimaryCaps, FCCaps, Length
-from utils.tools import get_callbacks, marginLoss, multiAccuracy
+from utils.tools import get_callbacks, learn_scheduler, marginLoss, reconstructionLoss, multiAccuracy, scale_learning_rate, BackupCheckpoint, ThroughputMonitor
+from utils.engine import TrainEngine, find_micro_batch_size
+from utils.distribute import get_strategy, is_chief
+from utils.cpu_config import configure_threads
+from utils.export import export_model
+from utils.backends import get_backend
+from utils.prediction_cache import PredictionCache, weights_checksum
+from utils.instrumentation import Instrumentation, split_stages
+from utils.model_analysis import analyze
 from utils.dataset import Dataset
-from utils import pre_process_multimnist
-from models import efficient_capsnet_graph_mnist, efficient_capsnet_graph_smallnorb, efficient_capsnet_graph_multimnist, original_capsnet_graph_mnist
+from utils import pre_process_multimnist, pre_process_smallnorb, feature_cache
+import importlib
 import os
 import json
-from tqdm.notebook import tqdm
+import math
+import time
 
 
 class Model(object):
@@ -47,14 +55,46 @@ class Model(object):
         load configuration file
     load_graph_weights():
         load network weights
+    get_backend():
+        inference backend defined in the configuration file
     predict(dataset_test):
         use the model to predict dataset_test
-    evaluate(X_test, y_test):
+    export(export_dir):
+        write a SavedModel with classification and full signatures
+    get_capsnet():
+        capsule network sub-model, without decoder
+    analyze(batch_size):
+        analytic FLOPs, parameters and memory of the network
+    classify(X, return_vectors):
+        class scores of X computed without decoder, served from the prediction cache if it is enabled
+    classify_batch(X, return_vectors):
+        class scores of X computed without decoder
+    classify_crops(X, n_crops, flip):
+        class scores of rescaled smallNORB images averaged over several crops in one forward pass
+    get_prediction_cache():
+        prediction cache of the current weights defined in the configuration file
+    evaluate(X_test, y_test, profile):
         comute accuracy and test error with the given dataset (X_test, y_test)
+    profile_predict(calls):
+        capture a profiler trace of the next calls to predict
+    profile_stages(X, runs):
+        record the latency of the preprocessing, encoder, routing and decoder stages on X
+    get_metrics(format):
+        latency and throughput metrics of the inference calls as JSON or Prometheus text
     save_graph_weights():
         save model weights
+    get_learning_rate(effective_batch_size):
+        learning rate scaled to the effective batch size
+    get_decoder_subsample():
+        decoder subsampling arguments of build_graph
+    get_callbacks(tag, monitor):
+        training callbacks with the learning rate schedule defined in the configuration file
+    get_tf_data(dataset):
+        train and validation pipelines, sharded across workers when training is distributed
+    train_graph(dataset_train, dataset_val, loss, loss_weights, metric, steps, initial_epoch, callbacks, model, metric_outputs):
+        compile and train the network with the engine defined in the configuration file
     """
-    def __init__(self, model_name, mode='test', config_path='config.json', verbose=True):
+    def __init__(self, model_name, mode='test', config_path='config.json', verbose=False):
         self.model_name = model_name
         self.model = None
         self.mode = mode
@@ -62,6 +102,16 @@ class Model(object):
         self.config = None
         self.verbose = verbose
         self.load_config()
+        configure_threads(self.config) # before the strategy initializes the TensorFlow runtime
+        self.strategy = get_strategy(self.config)
+        self.classify_function = None
+        self.crops_function = None
+        self.backend = None
+        self.prediction_cache = None
+        self.instrumentation = Instrumentation({'model': f'{type(self).__name__}_{model_name}'}) if self.config.get('instrumentation') else None
+        self.stages = None
+        self.profile_calls = self.config.get('profile_predict_calls') or 0
+        self.profiling = None
 
 
     def load_config(self):
@@ -73,28 +123,248 @@ class Model(object):
     
 
     def load_graph_weights(self):
+        self.prediction_cache = None # results of the previous weights
+        self.backend = None # backends may hold a converted or restored copy of the weights
         try:
             self.model.load_weights(self.model_path)
         except Exception as e:
-            print("[ERRROR] Graph Weights not found")
+            print(f"[ERROR] Graph weights could not be loaded from {self.model_path}: {e}")
+            raise
             
         
+    def get_backend(self):
+        """
+        Inference backend defined by 'inference_backend' in the configuration file ('keras', 'xla' or 'tflite')
+        """
+        if self.backend is None:
+            self.backend = get_backend(self.config.get('inference_backend', 'keras'), self.model, self.config)
+        return self.backend
+
+
+    def record_timing(self, name, start, n_images):
+        if self.instrumentation is not None:
+            self.instrumentation.record(name, time.perf_counter() - start, n_images)
+
+
+    def start_profiler(self, tag):
+        """
+        Start a profiler trace written to the TensorBoard log directory of the model followed by tag. Only one trace can
+        run at a time in a process.
+        """
+        try:
+            tf.profiler.experimental.start(self.tb_path + tag)
+        except (tf.errors.AlreadyExistsError, tf.errors.UnavailableError) as e:
+            print(f"[WARNING] Profiler trace {tag} not started: {e}")
+            return False
+        self.profiling = tag
+        return True
+
+
+    def stop_profiler(self):
+        tf.profiler.experimental.stop()
+        print(f"[INFO] Profiler trace written to {self.tb_path + self.profiling}")
+        self.profiling = None
+
+
+    def profile_predict(self, calls=1):
+        """
+        Capture a profiler trace of the next calls to predict (log directory tb_path + '_predict')
+        """
+        self.profile_calls = calls
+
+
     def predict(self, dataset_test):
-        return self.model.predict(dataset_test)
+        if self.profile_calls > 0 and self.profiling is None and not self.start_profiler('_predict'):
+            self.profile_calls = 0
+        outputs = None
+        try:
+            start = time.perf_counter()
+            outputs = self.get_backend().predict(dataset_test)
+            self.record_timing('predict', start, len(outputs[0]))
+        finally:
+            if self.profiling == '_predict':
+                # a failed call ends the trace
+                self.profile_calls = self.profile_calls - 1 if outputs is not None else 0
+                if self.profile_calls <= 0:
+                    self.stop_profiler()
+        return outputs
+
+
+    def profile_stages(self, X, runs=10):
+        """
+        Run X through the preprocessing (conversion to a float32 tensor), encoder, routing and decoder stages of the test
+        graph separately, runs times, and record their latencies as 'stage_<name>'. Return the median latency [ms] of
+        every stage.
+        """
+        if self.mode != 'test':
+            raise ValueError(f"stages are defined on 'test' models, not on '{self.mode}' ones")
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation({'model': f'{type(self).__name__}_{self.model_name}'})
+        if self.stages is None:
+            encoder, routing, decoder = split_stages(self.model, self.get_capsnet())
+            self.stages = [('encoder', tf.function(lambda x: encoder(x, training=False))),
+                           ('routing', tf.function(lambda x: routing(x, training=False)[0])),
+                           ('decoder', tf.function(lambda x: decoder(x, training=False)))]
+        timings = {}
+        for run in range(runs + 1):
+            start = time.perf_counter()
+            x = tf.convert_to_tensor(np.asarray(X, dtype=np.float32))
+            times = [('preprocessing', time.perf_counter() - start)]
+            for name, stage in self.stages:
+                start = time.perf_counter()
+                x = stage(x)
+                tf.nest.map_structure(lambda t: t.numpy(), x) # wait for the results
+                times.append((name, time.perf_counter() - start))
+            if run == 0:
+                continue # tracing
+            for name, seconds in times:
+                self.instrumentation.record(f'stage_{name}', seconds, len(X))
+                timings.setdefault(name, []).append(seconds)
+        return {name: 1000 * np.median(seconds) for name, seconds in timings.items()}
+
+
+    def get_metrics(self, format='json'):
+        """
+        Recorded latencies and throughput as a JSON string ('json') or in the Prometheus text format ('prometheus').
+        'instrumentation' must be enabled in the configuration file.
+        """
+        if self.instrumentation is None:
+            raise ValueError("instrumentation is disabled, set 'instrumentation' in the configuration file")
+        if format == 'prometheus':
+            return self.instrumentation.to_prometheus()
+        return self.instrumentation.to_json()
+
+
+    def export(self, export_dir):
+        """
+        Write a SavedModel with a classification-only ('serving_default') and a full ('full') signature, fixed input
+        spec and bundled TensorFlow Serving warmup requests. Load it with utils.export.load, without the graph-building
+        code.
+        """
+        if self.mode != 'test':
+            raise ValueError(f"only 'test' models can be exported, not '{self.mode}' ones")
+        export_model(self.model, self.get_capsnet(), self.model.input_shape[1:], export_dir)
+
+
+    def get_capsnet(self):
+        """
+        Capsule network without decoder. Its last two outputs are digit_caps and digit_caps_len
+        """
+        return next(layer for layer in self.model.layers if layer.name in ('Efficient_CapsNet', 'Original_CapsNet'))
+
+
+    def analyze(self, batch_size=None):
+        """
+        Per-layer and total FLOPs, parameters and memory of the graph at batch_size (default: 'batch_size' in the
+        configuration file), estimated without running it. See utils.model_analysis.analyze.
+        """
+        return analyze(self.model, batch_size or self.config['batch_size'], training=self.mode == 'train')
+
+
+    def get_prediction_cache(self):
+        """
+        PredictionCache of the current weights ('prediction_cache_size' samples in memory, 'prediction_cache_dir' on
+        disk, digit capsules included if 'prediction_cache_vectors'), None if 'prediction_cache_size' is not set
+        """
+        if self.prediction_cache is None and self.config.get('prediction_cache_size'):
+            namespace = f'{type(self).__name__}_{self.model_name}-{weights_checksum(self.model)}'
+            self.prediction_cache = PredictionCache(namespace, self.config['prediction_cache_size'],
+                                                    self.config.get('prediction_cache_dir'),
+                                                    self.config.get('prediction_cache_vectors', False))
+        return self.prediction_cache
+
+
+    def classify(self, X, return_vectors=False):
+        """
+        Class scores (digit capsules lengths) of a batch X computed by a compiled forward pass of the capsule network
+        only, without decoder. With return_vectors, the digit capsules are returned too. If the prediction cache is
+        enabled, only samples that are not cached are computed.
+        """
+        start = time.perf_counter()
+        cache = self.get_prediction_cache()
+        if cache is not None:
+            outputs = cache.classify(self.classify_batch, X, return_vectors)
+        else:
+            outputs = self.classify_batch(X, return_vectors)
+        self.record_timing('classify', start, len(X))
+        return outputs
+
+
+    def classify_batch(self, X, return_vectors=False):
+        """
+        Class scores of X (and digit capsules with return_vectors) computed without prediction cache
+        """
+        if self.classify_function is None:
+            capsnet = self.get_capsnet()
+            self.classify_function = tf.function(lambda x: capsnet(x, training=False)[-2:], reduce_retracing=True)
+        digit_caps, digit_caps_len = self.classify_function(tf.convert_to_tensor(X, dtype=tf.float32))
+        if return_vectors:
+            return digit_caps_len.numpy(), digit_caps.numpy()
+        return digit_caps_len.numpy()
+
+
+    def classify_crops(self, X, n_crops=None, flip=None):
+        """
+        Class scores of the rescaled smallNORB images X ('scale_smallnorb' side) averaged over n_crops crops (default:
+        'test_crops' in the configuration file) and, with flip (default: 'test_flip'), their horizontal flips. The crops
+        of 'inference_batch_size' images are cut and classified by a single compiled forward pass of the capsule network,
+        without decoder.
+        """
+        n_crops = n_crops or self.config.get('test_crops', 1)
+        flip = self.config.get('test_flip', False) if flip is None else flip
+        if self.crops_function is None:
+            capsnet = self.get_capsnet()
+            def crops_function(x, n_crops, flip):
+                digit_caps_len = capsnet(pre_process_smallnorb.test_crops(x, self.config, n_crops, flip), training=False)[-1]
+                return tf.reduce_mean(tf.reshape(digit_caps_len, (tf.shape(x)[0], -1, digit_caps_len.shape[-1])), axis=1)
+            self.crops_function = tf.function(crops_function, reduce_retracing=True)
+        start = time.perf_counter()
+        batch_size = self.config.get('inference_batch_size', 32)
+        y_pred = [self.crops_function(tf.convert_to_tensor(X[i:i+batch_size], dtype=tf.float32), n_crops, bool(flip)).numpy()
+                  for i in range(0, len(X), batch_size)]
+        self.record_timing('classify_crops', start, len(X))
+        return np.concatenate(y_pred)
     
 
-    def evaluate(self, X_test, y_test):
+    def evaluate(self, X_test, y_test, profile=None):
+        """
+        Compute accuracy and test error on (X_test, y_test). SMALLNORB X_test can be the center patches or the rescaled
+        images, which are evaluated on 'test_crops' crops (and flips with 'test_flip', see classify_crops). With profile
+        (default: 'profile_evaluate' in the configuration file) a profiler trace of the evaluation is written to
+        tb_path + '_evaluate'.
+        """
+        if profile is None:
+            profile = self.config.get('profile_evaluate', False)
+        profiling = profile and self.profiling is None and self.start_profiler('_evaluate')
+        try:
+            self.evaluate_accuracy(X_test, y_test)
+        finally:
+            if profiling:
+                self.stop_profiler()
+
+
+    def evaluate_accuracy(self, X_test, y_test):
         print('-'*30 + f'{self.model_name} Evaluation' + '-'*30)
+        evaluation_start = time.perf_counter()
         if self.model_name == "MULTIMNIST":
             dataset_test = pre_process_multimnist.generate_tf_data_test(X_test, y_test, self.config["shift_multimnist"], n_multi=self.config['n_overlay_multimnist'])
+            from tqdm.notebook import tqdm
             acc = []
+            start = time.perf_counter()
             for X,y in tqdm(dataset_test,total=len(X_test)):
-                y_pred,X_gen1,X_gen2 = self.model.predict(X)
+                self.record_timing('evaluate_preprocessing', start, len(X))
+                y_pred,X_gen1,X_gen2 = self.predict(X)
                 acc.append(multiAccuracy(y, y_pred))
+                start = time.perf_counter()
             acc = np.mean(acc)
+        elif self.model_name == 'SMALLNORB' and X_test.shape[1] == self.config['scale_smallnorb']:
+            # rescaled images instead of the center patches: multi-crop evaluation, without decoder
+            y_pred = self.classify_crops(X_test)
+            acc = np.sum(np.argmax(y_pred, 1) == np.argmax(y_test, 1))/y_test.shape[0]
         else:
-            y_pred, X_gen =  self.model.predict(X_test)
+            y_pred, X_gen =  self.predict(X_test)
             acc = np.sum(np.argmax(y_pred, 1) == np.argmax(y_test, 1))/y_test.shape[0]
+        self.record_timing('evaluate', evaluation_start, len(X_test))
         test_error = 1 - acc
         print('Test acc:', acc)
         print(f"Test error [%]: {(test_error):.4%}")
@@ -108,6 +378,140 @@ class Model(object):
         self.model.save_weights(self.model_path)
 
 
+    def get_learning_rate(self, effective_batch_size=None):
+        """
+        Learning rate 'lr', tuned for 'batch_size', scaled to effective_batch_size (default: 'effective_batch_size') with
+        the 'lr_scaling' rule. If not set, the effective batch size is 'batch_size' times the number of replicas.
+        """
+        effective_batch_size = (effective_batch_size or self.config.get('effective_batch_size')
+                                or self.config['batch_size'] * self.strategy.num_replicas_in_sync)
+        return scale_learning_rate(self.config['lr'], self.config['batch_size'], effective_batch_size,
+                                   self.config.get('lr_scaling', 'linear'))
+
+
+    def get_decoder_subsample(self):
+        """
+        Fraction of the batch ('decoder_fraction') and frequency of the steps ('decoder_every') on which the
+        reconstruction loss is computed in training
+        """
+        return {'decoder_fraction': self.config.get('decoder_fraction', 1.), 'decoder_every': self.config.get('decoder_every', 1)}
+
+
+    def get_callbacks(self, tag='', monitor='val_Efficient_CapsNet_accuracy'):
+        """
+        Training callbacks. tag is appended to the log directory, checkpoint and backup names (Ex. '_finetune'). The best
+        weights are the ones that optimize the monitor metric.
+        """
+        tb_path = self.tb_path + tag
+        saved_model_path = tag.join(os.path.splitext(self.model_path_new_train))
+        backup_dir = self.config.get('backup_dir')
+        if backup_dir is not None:
+            backup_dir = os.path.join(backup_dir, os.path.basename(tb_path))
+        return get_callbacks(tb_path, saved_model_path, self.config['lr_dec'], self.get_learning_rate(),
+                             self.config.get('warmup_epochs', 0), self.config['lr'], is_chief(self.strategy),
+                             backup_dir, self.config.get('backup_freq'), self.config.get('backup_async', True),
+                             self.config.get('throughput_log_freq', 100), self.config.get('profile_batch') or 0, monitor)
+
+
+    def get_tf_data(self, dataset):
+        """
+        Train and validation pipelines of dataset. With more than one replica, every training input pipeline reads its
+        own shard and batches 'batch_size' samples per replica, while the training set is repeated (steps must be given
+        to fit). The validation set is split by elements across workers.
+        """
+        if self.strategy.num_replicas_in_sync == 1:
+            return dataset.get_tf_data()
+        dataset_train = self.strategy.distribute_datasets_from_function(lambda context: dataset.get_tf_data(context)[0].repeat())
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        dataset_val = dataset.get_tf_data()[1].with_options(options)
+        return dataset_train, dataset_val
+
+
+    def train_graph(self, dataset_train, dataset_val, loss, loss_weights, metric, steps, initial_epoch, callbacks, model=None,
+                    metric_outputs=(0,)):
+        """
+        Compile and train the network. 'train_engine' in the configuration file selects keras 'fit' ('keras') or the
+        custom training loop ('custom') that fuses 'steps_per_execution' steps and optionally compiles them with XLA.
+        If 'effective_batch_size' is larger than the global micro-batch, gradients are accumulated with the custom loop.
+        The micro-batch is 'batch_size' or, if 'micro_batch_memory_mb' is set, the largest one that fits that budget
+        (single replica only, the setting is ignored with a warning otherwise). The learning rate (and its schedule in
+        callbacks) is scaled to the actual batch of an update, micro-batch x replicas x accumulation steps.
+        If 'backup_dir' is set, training resumes automatically from the latest backup checkpoint (written every epoch and
+        every 'backup_freq' steps), skipping the batches of its epoch already trained on. If callbacks contain a
+        ThroughputMonitor, the input wait of dataset_train (tf.data.Dataset only) is measured. model defaults to the
+        network graph, metric is tracked on its metric_outputs (indices of the outputs, default: the class scores).
+        """
+        if model is None:
+            model = self.model
+        self.prediction_cache = None # weights are going to change
+        self.backend = None
+        n_replicas = self.strategy.num_replicas_in_sync
+        batch_size = self.config['batch_size']
+        effective_batch_size = self.config.get('effective_batch_size') or batch_size * n_replicas
+        if self.config.get('micro_batch_memory_mb') and n_replicas > 1:
+            print(f"[WARNING] micro_batch_memory_mb = {self.config['micro_batch_memory_mb']} ignored with {n_replicas} replicas, "
+                  f"the micro-batch is batch_size = {batch_size} per replica")
+        elif self.config.get('micro_batch_memory_mb'):
+            cardinality = int(dataset_train.cardinality())
+            batch_size = find_micro_batch_size(model, loss, loss_weights, dataset_train,
+                                               self.config['micro_batch_memory_mb'], effective_batch_size)
+            dataset_train = dataset_train.unbatch().batch(batch_size)
+            if steps is None and cardinality > 0: # rebatching hides the cardinality
+                steps = cardinality
+                dataset_train = dataset_train.repeat()
+            dataset_train = dataset_train.prefetch(-1)
+        accum_steps = max(1, math.ceil(effective_batch_size / (batch_size * n_replicas)))
+        if steps is not None: # steps are given in 'batch_size' batches
+            steps = max(1, steps * self.config['batch_size'] // (batch_size * accum_steps * n_replicas))
+        # the learning rate is scaled to the batch of an update, larger than effective_batch_size if the micro-batch
+        # does not divide it
+        if batch_size * n_replicas * accum_steps != effective_batch_size:
+            print(f"[WARNING] effective batch size {batch_size * n_replicas * accum_steps} instead of {effective_batch_size}: "
+                  f"{accum_steps} accumulation steps of {n_replicas} x {batch_size} samples")
+        effective_batch_size = batch_size * n_replicas * accum_steps
+        lr = self.get_learning_rate(effective_batch_size)
+        print(f"[INFO] effective batch size: {effective_batch_size} learning rate: {lr:.3g}")
+        for callback in callbacks:
+            if isinstance(callback, tf.keras.callbacks.LearningRateScheduler):
+                callback.schedule = learn_scheduler(self.config['lr_dec'], lr, self.config.get('warmup_epochs', 0), self.config['lr'])
+
+        with self.strategy.scope():
+            optimizer = tf.keras.optimizers.Adam(learning_rate=lr)
+            optimizer.build(model.trainable_variables)
+
+            # resume from the latest backup, if any, without the batches already trained on in its epoch
+            for callback in callbacks:
+                if isinstance(callback, BackupCheckpoint):
+                    initial_epoch = max(initial_epoch, callback.restore(model, optimizer))
+                    dataset_train, steps = callback.skip_consumed(dataset_train, steps, accum_steps)
+            if isinstance(dataset_train, tf.data.Dataset):
+                for callback in callbacks:
+                    if isinstance(callback, ThroughputMonitor):
+                        dataset_train = callback.wrap(dataset_train)
+
+            if self.config.get('train_engine', 'keras') == 'custom' or accum_steps > 1:
+                print(f"[INFO] micro-batch: {batch_size} accumulation steps: {accum_steps} replicas: {n_replicas}")
+                engine = TrainEngine(model, optimizer, loss, loss_weights, metric,
+                                     steps_per_execution=self.config.get('steps_per_execution', 1),
+                                     jit_compile=self.config.get('jit_compile', False),
+                                     accum_steps=accum_steps, metric_outputs=metric_outputs)
+                return engine.fit(dataset_train,
+                  epochs=self.config['epochs'], steps_per_epoch=steps,
+                  validation_data=dataset_val, initial_epoch=initial_epoch,
+                  callbacks=callbacks)
+
+            model.compile(optimizer=optimizer,
+              loss=loss,
+              loss_weights=loss_weights,
+              metrics={model.output_names[i]: metric for i in metric_outputs})
+
+        return model.fit(dataset_train,
+          epochs=self.config['epochs'], steps_per_epoch=steps,
+          validation_data=(dataset_val), batch_size=batch_size, initial_epoch=initial_epoch,
+          callbacks=callbacks)
+
+
 
 class EfficientCapsNet(Model):
     """
@@ -134,9 +538,10 @@ class EfficientCapsNet(Model):
         load the network graph given the model_name
     train(dataset, initial_epoch)
         train the constructed network with a given dataset. All train hyperparameters are defined in the configuration file
-
+    finetune(dataset, initial_epoch)
+        train FCCaps and the decoder on cached features of the frozen stem
     """
-    def __init__(self, model_name, mode='test', config_path='config.json', custom_path=None, verbose=True):
+    def __init__(self, model_name, mode='test', config_path='config.json', custom_path=None, verbose=False):
         Model.__init__(self, model_name, mode, config_path, verbose)
         if custom_path != None:
             self.model_path = custom_path
@@ -144,46 +549,201 @@ class EfficientCapsNet(Model):
             self.model_path = os.path.join(self.config['saved_model_dir'], f"efficient_capsnet_{self.model_name}.h5")
         self.model_path_new_train = os.path.join(self.config['saved_model_dir'], f"efficient_capsnet{self.model_name}_new_train.h5")
         self.tb_path = os.path.join(self.config['tb_log_save_dir'], f"efficient_capsnet_{self.model_name}")
-        self.load_graph()
+        with self.strategy.scope():
+            self.load_graph()
     
 
     def load_graph(self):
-        if self.model_name == 'MNIST':
-            self.model = efficient_capsnet_graph_mnist.build_graph(self.config['MNIST_INPUT_SHAPE'], self.mode, self.verbose)
-        elif self.model_name == 'SMALLNORB':
-            self.model = efficient_capsnet_graph_smallnorb.build_graph(self.config['SMALLNORB_INPUT_SHAPE'], self.mode, self.verbose)
-        elif self.model_name == 'MULTIMNIST':
-            self.model = efficient_capsnet_graph_multimnist.build_graph(self.config['MULTIMNIST_INPUT_SHAPE'], self.mode, self.verbose)
+        # only the graph module of model_name (and its dependencies) is imported
+        graph = importlib.import_module(f'models.efficient_capsnet_graph_{self.model_name.lower()}')
+        self.model = graph.build_graph(self.config[f'{self.model_name}_INPUT_SHAPE'], self.mode, self.verbose,
+                                       recompute=self.config.get('recompute_capsules', False), **self.get_decoder_subsample())
             
     def train(self, dataset=None, initial_epoch=0):
-        callbacks = get_callbacks(self.tb_path, self.model_path_new_train, self.config['lr_dec'], self.config['lr'])
+        callbacks = self.get_callbacks()
 
         if dataset == None:
             dataset = Dataset(self.model_name, self.config_path)
-        dataset_train, dataset_val = dataset.get_tf_data()    
+        dataset_train, dataset_val = self.get_tf_data(dataset)
 
         if self.model_name == 'MULTIMNIST':
-            self.model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=self.config['lr']),
-              loss=[marginLoss, 'mse', 'mse'],
-              loss_weights=[1., self.config['lmd_gen']/2,self.config['lmd_gen']/2],
-              metrics={'Efficient_CapsNet': multiAccuracy})
+            loss = [marginLoss, reconstructionLoss, reconstructionLoss]
+            loss_weights = [1., self.config['lmd_gen']/2,self.config['lmd_gen']/2]
+            metric = multiAccuracy
             steps = 10*int(dataset.y_train.shape[0] / self.config['batch_size'])
         else:
-            self.model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=self.config['lr']),
-              loss=[marginLoss, 'mse'],
-              loss_weights=[1., self.config['lmd_gen']],
-              metrics={'Efficient_CapsNet': 'accuracy'})
-            steps=None
+            loss = [marginLoss, reconstructionLoss]
+            loss_weights = [1., self.config['lmd_gen']]
+            metric = 'accuracy'
+            steps = int(dataset.y_train.shape[0] / self.config['batch_size']) if self.strategy.num_replicas_in_sync > 1 else None
 
         print('-'*30 + f'{self.model_name} train' + '-'*30)
 
-        history = self.model.fit(dataset_train,
-          epochs=self.config[f'epochs'], steps_per_epoch=steps,
-          validation_data=(dataset_val), batch_size=self.config['batch_size'], initial_epoch=initial_epoch,
-          callbacks=callbacks)
+        history = self.train_graph(dataset_train, dataset_val, loss, loss_weights, metric, steps, initial_epoch, callbacks)
         
         return history
 
+
+    def finetune(self, dataset=None, initial_epoch=0):
+        """
+        Fine-tune FCCaps and the decoder with a frozen stem (convolutions + PrimaryCaps). The stem runs once over the
+        dataset and its primary capsules are cached in 'feature_cache_dir' (recomputed when weights, preprocessing or
+        images change). Training samples are not augmented and SMALLNORB ones are center-cropped. The best weights are
+        saved in the full graph format to the new train weights path. MNIST and SMALLNORB only.
+        """
+        if self.model_name not in feature_cache.PREPROCESSING_KEYS:
+            raise ValueError(f'feature cache not available for {self.model_name}')
+        callbacks = self.get_callbacks('_finetune')
+
+        if dataset == None:
+            dataset = Dataset(self.model_name, self.config_path)
+        X_train, X_val = np.asarray(dataset.X_train), np.asarray(dataset.X_test)
+        if self.model_name == 'SMALLNORB':
+            X_train, _ = pre_process_smallnorb.test_patches(X_train, None, self.config)
+            X_val = np.asarray(dataset.X_test_patch)
+
+        stem, head = feature_cache.split_capsnet(self.model.get_layer('Efficient_CapsNet'))
+        generator = next(layer for layer in self.model.layers if layer.name.startswith('Generator'))
+        model = feature_cache.head_graph(head, generator, self.model.output_shape[0][-1])
+
+        cache_dir = self.config.get('feature_cache_dir', 'feature_cache')
+        preprocessing = {key: self.config[key] for key in feature_cache.PREPROCESSING_KEYS[self.model_name]}
+        name = os.path.basename(self.tb_path)
+        features_train = feature_cache.load_features(cache_dir, f'{name}_train', stem, X_train, preprocessing)
+        features_val = feature_cache.load_features(cache_dir, f'{name}_val', stem, X_val, preprocessing)
+        dataset_train = feature_cache.generate_tf_data(features_train, X_train, dataset.y_train, self.config['batch_size'])
+        dataset_val = feature_cache.generate_tf_data(features_val, X_val, dataset.y_test, self.config['batch_size'], shuffle=False)
+
+        print('-'*30 + f'{self.model_name} finetune' + '-'*30)
+
+        history = self.train_graph(dataset_train, dataset_val, [marginLoss, reconstructionLoss], [1., self.config['lmd_gen']],
+                                   'accuracy', None, initial_epoch, callbacks, model)
+
+        head_path = '_finetune'.join(os.path.splitext(self.model_path_new_train))
+        if is_chief(self.strategy) and os.path.exists(head_path):
+            model.load_weights(head_path) # best checkpoint, shared with the full graph
+            self.model.save_weights(self.model_path_new_train)
+
+        return history
+
+
+
+class EfficientCapsNetEnsemble(EfficientCapsNet):
+    """
+    A class used to manage an ensemble of Efficient-CapsNet models held in a single graph. The members are built by the
+    same build_graph with independent initializations and share the inputs: in 'train' mode they are trained together
+    on one input pipeline, each with its own losses, otherwise the graph predicts their averaged outputs in a single
+    forward pass.
+    
+    ...
+    
+    Attributes
+    ----------
+    model_name: str
+        name of the model (Ex. 'MNIST')
+    mode: str
+        model modality (Ex. 'test')
+    config_path: str
+        path configuration file
+    custom_path: str
+        custom weights path
+    verbose: bool
+    n_members: int
+        number of members (default: 'ensemble_members' in the configuration file)
+    
+    Methods
+    -------
+    load_graph():
+        build the ensemble graph of n_members networks given the model_name
+    load_member_weights(paths):
+        load the weights of separately trained networks into the members
+    get_capsnet():
+        averaged capsule networks of the members, without decoder
+    get_tf_data(dataset):
+        train and validation pipelines with the targets repeated for every member
+    """
+    def __init__(self, model_name, mode='test', config_path='config.json', custom_path=None, verbose=False, n_members=None):
+        self.n_members = n_members
+        self.capsnet = None
+        EfficientCapsNet.__init__(self, model_name, mode, config_path, custom_path, verbose)
+        name = f"{self.model_name}_ensemble{self.n_members}"
+        if custom_path == None:
+            self.model_path = os.path.join(self.config['saved_model_dir'], f"efficient_capsnet_{name}.h5")
+        self.model_path_new_train = os.path.join(self.config['saved_model_dir'], f"efficient_capsnet{name}_new_train.h5")
+        self.tb_path = os.path.join(self.config['tb_log_save_dir'], f"efficient_capsnet_{name}")
+
+
+    def load_config(self):
+        EfficientCapsNet.load_config(self)
+        self.n_members = self.n_members or self.config.get('ensemble_members', 3)
+
+
+    def load_graph(self):
+        graph = importlib.import_module(f'models.efficient_capsnet_graph_{self.model_name.lower()}')
+        ensemble_graph = importlib.import_module('models.ensemble_graph')
+        members = [graph.build_graph(self.config[f'{self.model_name}_INPUT_SHAPE'], self.mode, self.verbose and i == 0,
+                                     recompute=self.config.get('recompute_capsules', False), **self.get_decoder_subsample())
+                   for i in range(self.n_members)]
+        self.model = ensemble_graph.build_graph(members, self.mode)
+        self.capsnet = None
+
+
+    def load_member_weights(self, paths):
+        """
+        Load the weights of n_members separately trained networks of the same model_name (Ex. the .h5 files of
+        EfficientCapsNet), one per member
+        """
+        if len(paths) != self.n_members:
+            raise ValueError(f"{self.n_members} weights files expected, got {len(paths)}")
+        self.prediction_cache = None # results of the previous weights
+        self.backend = None
+        for i, path in enumerate(paths):
+            self.model.get_layer(f'member_{i}').load_weights(path)
+
+
+    def get_capsnet(self):
+        """
+        Capsule networks of the members averaged into one, without decoder. Its last two outputs are the averaged
+        digit_caps and digit_caps_len (the ensemble class scores)
+        """
+        if self.capsnet is None:
+            ensemble_graph = importlib.import_module('models.ensemble_graph')
+            members = [self.model.get_layer(f'member_{i}') for i in range(self.n_members)]
+            self.capsnet = ensemble_graph.capsnet_graph([member.get_layer('Efficient_CapsNet') for member in members])
+        return self.capsnet
+
+
+    def get_callbacks(self, tag='', monitor='val_loss'):
+        """
+        Training callbacks. The best weights are the ones with the lowest validation loss, the sum of the losses of all
+        the members
+        """
+        return EfficientCapsNet.get_callbacks(self, tag, monitor)
+
+
+    def get_tf_data(self, dataset):
+        """
+        Train and validation pipelines of dataset, shared by the members: every element carries the targets of all the
+        members. Ensembles are trained on a single replica.
+        """
+        if self.strategy.num_replicas_in_sync > 1:
+            raise ValueError("ensembles are trained on a single replica, set 'distribute_strategy' to 'none'")
+        ensemble_graph = importlib.import_module('models.ensemble_graph')
+        return tuple(ensemble_graph.member_targets(d, self.n_members) for d in dataset.get_tf_data())
+
+
+    def train_graph(self, dataset_train, dataset_val, loss, loss_weights, metric, *args, **kwargs):
+        # the losses of a single network, repeated for every member: the members do not share any weight, so each one
+        # gets the gradients it would get if trained alone. The metric is tracked on the class scores of every member
+        # (logged as member_<i>_<metric>)
+        return EfficientCapsNet.train_graph(self, dataset_train, dataset_val, loss * self.n_members,
+                                            loss_weights * self.n_members, metric, *args,
+                                            metric_outputs=[i * len(loss) for i in range(self.n_members)], **kwargs)
+
+
+    def finetune(self, dataset=None, initial_epoch=0):
+        raise ValueError('finetune is not available for ensembles, fine-tune the members separately')
+
             
         
         
@@ -212,7 +772,7 @@ class CapsNet(Model):
     train():
         train the constructed network with a given dataset. All train hyperparameters are defined in the configuration file
     """
-    def __init__(self, model_name, mode='test', config_path='config.json', custom_path=None, verbose=True, n_routing=3):
+    def __init__(self, model_name, mode='test', config_path='config.json', custom_path=None, verbose=False, n_routing=3):
         Model.__init__(self, model_name, mode, config_path, verbose)   
         self.n_routing = n_routing
         self.load_config()
@@ -222,30 +782,27 @@ class CapsNet(Model):
             self.model_path = os.path.join(self.config['saved_model_dir'], f"efficient_capsnet_{self.model_name}.h5")
         self.model_path_new_train = os.path.join(self.config['saved_model_dir'], f"original_capsnet_{self.model_name}_new_train.h5")
         self.tb_path = os.path.join(self.config['tb_log_save_dir'], f"original_capsnet_{self.model_name}")
-        self.load_graph()
+        with self.strategy.scope():
+            self.load_graph()
 
     
     def load_graph(self):
-        self.model = original_capsnet_graph_mnist.build_graph(self.config['MNIST_INPUT_SHAPE'], self.mode, self.n_routing, self.verbose)
+        original_capsnet_graph_mnist = importlib.import_module('models.original_capsnet_graph_mnist')
+        self.model = original_capsnet_graph_mnist.build_graph(self.config['MNIST_INPUT_SHAPE'], self.mode, self.n_routing, self.verbose,
+                                                               recompute=self.config.get('recompute_capsules', False),
+                                                               **self.get_decoder_subsample())
         
     def train(self, dataset=None, initial_epoch=0):
-        callbacks = get_callbacks(self.tb_path, self.model_path_new_train, self.config['lr_dec'], self.config['lr'])
+        callbacks = self.get_callbacks()
         
         if dataset == None:
             dataset = Dataset(self.model_name, self.config_path)          
-        dataset_train, dataset_val = dataset.get_tf_data()   
-
-
-        self.model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=self.config['lr']),
-              loss=[marginLoss, 'mse'],
-              loss_weights=[1., self.config['lmd_gen']],
-              metrics={'Original_CapsNet': 'accuracy'})
+        dataset_train, dataset_val = self.get_tf_data(dataset)
+        steps = int(dataset.y_train.shape[0] / self.config['batch_size']) if self.strategy.num_replicas_in_sync > 1 else None
 
         print('-'*30 + f'{self.model_name} train' + '-'*30)
 
-        history = self.model.fit(dataset_train,
-          epochs=self.config['epochs'],
-          validation_data=(dataset_val), batch_size=self.config['batch_size'], initial_epoch=initial_epoch,
-          callbacks=callbacks)
+        history = self.train_graph(dataset_train, dataset_val, [marginLoss, reconstructionLoss], [1., self.config['lmd_gen']], 'accuracy', steps,
+                                   initial_epoch, callbacks)
         
         return history
@@ -16,10 +16,10 @@
 import numpy as np
 import tensorflow as tf
 from utils.layers_hinton import PrimaryCaps, DigitCaps, Length, Mask
-import tensorflow_addons as tfa
+from utils.layers import DecoderSubsample
 
 
-def capsnet_graph(input_shape, routing):
+def capsnet_graph(input_shape, routing, recompute=False):
     """
     Original CapsNet graph architecture described in "dynamic routinig between capsules".
     
@@ -29,12 +29,14 @@ def capsnet_graph(input_shape, routing):
         network input shape
     routing: int
         number of routing iterations
+    recompute: bool
+        recompute the DigitCaps intermediates in the backward pass instead of keeping them
     """
     inputs = tf.keras.Input(input_shape)
     
     x = tf.keras.layers.Conv2D(256, 9, activation="relu")(inputs)
     primary = PrimaryCaps(C=32, L=8, k=9, s=2)(x)
-    digit_caps = DigitCaps(10, 16, routing=routing)(primary)  
+    digit_caps = DigitCaps(10, 16, routing=routing, recompute=recompute)(primary)  
     digit_caps_len = Length(name='capsnet_output_len')(digit_caps)
     pr_shape = primary.shape
     primary = tf.reshape(primary,(-1,pr_shape[1]*pr_shape[2]*pr_shape[3],pr_shape[-1]))
@@ -61,7 +63,7 @@ def generator_graph(input_shape):
     return tf.keras.Model(inputs=inputs, outputs=x, name='Generator')
 
 
-def build_graph(input_shape, mode, n_routing, verbose):
+def build_graph(input_shape, mode, n_routing, verbose, decoder_fraction=1., decoder_every=1, recompute=False):
     """
     Original CapsNet graph architecture with reconstruction regularizer. The network can be initialize with different modalities.
     
@@ -74,12 +76,18 @@ def build_graph(input_shape, mode, n_routing, verbose):
     n_routing: int
         number of routing iterations
     verbose: bool
+    decoder_fraction: float
+        fraction of the batch reconstructed in training (see DecoderSubsample)
+    decoder_every: int
+        the decoder runs once every decoder_every train steps on average (see DecoderSubsample)
+    recompute: bool
+        recompute the capsule intermediates in the backward pass to bound the training memory (see DigitCaps)
     """
     inputs = tf.keras.Input(input_shape)
     y_true = tf.keras.Input(shape=(10))
     noise = tf.keras.layers.Input(shape=(10, 16))
     
-    capsnet = capsnet_graph(input_shape, routing=n_routing)
+    capsnet = capsnet_graph(input_shape, routing=n_routing, recompute=recompute)
     primary, digit_caps, digit_caps_len = capsnet(inputs)
     noised_digitcaps = tf.keras.layers.Add()([digit_caps, noise]) # only if mode is play
     
@@ -99,7 +107,12 @@ def build_graph(input_shape, mode, n_routing, verbose):
         generator.summary()
         print("\n\n")
 
-    x_gen_train = generator(masked_by_y)
+    # the reconstruction branch of the train graph can be computed on a subset of the batch and of the steps
+    generator_train = generator
+    if decoder_fraction < 1 or decoder_every > 1:
+        generator_train = DecoderSubsample(generator, decoder_fraction, decoder_every, name='Generator_subsample')
+
+    x_gen_train = generator_train(masked_by_y)
     x_gen_eval = generator(masked)
     x_gen_play = generator(masked_noised_y)
       
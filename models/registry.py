@@ -0,0 +1,141 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import gc
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from models.model import EfficientCapsNet, CapsNet
+from utils.tools import process_rss_mb
+
+ARCHITECTURES = {'efficient_capsnet': EfficientCapsNet, 'original_capsnet': CapsNet}
+
+
+class ModelRegistry(object):
+    """
+    Registry of test models built and loaded on first use. The memory of every model is measured when it is loaded
+    (resident memory increase, at least the size of its weights) and the least recently used models are evicted when
+    the loaded ones exceed the memory budget. Loads run one at a time, so that the memory increase measured for a
+    model does not include the one of a model loaded concurrently. Inference calls of all models run on a shared thread pool.
+
+    ...
+
+    Attributes
+    ----------
+    config_path: str
+        path configuration file
+    memory_budget_mb: float
+        memory available for the loaded models. If None, 'registry_memory_mb' of the configuration file (None: no limit)
+    max_workers: int
+        threads of the shared pool
+
+    Methods
+    -------
+    get(model_name, architecture):
+        return the loaded model, building it if needed
+    classify(model_name, X, architecture):
+        submit a classification to the thread pool and return its Future
+    evict(model_name, architecture):
+        unload a model
+    stats():
+        hit/miss/eviction counters and memory of the loaded models
+    close():
+        shut down the thread pool
+    """
+    def __init__(self, config_path='config.json', memory_budget_mb=None, max_workers=None):
+        self.config_path = config_path
+        if memory_budget_mb is None:
+            with open(config_path) as json_data_file:
+                memory_budget_mb = json.load(json_data_file).get('registry_memory_mb')
+        self.memory_budget_mb = memory_budget_mb
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='model_registry')
+        self.models = OrderedDict() # key -> (model, memory_mb), least recently used first
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, model_name, architecture='efficient_capsnet'):
+        key = (architecture, model_name)
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+        with self.load_lock: # a model is loaded once even if requested by several threads
+            with self.lock:
+                if key in self.models:
+                    self.hits += 1
+                    self.models.move_to_end(key)
+                    return self.models[key][0]
+                self.misses += 1
+            model, memory_mb = self.load(architecture, model_name)
+            with self.lock:
+                self.models[key] = (model, memory_mb)
+                self.evict_lru(keep=key)
+        return model
+
+
+    def load(self, architecture, model_name):
+        rss_mb = process_rss_mb()
+        model = ARCHITECTURES[architecture](model_name, mode='test', config_path=self.config_path, verbose=False)
+        model.load_graph_weights()
+        weights_mb = sum(w.numpy().nbytes for w in model.model.weights) / 2**20
+        memory_mb = max(process_rss_mb() - rss_mb, weights_mb)
+        print(f"[INFO] {architecture} {model_name} loaded ({memory_mb:.1f} MB)")
+        return model, memory_mb
+
+
+    def evict_lru(self, keep=None):
+        if self.memory_budget_mb is None:
+            return
+        while sum(m for _, m in self.models.values()) > self.memory_budget_mb:
+            key = next((k for k in self.models if k != keep), None)
+            if key is None: # a single model larger than the budget stays loaded
+                break
+            del self.models[key]
+            self.evictions += 1
+        gc.collect()
+
+
+    def evict(self, model_name, architecture='efficient_capsnet'):
+        with self.lock:
+            if self.models.pop((architecture, model_name), None) is not None:
+                self.evictions += 1
+        gc.collect()
+
+
+    def classify(self, model_name, X, architecture='efficient_capsnet'):
+        return self.executor.submit(lambda: self.get(model_name, architecture).classify(X))
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory_mb': sum(m for _, m in self.models.values()),
+                'memory_budget_mb': self.memory_budget_mb,
+                'models': {f'{a}/{n}': m for (a, n), (_, m) in self.models.items()}
+            }
+
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,89 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Inference backends must match the keras reference (check_parity) and follow the weights of the model: predictions after
+load_graph_weights are compared with keras.
+"""
+
+import json
+import os
+import numpy as np
+import pytest
+from models.model import EfficientCapsNet
+from utils.backends import BACKENDS, KerasBackend, check_parity, get_backend
+from utils.compile_cache import cache_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEIGHTS = os.path.join(ROOT, 'bin', 'efficient_capsnet_SMALLNORB.h5')
+
+
+def make_model(tmp_path, backend):
+    with open(os.path.join(ROOT, 'config.json')) as f:
+        config = json.load(f)
+    config.update(inference_backend=backend, xla_buckets=[8], compile_cache_dir=str(tmp_path / 'compile_cache'),
+                  compile_cache_xla_devices='', compile_cache_cpu=True)
+    config_path = tmp_path / 'config.json'
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    model = EfficientCapsNet('SMALLNORB', mode='test', config_path=str(config_path), custom_path=WEIGHTS)
+    model.load_graph_weights()
+    return model
+
+
+def perturbed_weights(model, path):
+    rng = np.random.RandomState(0)
+    model.model.set_weights([w + 0.1 * rng.randn(*w.shape).astype(w.dtype) for w in model.model.get_weights()])
+    model.model.save_weights(path)
+
+
+@pytest.mark.skipif(not os.path.exists(WEIGHTS), reason='SMALLNORB weights not available')
+@pytest.mark.parametrize('backend', ['tflite', 'xla_buckets'])
+def test_predict_follows_loaded_weights(tmp_path, backend):
+    X = np.random.RandomState(1).randn(8, 48, 48, 2).astype('float32')
+    new_weights = str(tmp_path / 'perturbed.h5')
+    perturbed_weights(make_model(tmp_path, 'keras'), new_weights)
+
+    make_model(tmp_path, backend).predict(X) # cold: the xla_buckets functions are stored in the compile cache
+    model = make_model(tmp_path, backend)
+    model.predict(X) # warm: loaded from the compile cache
+    if backend == 'xla_buckets':
+        assert model.get_backend().loaded is not None
+
+    model.model_path = new_weights
+    model.load_graph_weights()
+    outputs = model.predict(X)
+    reference = model.model.predict(X, verbose=0)
+    for output, expected in zip(outputs, reference):
+        np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+@pytest.fixture(scope='module')
+def random_model():
+    # test graph of MNIST with its random initial weights, no weights file needed
+    return EfficientCapsNet('MNIST', mode='test', config_path=os.path.join(ROOT, 'config.json'), verbose=False)
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_backend_parity(random_model, backend):
+    X = np.random.RandomState(0).rand(20, *random_model.model.input_shape[1:]).astype('float32')
+    config = dict(random_model.config, inference_batch_size=8, xla_buckets=[1, 8], compile_cache_dir=None)
+    check_parity(get_backend(backend, random_model.model, config), KerasBackend(random_model.model, 8, verbose=0), X)
+
+
+def test_cache_key_ignores_non_graph_keys(random_model):
+    config = random_model.config
+    key = cache_key(random_model.model, config, 'xla_buckets')
+    assert cache_key(random_model.model, dict(config, lr=1e-3, compile_cache_mb=1), 'xla_buckets') == key
+    assert cache_key(random_model.model, dict(config, xla_buckets=[4]), 'xla_buckets') != key
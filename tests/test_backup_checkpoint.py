@@ -0,0 +1,154 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Backup and resume of a training with two local MultiWorkerMirroredStrategy workers. The workers run this file with
+TF_CONFIG set: the first run is preempted after the first of 3 epochs, the second one resumes from the shared backup.
+A training preempted in the middle of an epoch must resume from its last step checkpoint without training again on
+the batches before it: its weights are compared with the ones of an uninterrupted training.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Preemption(Exception):
+    pass
+
+
+def worker(backup_dir, output, preempt):
+    import tensorflow as tf
+    from utils.distribute import get_strategy, is_chief
+    from utils.tools import BackupCheckpoint, TemporaryDirectoryCleanup, get_callbacks
+
+    strategy = get_strategy({'distribute_strategy': 'multi_worker'})
+    chief = is_chief(strategy)
+    callbacks = get_callbacks(os.path.join(backup_dir, 'logs'), os.path.join(backup_dir, 'best.h5'), 0.9, 1e-3,
+                              is_chief=chief, backup_dir=os.path.join(backup_dir, 'backup'), backup_async=False,
+                              throughput_freq=0, monitor='val_loss')
+
+    class Preempt(tf.keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            if preempt and epoch == 0:
+                raise Preemption()
+
+    rng = np.random.RandomState(0)
+    X, y = rng.rand(64, 4).astype('float32'), rng.rand(64, 1).astype('float32')
+    dataset = tf.data.Dataset.from_tensor_slices((X, y)).batch(16)
+    with strategy.scope():
+        model = tf.keras.Sequential([tf.keras.layers.Dense(1, input_shape=(4,))])
+        optimizer = tf.keras.optimizers.Adam(1e-3)
+        optimizer.build(model.trainable_variables)
+        initial_epoch = next(c for c in callbacks if isinstance(c, BackupCheckpoint)).restore(model, optimizer)
+        model.compile(optimizer=optimizer, loss='mse')
+    result = {'initial_epoch': initial_epoch, 'best': float(callbacks[1].best), 'kernel': model.get_weights()[0].tolist(),
+              'worker_dirs': [c.path for c in callbacks if isinstance(c, TemporaryDirectoryCleanup)]}
+    try:
+        model.fit(dataset, epochs=3, initial_epoch=initial_epoch, validation_data=dataset, callbacks=callbacks + [Preempt()], verbose=0)
+    except Preemption:
+        result['preempted'] = True
+    with open(output, 'w') as f:
+        json.dump(result, f)
+
+
+def launch(backup_dir, preempt):
+    from utils.distribute import free_port
+    cluster = {'worker': [f'localhost:{free_port()}' for _ in range(2)]}
+    processes, outputs = [], []
+    for index in range(2):
+        outputs.append(os.path.join(backup_dir, f'worker_{index}.json'))
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}),
+                   PYTHONPATH=ROOT, TF_CPP_MIN_LOG_LEVEL='2')
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), backup_dir, outputs[-1], str(int(preempt))],
+                                          env=env, cwd=ROOT))
+    assert [p.wait(timeout=600) for p in processes] == [0, 0]
+    results = []
+    for output in outputs:
+        with open(output) as f:
+            results.append(json.load(f))
+    return results
+
+
+def test_two_workers_resume_from_shared_backup(tmp_path):
+    first = launch(str(tmp_path), preempt=True)
+    assert all(r.get('preempted') for r in first)
+    assert os.listdir(tmp_path / 'backup') # written by the chief only
+
+    second = launch(str(tmp_path), preempt=False)
+    assert [r['initial_epoch'] for r in second] == [1, 1]
+    assert second[0]['kernel'] == second[1]['kernel']
+    assert [r['best'] for r in second] == [second[0]['best']] * 2 and np.isfinite(second[0]['best'])
+    assert not (tmp_path / 'backup').exists() # removed once training ends
+    assert not second[0]['worker_dirs'] and len(second[1]['worker_dirs']) == 1 # non-chief logs and checkpoints
+    assert not os.path.exists(second[1]['worker_dirs'][0])
+
+
+def train_mid_epoch(backup_dir, engine, preempt_at=None):
+    """
+    2 epochs of 6 batches with a backup every 2 steps, preempted after the step preempt_at=(epoch, batch) if given
+    """
+    import tensorflow as tf
+    from utils.engine import TrainEngine
+    from utils.tools import BackupCheckpoint
+
+    class Preempt(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch = epoch
+
+        def on_train_batch_end(self, batch, logs=None):
+            if (self.epoch, batch) == preempt_at:
+                raise Preemption()
+
+    rng = np.random.RandomState(0)
+    X, y = rng.rand(96, 4).astype('float32'), rng.rand(96, 2).astype('float32')
+    dataset = tf.data.Dataset.from_tensor_slices((X, (y, y[:, :1]))).batch(16)
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.Input((4,))
+    model = tf.keras.Model(inputs, [tf.keras.layers.Dense(2)(inputs), tf.keras.layers.Dense(1)(inputs)])
+    optimizer = tf.keras.optimizers.Adam(1e-2)
+    optimizer.build(model.trainable_variables)
+    backup = BackupCheckpoint(backup_dir, async_save=False, save_freq=2)
+    initial_epoch = backup.restore(model, optimizer)
+    dataset, steps = backup.skip_consumed(dataset, None)
+    callbacks = [backup, Preempt()]
+    try:
+        if engine == 'custom':
+            TrainEngine(model, optimizer, ['mse', 'mse'], [1., 1.], 'accuracy').fit(dataset, 2, steps, initial_epoch=initial_epoch,
+                                                                                   callbacks=callbacks, verbose=0)
+        else:
+            model.compile(optimizer=optimizer, loss=['mse', 'mse'])
+            model.fit(dataset, epochs=2, steps_per_epoch=steps, initial_epoch=initial_epoch, callbacks=callbacks, verbose=0)
+    except Preemption:
+        return None
+    return model.get_weights()
+
+
+@pytest.mark.parametrize('engine', ['keras', 'custom'])
+def test_resume_mid_epoch(tmp_path, engine):
+    expected = train_mid_epoch(str(tmp_path / 'uninterrupted'), engine)
+    assert train_mid_epoch(str(tmp_path / 'backup'), engine, preempt_at=(1, 4)) is None # last backup at epoch 1, step 4
+    weights = train_mid_epoch(str(tmp_path / 'backup'), engine)
+    for w, e in zip(weights, expected):
+        np.testing.assert_allclose(w, e, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    worker(sys.argv[1], sys.argv[2], bool(int(sys.argv[3])))
@@ -0,0 +1,77 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+The warmup file of an exported model must be a TFRecord of tensorflow.serving.PredictionLog protos. They are parsed
+with message classes built from the TensorFlow Serving definitions (prediction_log.proto, predict.proto, model.proto),
+so that tensorflow-serving-api is not needed.
+"""
+
+import os
+import numpy as np
+import tensorflow as tf
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from tensorflow.core.framework import tensor_pb2
+from models.model import EfficientCapsNet
+from utils.export import WARMUP_FILE, load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prediction_log_class():
+    # the subset of the TensorFlow Serving messages used by warmup requests, with their field numbers, added to the
+    # default pool where tensorflow.TensorProto is defined
+    pool = descriptor_pool.Default()
+    f = descriptor_pb2.FileDescriptorProto(name='serving_warmup.proto', package='tensorflow.serving',
+                                           dependency=[tensor_pb2.DESCRIPTOR.name], syntax='proto3')
+    Field = descriptor_pb2.FieldDescriptorProto
+    def message(name, fields, nested=()):
+        m = f.message_type.add(name=name)
+        m.nested_type.extend(nested)
+        for field_name, number, type_name, label in fields:
+            field = m.field.add(name=field_name, number=number, label=label)
+            if type_name == 'string':
+                field.type = Field.TYPE_STRING
+            else:
+                field.type, field.type_name = Field.TYPE_MESSAGE, type_name
+        return m
+    optional, repeated = Field.LABEL_OPTIONAL, Field.LABEL_REPEATED
+    message('ModelSpec', [('name', 1, 'string', optional), ('signature_name', 3, 'string', optional)])
+    inputs_entry = descriptor_pb2.DescriptorProto(name='InputsEntry', options=descriptor_pb2.MessageOptions(map_entry=True))
+    inputs_entry.field.add(name='key', number=1, type=Field.TYPE_STRING, label=optional)
+    inputs_entry.field.add(name='value', number=2, type=Field.TYPE_MESSAGE, type_name='.tensorflow.TensorProto', label=optional)
+    message('PredictRequest', [('model_spec', 1, '.tensorflow.serving.ModelSpec', optional),
+                               ('inputs', 2, '.tensorflow.serving.PredictRequest.InputsEntry', repeated)], [inputs_entry])
+    message('PredictLog', [('request', 1, '.tensorflow.serving.PredictRequest', optional)])
+    message('PredictionLog', [('predict_log', 6, '.tensorflow.serving.PredictLog', optional)])
+    pool.Add(f)
+    return message_factory.MessageFactory(pool).GetPrototype(pool.FindMessageTypeByName('tensorflow.serving.PredictionLog'))
+
+
+def test_warmup_requests(tmp_path):
+    model = EfficientCapsNet('MNIST', mode='test', config_path=os.path.join(ROOT, 'config.json'))
+    export_dir = str(tmp_path / 'exported')
+    model.export(export_dir)
+
+    PredictionLog = prediction_log_class()
+    requests = []
+    for record in tf.data.TFRecordDataset(os.path.join(export_dir, WARMUP_FILE)):
+        request = PredictionLog.FromString(record.numpy()).predict_log.request
+        images = tf.make_ndarray(tensor_pb2.TensorProto.FromString(request.inputs['images'].SerializeToString()))
+        requests.append((request.model_spec.signature_name, images.shape))
+    assert requests == [('serving_default', (1, 28, 28, 1)), ('serving_default', (8, 28, 28, 1)),
+                        ('full', (1, 28, 28, 1)), ('full', (8, 28, 28, 1))]
+
+    X = np.random.RandomState(0).rand(4, 28, 28, 1).astype('float32')
+    np.testing.assert_allclose(load(export_dir).classify(X), model.model.predict(X, verbose=0)[0], atol=1e-5)
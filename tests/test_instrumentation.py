@@ -0,0 +1,43 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+The encoder, routing and decoder stages of split_stages, run in sequence, must give the outputs of the test graph, for
+single networks and ensembles (random weights).
+"""
+
+import os
+import numpy as np
+import pytest
+import tensorflow as tf
+from models.model import EfficientCapsNet, EfficientCapsNetEnsemble
+from utils.instrumentation import split_stages
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('n_members', [0, 2])
+def test_stages_match_graph(n_members):
+    config_path = os.path.join(ROOT, 'config.json')
+    if n_members:
+        model = EfficientCapsNetEnsemble('MNIST', mode='test', config_path=config_path, n_members=n_members)
+    else:
+        model = EfficientCapsNet('MNIST', mode='test', config_path=config_path)
+    X = np.random.RandomState(0).rand(4, 28, 28, 1).astype('float32')
+    encoder, routing, decoder = split_stages(model.model, model.get_capsnet())
+    digit_caps, scores = routing(encoder(X))
+    expected = model.model(X)
+    np.testing.assert_allclose(scores, expected[0], atol=1e-6)
+    for reconstruction, reference in zip(tf.nest.flatten(decoder(digit_caps)), expected[1:]):
+        np.testing.assert_allclose(reconstruction, reference, atol=1e-6)
@@ -1,3 +1,28 @@
-from utils.layers import *
-from utils.visualization import AffineVisualizer, plotImages, plotWrongImages, plotHistory
-from utils.dataset import Dataset
+# public names are imported on first access (PEP 562), so importing a utils submodule does not load matplotlib,
+# tensorflow_datasets & co.
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    'SquashHinton': 'utils.layers',
+    'Squash': 'utils.layers',
+    'PrimaryCaps': 'utils.layers',
+    'FCCaps': 'utils.layers',
+    'Length': 'utils.layers',
+    'Mask': 'utils.layers',
+    'DecoderSubsample': 'utils.layers',
+    'AffineVisualizer': 'utils.visualization',
+    'plotImages': 'utils.visualization',
+    'plotWrongImages': 'utils.visualization',
+    'plotHistory': 'utils.visualization',
+    'Dataset': 'utils.dataset',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module 'utils' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
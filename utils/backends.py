@@ -0,0 +1,219 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Inference backends used by Model.predict, selected by 'inference_backend' in the configuration file:
+    keras    keras 'predict' of the network graph
+    xla      compiled tf.function (jit_compile=True), run batch by batch
+    xla_buckets
+             XLA executables compiled for the static batch sizes 'xla_buckets', inputs are padded to the nearest one.
+             Traced functions are stored in the compile cache of utils.compile_cache if 'compile_cache_dir' is set
+             (GPU workers only, unless 'compile_cache_cpu' is set)
+    tflite   TFLite interpreter with 'tflite_threads' threads (TF ops not supported by TFLite run as select TF ops)
+All backends return the list of the graph outputs.
+"""
+
+import numpy as np
+import tensorflow as tf
+from utils.compile_cache import get_compile_cache, cache_key
+
+
+class Backend(object):
+    """
+    Base inference backend. Subclasses implement predict_batch.
+
+    ...
+
+    Attributes
+    ----------
+    model: tf.keras.Model
+        network graph
+    batch_size: int
+        samples per forward pass
+
+    Methods
+    -------
+    predict(X)
+        outputs of the graph for an array, a list of arrays (multi-input graphs) or a tf.data.Dataset
+    """
+    name = None
+
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = batch_size
+
+
+    def predict_batch(self, x):
+        raise NotImplementedError
+
+
+    def batches(self, X):
+        if isinstance(X, tf.data.Dataset):
+            for batch in X:
+                # datasets may yield (x, y) pairs, as the ones of generate_tf_data
+                yield batch[0] if isinstance(batch, tuple) else batch
+        else:
+            n = len(X[0]) if isinstance(X, (list, tuple)) else len(X)
+            for start in range(0, n, self.batch_size):
+                yield tf.nest.map_structure(lambda x: x[start:start+self.batch_size], X)
+
+
+    def predict(self, X):
+        outputs = [self.predict_batch(x) for x in self.batches(X)]
+        return [np.concatenate(output) for output in zip(*outputs)]
+
+
+
+class KerasBackend(Backend):
+    name = 'keras'
+
+    def __init__(self, model, batch_size=32, verbose='auto'):
+        super(KerasBackend, self).__init__(model, batch_size)
+        self.verbose = verbose
+
+
+    def predict(self, X):
+        outputs = self.model.predict(X, batch_size=None if isinstance(X, tf.data.Dataset) else self.batch_size, verbose=self.verbose)
+        return outputs if isinstance(outputs, list) else [outputs]
+
+
+
+class XLABackend(Backend):
+    name = 'xla'
+
+    def __init__(self, model, batch_size=32, jit_compile=True):
+        super(XLABackend, self).__init__(model, batch_size)
+        self.function = tf.function(lambda x: model(x, training=False), jit_compile=jit_compile, reduce_retracing=True)
+
+
+    def predict_batch(self, x):
+        outputs = self.function(tf.nest.map_structure(lambda t: tf.convert_to_tensor(t, dtype=tf.float32), x))
+        return [o.numpy() for o in tf.nest.flatten(outputs)]
+
+
+
+class TFLiteBackend(Backend):
+    name = 'tflite'
+
+    def __init__(self, model, batch_size=32, num_threads=None):
+        super(TFLiteBackend, self).__init__(model, batch_size)
+        if len(model.inputs) != 1:
+            raise ValueError('the TFLite backend supports single-input graphs only (Ex. test mode)')
+        spec = tf.TensorSpec([None] + list(model.input_shape[1:]), tf.float32, name='images')
+        function = tf.function(lambda images: {f'output_{i}': o for i, o in enumerate(tf.nest.flatten(model(images, training=False)))})
+        concrete_function = function.get_concrete_function(spec)
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], model)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        self.interpreter = tf.lite.Interpreter(model_content=converter.convert(), num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.n_outputs = len(tf.nest.flatten(model.outputs))
+
+
+    def predict_batch(self, x):
+        outputs = self.runner(images=np.asarray(x, dtype=np.float32))
+        return [outputs[f'output_{i}'] for i in range(self.n_outputs)]
+
+
+
+class XLABucketBackend(Backend):
+    """
+    XLA inference with static shapes. The graph is compiled once for every batch-size bucket (executables are cached),
+    batches are zero-padded to the smallest bucket that contains them and batches larger than the largest bucket are
+    split. With static shapes XLA fuses the capsule math (Ex. the einsum/softmax/squash chain of FCCaps).
+    With a compile cache (utils.compile_cache.CompileCache) the functions traced for all buckets are loaded from the
+    entry key, or traced and stored there if it does not exist.
+    """
+    name = 'xla_buckets'
+
+    def __init__(self, model, batch_size=32, buckets=(1, 8, 32, 128, 256), cache=None, key=None):
+        super(XLABucketBackend, self).__init__(model, max(buckets))
+        self.buckets = sorted(buckets)
+        self.function = tf.function(lambda x: model(x, training=False), jit_compile=True)
+        self.compiled = {}
+        self.loaded = None
+        if cache is not None:
+            self.load_or_trace(cache, key)
+
+
+    def load_or_trace(self, cache, key):
+        self.loaded = cache.load(key) # keeps the restored variables alive
+        if self.loaded is not None:
+            self.function = self.loaded.function
+            return
+        for bucket in self.buckets:
+            self.get_function(bucket)
+        module = tf.Module()
+        module.function = self.function
+        module.weights = list(self.model.variables)
+        cache.save(key, module)
+
+
+    def get_function(self, bucket):
+        if bucket not in self.compiled:
+            specs = [tf.TensorSpec([bucket] + list(x.shape[1:]), tf.float32) for x in self.model.inputs]
+            self.compiled[bucket] = self.function.get_concrete_function(specs[0] if len(specs) == 1 else specs)
+        return self.compiled[bucket]
+
+
+    def compile(self):
+        """
+        Compile all buckets ahead of the first request
+        """
+        for bucket in self.buckets:
+            self.predict_batch(tf.nest.map_structure(lambda x: np.zeros([bucket] + list(x.shape[1:]), np.float32),
+                                                     self.model.inputs if len(self.model.inputs) > 1 else self.model.inputs[0]))
+
+
+    def predict_batch(self, x):
+        n = len(tf.nest.flatten(x)[0])
+        if n > self.buckets[-1]:
+            outputs = [self.predict_batch(tf.nest.map_structure(lambda t: t[i:i+self.buckets[-1]], x)) for i in range(0, n, self.buckets[-1])]
+            return [np.concatenate(output) for output in zip(*outputs)]
+        bucket = next(b for b in self.buckets if b >= n)
+        pad = lambda t: tf.pad(tf.cast(t, tf.float32), [[0, bucket - n]] + [[0, 0]] * (len(t.shape) - 1))
+        outputs = self.get_function(bucket)(tf.nest.map_structure(pad, x))
+        return [o[:n].numpy() for o in tf.nest.flatten(outputs)]
+
+
+
+BACKENDS = {backend.name: backend for backend in [KerasBackend, XLABackend, XLABucketBackend, TFLiteBackend]}
+
+
+def get_backend(name, model, config):
+    """
+    Create the backend 'name' for model, with the options of the configuration file ('inference_batch_size',
+    'xla_buckets', 'tflite_threads' and the compile cache ones)
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'inference backend {name} not recognized, use one of {list(BACKENDS)}')
+    batch_size = config.get('inference_batch_size', 32)
+    if name == 'tflite':
+        return TFLiteBackend(model, batch_size, config.get('tflite_threads'))
+    if name == 'xla_buckets':
+        buckets = config.get('xla_buckets', (1, 8, 32, 128, 256))
+        cache = get_compile_cache(config)
+        key = cache_key(model, config, (name, sorted(buckets))) if cache is not None else None
+        return XLABucketBackend(model, batch_size, buckets, cache, key)
+    return BACKENDS[name](model, batch_size)
+
+
+def check_parity(backend, reference, X, atol=1e-4):
+    """
+    Maximum absolute difference between the outputs of backend and reference (Ex. KerasBackend) on X. Raise an
+    AssertionError if it exceeds atol.
+    """
+    error = max(np.max(np.abs(a - b)) for a, b in zip(backend.predict(X), reference.predict(X)))
+    if error > atol:
+        raise AssertionError(f'{backend.name} backend differs from {reference.name} by {error:.2e} (atol {atol:.0e})')
+    return error
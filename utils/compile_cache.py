@@ -0,0 +1,181 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+On-disk cache of traced inference functions and XLA executables, enabled by 'compile_cache_dir' in the configuration
+file. Traced functions are stored as SavedModels whose directory name is a hash of the input and output shapes, the
+weights, the configuration keys that change the traced graph (GRAPH_KEYS), the TensorFlow version and the backend, so a
+restarted process loads them instead of tracing the graph again. XLA executables are persisted by TensorFlow itself
+('--tf_xla_persistent_cache_directory') for the device types in 'compile_cache_xla_devices'. The cache is kept below
+'compile_cache_mb' by deleting the least recently used entries.
+
+The cache is meant for GPU workers and is disabled when no GPU is visible, unless 'compile_cache_cpu' is set: on CPU
+loading a warm entry is slower than tracing again, and the persistent XLA cache does not support CPU executables, so
+'CPU' is always dropped from 'compile_cache_xla_devices'.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import tensorflow as tf
+
+# configuration keys that change the graph or the traced functions, besides the '*_INPUT_SHAPE' ones
+GRAPH_KEYS = ('recompute_capsules', 'decoder_fraction', 'decoder_every', 'inference_batch_size', 'xla_buckets')
+
+
+def graph_config(config):
+    return {key: value for key, value in config.items() if key.endswith('_INPUT_SHAPE') or key in GRAPH_KEYS}
+
+
+def cache_key(model, config, tag=''):
+    """
+    Hash of the input and output shapes and of the weights of model (tf.keras.Model), of the graph keys of the
+    configuration (dict, see GRAPH_KEYS), of the TensorFlow version and of tag (Ex. the backend name and its batch
+    sizes). Layer and model names are left out: unnamed graphs get a different one every time they are built in a
+    process. Other configuration keys (Ex. 'lr' or the cache options) do not invalidate the cache.
+    """
+    h = hashlib.sha256()
+    h.update(str([x.shape.as_list() for x in model.inputs + tf.nest.flatten(model.outputs)]).encode())
+    h.update(json.dumps(graph_config(config), sort_keys=True).encode())
+    h.update(tf.__version__.encode())
+    h.update(str(tag).encode())
+    for w in model.get_weights():
+        h.update(str(w.shape).encode())
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()[:16]
+
+
+def enable_xla_cache(cache_dir, device_types='GPU'):
+    """
+    Persist the XLA executables of device_types (comma-separated, Ex. 'GPU' or 'CPU,GPU') in cache_dir. The flag is
+    read by TensorFlow at the first XLA compilation of the process, so it has no effect if one already happened.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_persistent_cache_directory' not in flags:
+        os.environ['TF_XLA_FLAGS'] = (f'{flags} --tf_xla_persistent_cache_directory={cache_dir} '
+                                      f'--tf_xla_persistent_cache_device_types={device_types}').strip()
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+class CompileCache(object):
+    """
+    Size-bounded cache of SavedModels of traced functions, plus the XLA persistent cache in the 'xla' subdirectory.
+
+    ...
+
+    Attributes
+    ----------
+    cache_dir: str
+        cache directory
+    max_mb: float
+        size budget of cache_dir, least recently used entries are deleted above it
+    xla_devices: str
+        device types whose XLA executables are persisted (None disables the XLA cache)
+
+    Methods
+    -------
+    load(key)
+        loaded SavedModel of the entry key, or None
+    save(key, module)
+        store module (tf.Module with traced tf.functions and the variables they use) as the entry key
+    evict(keep=None)
+        delete least recently used entries until the cache fits max_mb
+    """
+    def __init__(self, cache_dir, max_mb=1024, xla_devices='GPU'):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        self.xla_devices = xla_devices
+        os.makedirs(cache_dir, exist_ok=True)
+        if xla_devices:
+            enable_xla_cache(os.path.join(cache_dir, 'xla'), xla_devices)
+
+
+    def load(self, key):
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            loaded = tf.saved_model.load(path)
+        except (OSError, ValueError, tf.errors.OpError) as e:
+            print(f"[WARNING] Compile cache entry {path} could not be loaded ({e}), it will be rebuilt")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        os.utime(path) # last access time used for eviction
+        print(f"[INFO] Traced functions loaded from {path}")
+        return loaded
+
+
+    def save(self, key, module):
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        tf.saved_model.save(module, tmp_path)
+        try:
+            os.replace(tmp_path, path) # an entry is visible only when complete
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"[INFO] Traced functions cached in {path}")
+        self.evict(keep=key)
+
+
+    def entries(self):
+        """
+        (last access time, size in bytes, path) of every entry, XLA executables included
+        """
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if '.tmp' not in name and name != 'xla']
+        xla_dir = os.path.join(self.cache_dir, 'xla')
+        if os.path.isdir(xla_dir):
+            paths += [os.path.join(xla_dir, name) for name in os.listdir(xla_dir)]
+        return [(os.path.getmtime(path), directory_size(path), path) for path in paths]
+
+
+    def evict(self, keep=None):
+        if self.max_mb is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_mb * 2**20:
+                break
+            if keep is not None and os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+            total -= size
+            print(f"[INFO] Compile cache entry {path} evicted")
+
+
+def get_compile_cache(config):
+    """
+    CompileCache of the configuration file ('compile_cache_dir', 'compile_cache_mb', 'compile_cache_xla_devices'), or
+    None if 'compile_cache_dir' is not set, or if no GPU is visible and 'compile_cache_cpu' is not set
+    """
+    if not config.get('compile_cache_dir'):
+        return None
+    if not tf.config.list_physical_devices('GPU') and not config.get('compile_cache_cpu', False):
+        print("[INFO] Compile cache disabled: no GPU visible (set compile_cache_cpu to use it on CPU)")
+        return None
+    devices = [d for d in (config.get('compile_cache_xla_devices') or '').split(',') if d.strip()]
+    if any(d.strip().upper() == 'CPU' for d in devices):
+        print("[WARNING] The persistent XLA cache does not support CPU executables, CPU removed from compile_cache_xla_devices")
+        devices = [d for d in devices if d.strip().upper() != 'CPU']
+    return CompileCache(config['compile_cache_dir'], config.get('compile_cache_mb', 1024), ','.join(devices) or None)
@@ -0,0 +1,105 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+CPU threading and affinity of the process, defined in the configuration file:
+    intra_op_threads    threads of a single op (Ex. a matmul), null for TensorFlow's default (all schedulable cores)
+    inter_op_threads    ops run in parallel, null for TensorFlow's default
+    data_threads        size of the private threadpool of the tf.data pipelines, null to share TensorFlow's pool
+    cpu_affinity        cores the process is pinned to: null, a list of core ids, a string as "0-7,16-23" or "auto"
+                        (the schedulable cores split evenly among the workers of TF_CONFIG, contiguous blocks so that
+                        a worker stays on one socket when workers are as many as sockets)
+Thread pools and affinity must be set before TensorFlow executes its first op, which is why Model applies them in its
+constructor.
+"""
+
+import json
+import os
+import tensorflow as tf
+
+THREADING_KEYS = ['intra_op_threads', 'inter_op_threads', 'data_threads', 'cpu_affinity']
+
+
+def parse_cpus(spec):
+    """
+    List of core ids of a list or of a string as "0-7,16-23"
+    """
+    if isinstance(spec, (list, tuple)):
+        return sorted(int(c) for c in spec)
+    cpus = []
+    for part in str(spec).split(','):
+        start, _, end = part.strip().partition('-')
+        cpus += range(int(start), int(end or start) + 1)
+    return sorted(cpus)
+
+
+def worker_cpus(cpus, tf_config=None):
+    """
+    Contiguous block of cpus of the current worker of tf_config (TF_CONFIG environment variable by default). All cpus if
+    the process is not part of a cluster.
+    """
+    tf_config = json.loads(tf_config or os.environ.get('TF_CONFIG', '{}'))
+    cluster, task = tf_config.get('cluster', {}), tf_config.get('task', {})
+    tasks = [(task_type, i) for task_type in sorted(cluster) for i in range(len(cluster[task_type]))]
+    if (task.get('type'), task.get('index')) not in tasks:
+        return cpus
+    n, index = len(tasks), tasks.index((task['type'], task['index']))
+    block = max(1, len(cpus) // n)
+    return cpus[index*block:(index+1)*block] or cpus
+
+
+def set_affinity(spec):
+    """
+    Pin the calling thread to the cores of spec (see cpu_affinity) and return them. Threads inherit the affinity of the
+    thread that creates them, so TensorFlow's pools must not exist yet.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        print("[WARNING] CPU affinity is not supported on this platform")
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    cpus = worker_cpus(cpus) if spec == 'auto' else parse_cpus(spec)
+    os.sched_setaffinity(0, cpus)
+    return cpus
+
+
+def configure_threads(config):
+    """
+    Apply 'cpu_affinity', 'intra_op_threads' and 'inter_op_threads' of the configuration file to the process. Settings
+    that cannot be changed anymore (the TensorFlow runtime is already initialized) are reported and skipped.
+    """
+    if config.get('cpu_affinity') is not None:
+        set_affinity(config['cpu_affinity'])
+    for key, current, setter in [('intra_op_threads', tf.config.threading.get_intra_op_parallelism_threads,
+                                  tf.config.threading.set_intra_op_parallelism_threads),
+                                 ('inter_op_threads', tf.config.threading.get_inter_op_parallelism_threads,
+                                  tf.config.threading.set_inter_op_parallelism_threads)]:
+        if config.get(key) is None or current() == config[key]:
+            continue
+        try:
+            setter(config[key])
+        except RuntimeError:
+            print(f"[WARNING] {key} = {config[key]} ignored, the TensorFlow runtime is already initialized "
+                  f"(running with {current() or 'default'})")
+
+
+def data_options(config):
+    """
+    tf.data.Options with the private threadpool of 'data_threads', so the input pipeline does not compete with the
+    compute ops for TensorFlow's threads
+    """
+    options = tf.data.Options()
+    if config.get('data_threads') is not None:
+        options.threading.private_threadpool_size = config['data_threads']
+        options.threading.max_intra_op_parallelism = 1
+    return options
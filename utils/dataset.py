@@ -15,10 +15,10 @@
 
 import numpy as np
 import tensorflow as tf
-import tensorflow_datasets as tfds
-import matplotlib.pyplot as plt
 import os
 from utils import pre_process_mnist, pre_process_multimnist, pre_process_smallnorb
+from utils.distribute import shard
+from utils.cpu_config import configure_threads, data_options
 import json
 
 
@@ -41,8 +41,8 @@ class Dataset(object):
         load configuration file
     get_dataset():
         load the dataset defined by model_name and pre_process it
-    get_tf_data():
-        get a tf.data.Dataset object of the loaded dataset. 
+    get_tf_data(input_context):
+        get a tf.data.Dataset object of the loaded dataset (or of its shard). 
     """
     def __init__(self, model_name, config_path='config.json'):
         self.model_name = model_name
@@ -55,6 +55,7 @@ class Dataset(object):
         self.class_names = None
         self.X_test_patch = None
         self.load_config()
+        configure_threads(self.config) # pre-processing runs TensorFlow ops
         self.get_dataset()
         
 
@@ -75,7 +76,8 @@ class Dataset(object):
             self.class_names = list(range(10))
             print("[INFO] Dataset loaded!")
         elif self.model_name == 'SMALLNORB':
-                    # import the datatset
+            import tensorflow_datasets as tfds # only needed by smallNORB
+            # import the datatset
             (ds_train, ds_test), ds_info = tfds.load(
                 'smallnorb',
                 split=['train', 'test'],
@@ -103,12 +105,24 @@ class Dataset(object):
             print("[INFO] Dataset loaded!")
 
 
-    def get_tf_data(self):
+    def get_tf_data(self, input_context=None):
+        """
+        Build the train and test pipelines. If input_context (tf.distribute.InputContext) is given, the pipelines read
+        only the shard of the input pipeline id.
+        """
+        parallel_calls = self.config.get('input_parallel_calls', 16) # -1 for AUTOTUNE
         if self.model_name == 'MNIST':
-            dataset_train, dataset_test = pre_process_mnist.generate_tf_data(self.X_train, self.y_train, self.X_test, self.y_test, self.config['batch_size'])
+            dataset_train, dataset_test = pre_process_mnist.generate_tf_data(shard(self.X_train, input_context), shard(self.y_train, input_context),
+                                                                            shard(self.X_test, input_context), shard(self.y_test, input_context), self.config['batch_size'],
+                                                                            parallel_calls)
         elif self.model_name == 'SMALLNORB':
-            dataset_train, dataset_test = pre_process_smallnorb.generate_tf_data(self.X_train, self.y_train, self.X_test_patch, self.y_test, self.config['batch_size'])
+            dataset_train, dataset_test = pre_process_smallnorb.generate_tf_data(shard(self.X_train, input_context), shard(self.y_train, input_context),
+                                                                                shard(self.X_test_patch, input_context), shard(self.y_test, input_context), self.config['batch_size'],
+                                                                                parallel_calls)
         elif self.model_name == 'MULTIMNIST':
-            dataset_train, dataset_test = pre_process_multimnist.generate_tf_data(self.X_train, self.y_train, self.X_test, self.y_test, self.config['batch_size'], self.config["shift_multimnist"])
+            # training samples are synthesized at random, so every pipeline uses the whole training set
+            dataset_train, dataset_test = pre_process_multimnist.generate_tf_data(self.X_train, self.y_train, shard(self.X_test, input_context),
+                                                                                  shard(self.y_test, input_context), self.config['batch_size'], self.config["shift_multimnist"])
 
-        return dataset_train, dataset_test
+        options = data_options(self.config)
+        return dataset_train.with_options(options), dataset_test.with_options(options)
@@ -0,0 +1,125 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Data-parallel training helpers. Workers are described by the TF_CONFIG environment variable, so the same training code
+runs single-process or as one of several workers.
+
+Launch N local workers (Ex. for testing on a single Linux box):
+    python -m utils.distribute --workers 2 --model MNIST [--config config.json] [--epochs 1]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tensorflow as tf
+
+
+def get_strategy(config):
+    """
+    Create the tf.distribute strategy defined by 'distribute_strategy' in the configuration file: 'auto' (multi-worker if
+    TF_CONFIG is set, otherwise single process), 'multi_worker', 'mirrored' (all local devices) or 'none'.
+    """
+    name = config.get('distribute_strategy', 'auto')
+    if name == 'auto':
+        name = 'multi_worker' if 'TF_CONFIG' in os.environ else 'none'
+
+    if name == 'multi_worker':
+        communication = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+        return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+    elif name == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    elif name == 'none':
+        return tf.distribute.get_strategy()
+    else:
+        raise ValueError(f'distribute strategy {name} not recognized')
+
+
+def task_info(strategy):
+    """
+    Return (task_type, task_id) of the current worker. (None, 0) for single process strategies.
+    """
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.task_type:
+        return None, 0
+    return resolver.task_type, resolver.task_id
+
+
+def is_chief(strategy):
+    """
+    True if the current worker is in charge of checkpoints and logs ('chief' or worker 0 when there is no chief)
+    """
+    task_type, task_id = task_info(strategy)
+    if task_type is None or task_type == 'chief':
+        return True
+    cluster_spec = strategy.cluster_resolver.cluster_spec().as_dict()
+    return task_type == 'worker' and task_id == 0 and 'chief' not in cluster_spec
+
+
+def shard(x, input_context):
+    """
+    Return the shard of x (array or tensor) read by the input pipeline of input_context
+    """
+    if input_context is None or input_context.num_input_pipelines == 1:
+        return x
+    return x[input_context.input_pipeline_id::input_context.num_input_pipelines]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def launch_local_workers(n_workers, args):
+    """
+    Spawn n_workers local processes running 'python -m utils.distribute --worker args' with a TF_CONFIG cluster on
+    localhost. Return the exit codes.
+    """
+    cluster = {'worker': [f'localhost:{free_port()}' for _ in range(n_workers)]}
+    processes = []
+    for index in range(n_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}))
+        processes.append(subprocess.Popen([sys.executable, '-m', 'utils.distribute', '--worker'] + args, env=env))
+    return [p.wait() for p in processes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2, help='number of local workers to launch')
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--epochs', type=int, default=None, help='override the configured number of epochs')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.worker:
+        worker_args = ['--model', args.model, '--config', args.config]
+        if args.epochs is not None:
+            worker_args += ['--epochs', str(args.epochs)]
+        sys.exit(max(launch_local_workers(args.workers, worker_args)))
+
+    from models.model import EfficientCapsNet # the strategy is created before any other TF operation
+    model = EfficientCapsNet(args.model, mode='train', config_path=args.config, verbose=False)
+    if args.epochs is not None:
+        model.config['epochs'] = args.epochs
+    model.train()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import tensorflow as tf
+from utils.tools import PeakMemory
+
+
+class TrainEngine(object):
+    """
+    Custom training loop used as an alternative to keras 'fit'. Several train steps are fused in a single tf.function call
+    and each step can be compiled with XLA. Losses and metric are the same passed to keras 'compile', while history and
+    checkpoints are produced by the standard keras callbacks (Ex. the ones returned by 'get_callbacks'). The engine
+    runs on the tf.distribute strategy in scope when it is created.
+
+    ...
+
+    Attributes
+    ----------
+    model: tf.keras.Model
+        network to train
+    optimizer: tf.keras.optimizers.Optimizer
+        optimizer used to apply the gradients
+    loss: list
+        loss of each model output (function or keras identifier, Ex. 'mse')
+    loss_weights: list
+        weight of each output loss
+    metric: str or function
+        metric computed on the metric_outputs ('accuracy' or a function like multiAccuracy)
+    steps_per_execution: int
+        number of train steps run by a single tf.function call
+    jit_compile: bool
+        compile train and test steps with XLA
+    accum_steps: int
+        number of micro-batches whose gradients are averaged before every optimizer update
+    metric_outputs: list
+        indices of the model outputs the metric is computed on (default: the first one)
+
+    Methods
+    -------
+    fit(dataset_train, epochs, steps_per_epoch, validation_data, initial_epoch, callbacks, verbose)
+        train the model and return its keras History
+    evaluate(dataset)
+        compute losses and metric over a finite dataset
+    """
+    def __init__(self, model, optimizer, loss, loss_weights, metric, steps_per_execution=1, jit_compile=False, accum_steps=1,
+                 metric_outputs=(0,)):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss = [tf.keras.losses.get(l) for l in loss]
+        self.loss_weights = loss_weights
+        if metric == 'accuracy':
+            self.metric_name, self.metric_fn = 'accuracy', tf.keras.metrics.categorical_accuracy
+        else:
+            self.metric_name, self.metric_fn = metric.__name__, metric
+        self.steps_per_execution = steps_per_execution
+        self.jit_compile = jit_compile
+        self.accum_steps = accum_steps
+        self.metric_outputs = list(metric_outputs)
+        self.strategy = tf.distribute.get_strategy()
+
+        # keras callbacks (Ex. LearningRateScheduler) access the optimizer through the model
+        self.model.optimizer = self.optimizer
+
+        # same log names produced by keras 'fit'
+        output_names = self.model.output_names
+        self.log_names = (['loss'] + [f'{name}_loss' for name in output_names]
+                          + [f'{output_names[i]}_{self.metric_name}' for i in self.metric_outputs])
+        self.train_trackers = [tf.keras.metrics.Mean(name) for name in self.log_names]
+        self.test_trackers = [tf.keras.metrics.Mean(f'val_{name}') for name in self.log_names]
+
+        if self.accum_steps > 1:
+            # replica-local accumulators, summed across replicas by apply_gradients
+            self.accum_grads = [tf.Variable(tf.zeros_like(v), trainable=False,
+                                            synchronization=tf.VariableSynchronization.ON_READ,
+                                            aggregation=tf.VariableAggregation.SUM) for v in self.model.trainable_variables]
+        self._gradient_step = tf.function(self.gradient_step, jit_compile=jit_compile)
+        self._test_step = tf.function(self.test_step, jit_compile=jit_compile)
+        self._train_function = tf.function(self.train_function)
+        self._test_function = tf.function(self.test_function)
+
+
+    @staticmethod
+    def safe_mean(x):
+        # 0 for empty tensors (Ex. decoder outputs skipped by DecoderSubsample), as keras losses reduction
+        return tf.math.divide_no_nan(tf.reduce_sum(x), tf.cast(tf.size(x), x.dtype))
+
+
+    def compute_losses(self, y, y_pred):
+        losses = [self.safe_mean(fn(y_true, y_hat)) for fn, y_true, y_hat in zip(self.loss, y, y_pred)]
+        total = tf.add_n([w * l for w, l in zip(self.loss_weights, losses)])
+        if self.model.losses:
+            total += tf.add_n(self.model.losses)
+        return [total] + losses
+
+
+    def compute_metrics(self, y, y_pred):
+        return [tf.reduce_mean(tf.cast(self.metric_fn(y[i], y_pred[i]), tf.float32)) for i in self.metric_outputs]
+
+
+    def update_trackers(self, trackers, values, y):
+        batch_size = tf.shape(y[0])[0]
+        for tracker, value in zip(trackers, values):
+            tracker.update_state(value, sample_weight=batch_size)
+
+
+    def gradient_step(self, x, y):
+        with tf.GradientTape() as tape:
+            y_pred = self.model(x, training=True)
+            losses = self.compute_losses(y, y_pred)
+            scaled_loss = losses[0] / self.strategy.num_replicas_in_sync # gradients are summed across replicas
+        grads = tape.gradient(scaled_loss, self.model.trainable_variables)
+        self.update_trackers(self.train_trackers, losses + self.compute_metrics(y, y_pred), y)
+        return grads
+
+
+    def train_step(self, x, y):
+        grads = self._gradient_step(x, y)
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+
+
+    def accumulate_step(self, x, y):
+        grads = self._gradient_step(x, y)
+        for accum_grad, grad in zip(self.accum_grads, grads):
+            accum_grad.assign_add(grad / self.accum_steps)
+
+
+    def apply_step(self):
+        self.optimizer.apply_gradients(zip([tf.convert_to_tensor(g) for g in self.accum_grads], self.model.trainable_variables))
+        for accum_grad in self.accum_grads:
+            accum_grad.assign(tf.zeros_like(accum_grad))
+
+
+    def test_step(self, x, y):
+        y_pred = self.model(x, training=False)
+        losses = self.compute_losses(y, y_pred)
+        self.update_trackers(self.test_trackers, losses + self.compute_metrics(y, y_pred), y)
+
+
+    def train_function(self, iterator, steps):
+        for _ in tf.range(steps):
+            if self.accum_steps > 1:
+                for _ in tf.range(self.accum_steps):
+                    x, y = next(iterator)
+                    self.strategy.run(self.accumulate_step, args=(x, y))
+                self.strategy.run(self.apply_step)
+            else:
+                x, y = next(iterator)
+                self.strategy.run(self.train_step, args=(x, y))
+
+
+    def test_function(self, x, y):
+        self.strategy.run(self._test_step, args=(x, y))
+
+
+    def get_logs(self, trackers):
+        return {name: float(tracker.result()) for name, tracker in zip(self.log_names, trackers)}
+
+
+    def evaluate(self, dataset):
+        """
+        Compute losses and metric over a finite dataset
+
+        Parameters
+        ----------
+        dataset: tf.data.Dataset or tf.distribute.DistributedDataset
+            dataset that yields (x, y) batches
+        """
+        for tracker in self.test_trackers:
+            tracker.reset_state()
+        if isinstance(dataset, tf.data.Dataset):
+            dataset = self.strategy.experimental_distribute_dataset(dataset)
+        for x, y in dataset:
+            self._test_function(x, y)
+        return self.get_logs(self.test_trackers)
+
+
+    def fit(self, dataset_train, epochs, steps_per_epoch=None, validation_data=None, initial_epoch=0, callbacks=None, verbose=1):
+        """
+        Train the model with the same semantic of keras 'fit'
+
+        Parameters
+        ----------
+        dataset_train: tf.data.Dataset or tf.distribute.DistributedDataset
+            training dataset that yields (x, y) batches
+        epochs: int
+            index of the last epoch
+        steps_per_epoch: int
+            number of optimizer updates per epoch. If None, the dataset is fully iterated every epoch (a trailing group of
+            less than accum_steps micro-batches is skipped)
+        validation_data: tf.data.Dataset
+            dataset evaluated at the end of every epoch
+        initial_epoch: int
+            epoch at which to start training
+        callbacks: list
+            keras callbacks
+        verbose: int
+            show the keras progress bar
+        """
+        steps_per_epoch_given = steps_per_epoch is not None
+        if not steps_per_epoch_given:
+            steps_per_epoch = int(dataset_train.cardinality())
+            if steps_per_epoch < 0:
+                raise ValueError('steps_per_epoch must be provided for datasets with infinite or unknown cardinality')
+            steps_per_epoch //= self.accum_steps
+        if isinstance(dataset_train, tf.data.Dataset):
+            dataset_train = self.strategy.experimental_distribute_dataset(dataset_train)
+        iterator = iter(dataset_train) if steps_per_epoch_given else None
+
+        callbacks = tf.keras.callbacks.CallbackList(callbacks, add_history=True, add_progbar=verbose != 0,
+                                                    model=self.model, verbose=verbose, epochs=epochs, steps=steps_per_epoch)
+        self.model.stop_training = False
+        logs = {}
+        callbacks.on_train_begin()
+        # a callback may resume the first epoch from a step, as in keras 'fit' (Ex. utils.tools.BackupCheckpoint)
+        initial_epoch, initial_step = self.model._maybe_load_initial_counters_from_ckpt(steps_per_epoch, initial_epoch)
+        for epoch in range(initial_epoch, epochs):
+            for tracker in self.train_trackers:
+                tracker.reset_state()
+            epoch_iterator = iterator if iterator is not None else iter(dataset_train)
+            callbacks.on_epoch_begin(epoch)
+            step, initial_step = initial_step, 0
+            while step < steps_per_epoch:
+                n_steps = min(self.steps_per_execution, steps_per_epoch - step)
+                callbacks.on_train_batch_begin(step)
+                self._train_function(epoch_iterator, tf.constant(n_steps))
+                step += n_steps
+                logs = self.get_logs(self.train_trackers)
+                callbacks.on_train_batch_end(step - 1, logs)
+                if self.model.stop_training:
+                    break
+            if validation_data is not None:
+                logs.update({f'val_{name}': value for name, value in self.evaluate(validation_data).items()})
+            callbacks.on_epoch_end(epoch, logs)
+            if self.model.stop_training:
+                break
+        callbacks.on_train_end(logs)
+
+        return self.model.history
+
+
+
+def find_micro_batch_size(model, loss, loss_weights, dataset, memory_budget_mb, max_batch_size):
+    """
+    Search the largest micro-batch size (power of two, at most max_batch_size) whose train step fits memory_budget_mb.
+    The footprint of every candidate is measured running a forward and backward pass on a batch tiled from the first
+    element of dataset. Model weights are restored after the search.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        network to train
+    loss: list
+        loss of each model output
+    loss_weights: list
+        weight of each output loss
+    dataset: tf.data.Dataset
+        training dataset that yields (x, y) batches
+    memory_budget_mb: float
+        memory available for a train step in MB
+    max_batch_size: int
+        upper bound of the search (Ex. the effective batch size)
+    """
+    loss = [tf.keras.losses.get(l) for l in loss]
+    x, y = next(iter(dataset))
+
+    @tf.function(reduce_retracing=True)
+    def gradient_step(x, y):
+        with tf.GradientTape() as tape:
+            y_pred = model(x, training=True)
+            total = tf.add_n([w * TrainEngine.safe_mean(fn(y_true, y_hat)) for fn, w, y_true, y_hat in zip(loss, loss_weights, y, y_pred)])
+        return tape.gradient(total, model.trainable_variables)
+
+    weights = model.get_weights()
+    baseline = PeakMemory().current_mb() # allocators keep freed memory, so candidates are measured from the search start
+    best = None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        tile = lambda t: tf.repeat(t[:1], batch_size, axis=0)
+        x_tiled, y_tiled = tf.nest.map_structure(tile, x), tf.nest.map_structure(tile, y)
+        try:
+            with PeakMemory(baseline_mb=baseline) as memory:
+                gradient_step(x_tiled, y_tiled)
+        except tf.errors.ResourceExhaustedError:
+            break
+        print(f"[INFO] micro-batch {batch_size}: {memory.peak_mb:.0f} MB")
+        if memory.peak_mb > memory_budget_mb:
+            break
+        best = batch_size
+        batch_size *= 2
+    model.set_weights(weights)
+
+    if best is None:
+        raise RuntimeError(f'No micro-batch fits the memory budget of {memory_budget_mb} MB')
+    return best
@@ -0,0 +1,218 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+SavedModel export of a test model and matching loader. The SavedModel has two signatures with a fixed input spec
+[None] + input_shape ('images'):
+    serving_default   classification only: {'scores': digit capsules lengths, 'digit_caps': digit capsules}
+    full              test graph: {'scores', 'reconstruction'} ('reconstruction_1', 'reconstruction_2' for MULTIMNIST)
+Warmup requests are bundled in assets.extra/tf_serving_warmup_requests, the TensorFlow Serving warmup file: a TFRecord
+of PredictionLog protos with a PredictRequest of both signatures, at batch size 1 and n_warmup. TensorFlow Serving runs
+them before serving the model, and the loader of this module does the same without the graph-building code (models
+package). The protos are encoded here, so that tensorflow-serving-api is not needed.
+
+Export: python -m utils.export --model MNIST --export-dir exported/efficient_capsnet_MNIST [--original] [--custom-path w.h5]
+"""
+
+import argparse
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import tensor_pb2
+
+WARMUP_FILE = os.path.join('assets.extra', 'tf_serving_warmup_requests')
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7f, value >> 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def _field(number, payload):
+    # length-delimited protobuf field (messages, strings and bytes)
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _fields(data):
+    """
+    (field number, payload) of the length-delimited fields of a serialized protobuf message, other fields are skipped
+    """
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            yield number, data[pos:pos+length]
+            pos += length
+        elif wire_type == 0:
+            _, pos = _read_varint(data, pos)
+        else:
+            pos += {1: 8, 5: 4}[wire_type]
+
+
+def _read_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos, shift = pos + 1, shift + 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def warmup_record(images, signature_name):
+    """
+    Serialized tensorflow.serving.PredictionLog with the PredictRequest of images ('images' input) to signature_name:
+    PredictionLog.predict_log (6) > PredictLog.request (1) > PredictRequest.model_spec (1) > ModelSpec.signature_name (3)
+    and PredictRequest.inputs (2, map<string, TensorProto>)
+    """
+    model_spec = _field(3, signature_name.encode())
+    inputs = _field(1, b'images') + _field(2, tf.make_tensor_proto(images).SerializeToString())
+    request = _field(1, model_spec) + _field(2, inputs)
+    return _field(6, _field(1, request))
+
+
+def parse_warmup_record(record):
+    """
+    (signature name, images) of a PredictionLog written by warmup_record
+    """
+    request = dict(_fields(dict(_fields(dict(_fields(record))[6]))[1]))
+    signature_name = dict(_fields(request[1])).get(3, b'serving_default').decode()
+    inputs = dict(_fields(request[2]))
+    return signature_name, tf.make_ndarray(tensor_pb2.TensorProto.FromString(inputs[2]))
+
+
+def export_model(model, capsnet, input_shape, export_dir, n_warmup=8):
+    """
+    Write the SavedModel of a test graph
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        test graph (images -> [digit_caps_len, reconstruction(s)])
+    capsnet: tf.keras.Model
+        capsule network of model, whose last two outputs are digit_caps and digit_caps_len
+    input_shape: list
+        input shape without batch dimension
+    export_dir: str
+        SavedModel directory
+    n_warmup: int
+        batch size of the largest bundled warmup request
+    """
+    spec = tf.TensorSpec([None] + list(input_shape), tf.float32, name='images')
+
+    @tf.function(input_signature=[spec])
+    def classify(images):
+        digit_caps, digit_caps_len = capsnet(images, training=False)[-2:]
+        return {'scores': digit_caps_len, 'digit_caps': digit_caps}
+
+    @tf.function(input_signature=[spec])
+    def full(images):
+        outputs = model(images, training=False)
+        reconstructions = outputs[1:]
+        if len(reconstructions) == 1:
+            return {'scores': outputs[0], 'reconstruction': reconstructions[0]}
+        return dict({'scores': outputs[0]}, **{f'reconstruction_{i+1}': x for i, x in enumerate(reconstructions)})
+
+    module = tf.Module()
+    module.model = model
+    module.classify = classify
+    module.full = full
+    tf.saved_model.save(module, export_dir, signatures={'serving_default': classify, 'full': full})
+
+    os.makedirs(os.path.join(export_dir, 'assets.extra'), exist_ok=True)
+    with tf.io.TFRecordWriter(os.path.join(export_dir, WARMUP_FILE)) as writer:
+        for signature_name in ('serving_default', 'full'):
+            for batch_size in sorted({1, n_warmup}):
+                writer.write(warmup_record(np.zeros([batch_size] + list(input_shape), np.float32), signature_name))
+
+
+
+class ExportedModel(object):
+    """
+    Model loaded from a SavedModel written by export_model.
+
+    ...
+
+    Attributes
+    ----------
+    export_dir: str
+        SavedModel directory
+    warmup: bool
+        run the bundled warmup requests when loading, as TensorFlow Serving does
+
+    Methods
+    -------
+    classify(X, return_vectors)
+        class scores (digit capsules lengths) of X and optionally the digit capsules
+    predict(X)
+        outputs of the full test graph (scores and reconstructions)
+    """
+    def __init__(self, export_dir, warmup=True):
+        self.export_dir = export_dir
+        self.saved_model = tf.saved_model.load(export_dir)
+        self.classify_function = self.saved_model.signatures['serving_default']
+        self.full_function = self.saved_model.signatures['full']
+        self.input_shape = self.classify_function.structured_input_signature[1]['images'].shape[1:]
+        warmup_path = os.path.join(export_dir, WARMUP_FILE)
+        if warmup and os.path.exists(warmup_path):
+            for record in tf.data.TFRecordDataset(warmup_path):
+                signature_name, X = parse_warmup_record(record.numpy())
+                self.saved_model.signatures[signature_name](images=tf.convert_to_tensor(X))
+
+
+    def classify(self, X, return_vectors=False):
+        outputs = self.classify_function(images=tf.convert_to_tensor(X, dtype=tf.float32))
+        if return_vectors:
+            return outputs['scores'].numpy(), outputs['digit_caps'].numpy()
+        return outputs['scores'].numpy()
+
+
+    def predict(self, X):
+        outputs = self.full_function(images=tf.convert_to_tensor(X, dtype=tf.float32))
+        return {name: value.numpy() for name, value in outputs.items()}
+
+
+
+def load(export_dir, warmup=True):
+    """
+    Load a SavedModel written by export_model (Ex. Model.export)
+    """
+    return ExportedModel(export_dir, warmup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--original', action='store_true', help='export the original CapsNet (MNIST only)')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--custom-path', default=None, help='custom weights path')
+    parser.add_argument('--export-dir', required=True)
+    args = parser.parse_args()
+
+    from models.model import EfficientCapsNet, CapsNet
+    model_class = CapsNet if args.original else EfficientCapsNet
+    model = model_class(args.model, mode='test', config_path=args.config, custom_path=args.custom_path, verbose=False)
+    model.load_graph_weights()
+    model.export(args.export_dir)
+    print(f"[INFO] SavedModel written to {args.export_dir}")
+
+
+if __name__ == '__main__':
+    main()
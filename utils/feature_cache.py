@@ -0,0 +1,144 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Cache of the primary capsules computed by a frozen Efficient-CapsNet stem (convolutions + PrimaryCaps). Features are
+stored as memory-mapped .npy files whose name contains a hash of the stem weights, of the preprocessing configuration and
+of the images, so that a cache entry is recomputed as soon as any of them changes.
+"""
+
+import hashlib
+import glob
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from utils.layers import PrimaryCaps, FCCaps, Length, Mask
+
+# configuration keys that change the images fed to the stem
+PREPROCESSING_KEYS = {
+    'MNIST': ['MNIST_INPUT_SHAPE', 'mnist_path'],
+    'SMALLNORB': ['SMALLNORB_INPUT_SHAPE', 'scale_smallnorb', 'patch_smallnorb'],
+}
+
+
+def split_capsnet(capsnet):
+    """
+    Split an Efficient-CapsNet graph (the 'Efficient_CapsNet' model) in the stem, from the input to PrimaryCaps, and the
+    head, from the primary capsules to [digit_caps, digit_caps_len]. Both share the layers of capsnet.
+    """
+    primary_caps = next(layer for layer in capsnet.layers if isinstance(layer, PrimaryCaps))
+    fc_caps = next(layer for layer in capsnet.layers if isinstance(layer, FCCaps))
+    length = next(layer for layer in capsnet.layers if isinstance(layer, Length))
+
+    stem = tf.keras.Model(inputs=capsnet.input, outputs=primary_caps.output, name='Efficient_CapsNet_stem')
+
+    features = tf.keras.Input(primary_caps.output.shape[1:])
+    digit_caps = fc_caps(features)
+    head = tf.keras.Model(inputs=features, outputs=[digit_caps, length(digit_caps)], name='Efficient_CapsNet')
+    return stem, head
+
+
+def head_graph(head, generator, n_classes):
+    """
+    Train graph of the head: [primary capsules, y_true] -> [digit_caps_len, reconstruction]. Output names are the ones of
+    the full train graph ('Efficient_CapsNet' and the generator name).
+    """
+    features = tf.keras.Input(head.input_shape[1:])
+    y_true = tf.keras.layers.Input(shape=(n_classes,))
+    digit_caps, digit_caps_len = head(features)
+    masked_by_y = Mask()([digit_caps, y_true])
+    return tf.keras.models.Model([features, y_true], [digit_caps_len, generator(masked_by_y)], name='Efficient_CapsNet_Head')
+
+
+def cache_key(stem, X, preprocessing):
+    """
+    Hash of the stem weights, of the preprocessing configuration (dict) and of the images X
+    """
+    h = hashlib.sha256()
+    for w in stem.get_weights():
+        h.update(w.tobytes())
+    h.update(json.dumps(preprocessing, sort_keys=True).encode())
+    h.update(str(X.shape).encode())
+    h.update(np.ascontiguousarray(X).tobytes())
+    return h.hexdigest()[:16]
+
+
+def load_features(cache_dir, name, stem, X, preprocessing, batch_size=256):
+    """
+    Return the stem features of X as a read-only memory-mapped array, computing and storing them in cache_dir if there
+    is no entry for the current weights, preprocessing and images. Stale entries of the same name are deleted.
+
+    Parameters
+    ----------
+    cache_dir: str
+        cache directory
+    name: str
+        entry name (Ex. 'efficient_capsnet_MNIST_train')
+    stem: tf.keras.Model
+        frozen stem returned by split_capsnet
+    X: np.ndarray
+        images fed to the stem
+    preprocessing: dict
+        configuration values used to produce X
+    batch_size: int
+        batch size of the stem forward passes
+    """
+    X = np.asarray(X, dtype=np.float32)
+    path = os.path.join(cache_dir, f'{name}_{cache_key(stem, X, preprocessing)}.npy')
+    if os.path.exists(path):
+        print(f"[INFO] Features loaded from {path}")
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(X),) + tuple(stem.output_shape[1:]))
+    for start in range(0, len(X), batch_size):
+        features[start:start+batch_size] = stem(X[start:start+batch_size], training=False).numpy()
+    features.flush()
+    del features
+    os.replace(tmp_path, path) # a cache entry is visible only when complete
+
+    for stale_path in glob.glob(os.path.join(cache_dir, f'{name}_*.npy')):
+        if stale_path != path:
+            os.remove(stale_path)
+    print(f"[INFO] Features cached in {path}")
+    return np.load(path, mmap_mode='r')
+
+
+def generate_tf_data(features, X, y, batch_size, shuffle=True):
+    """
+    Pipeline of ((features, y), (y, X)) batches. Batches are gathered from the memory-mapped features, so the cache is
+    never loaded entirely in memory.
+    """
+    y = np.asarray(y, dtype=np.float32)
+    X = np.asarray(X, dtype=np.float32)
+
+    def gather(index):
+        index = np.sort(index)
+        return np.asarray(features[index]), X[index], y[index]
+
+    def load_batch(index):
+        f, x, label = tf.numpy_function(gather, [index], [tf.float32, tf.float32, tf.float32])
+        f.set_shape((None,) + features.shape[1:])
+        x.set_shape((None,) + X.shape[1:])
+        label.set_shape((None,) + y.shape[1:])
+        return (f, label), (label, x)
+
+    dataset = tf.data.Dataset.range(len(y))
+    if shuffle:
+        dataset = dataset.shuffle(len(y), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(-1)
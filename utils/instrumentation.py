@@ -0,0 +1,230 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Latency and throughput instrumentation of the inference path, enabled by 'instrumentation' in the configuration file.
+Model records every predict, classify and evaluate call (latency histogram, images/s, batch sizes), and
+Model.profile_stages times the preprocessing, encoder (convolutions and primary capsules), routing (digit capsules)
+and decoder stages on a batch. Stages are timed on that batch only, not on live requests: splitting every request
+into three graphs would replace the single fused forward pass of the inference backend. Metrics are exported as JSON
+or in the Prometheus text format.
+"""
+
+import bisect
+import json
+import threading
+import time
+from collections import deque
+import numpy as np
+import tensorflow as tf
+
+# upper bounds [s] of the Prometheus histogram buckets, from 0.1 ms to ~100 s
+BUCKETS = [1e-4 * 2**(i/2) for i in range(41)]
+
+
+class LatencyHistogram(object):
+    """
+    Latency histogram of an operation. Percentiles are exact over the last 'window' calls, the cumulative buckets cover
+    all calls.
+
+    ...
+
+    Attributes
+    ----------
+    window: int
+        number of recent latencies used for the percentiles
+
+    Methods
+    -------
+    record(seconds, n_images)
+        add a call that processed n_images
+    summary()
+        count, percentiles, throughput and batch-size distribution
+    """
+    def __init__(self, window=10000):
+        self.recent = deque(maxlen=window)
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total_time = 0.
+        self.n_images = 0
+        self.batch_sizes = {}
+        self.first = None
+        self.last = None
+
+
+    def record(self, seconds, n_images):
+        now = time.time()
+        self.first = self.first or now - seconds
+        self.last = now
+        self.recent.append(seconds)
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_time += seconds
+        self.n_images += n_images
+        self.batch_sizes[n_images] = self.batch_sizes.get(n_images, 0) + 1
+
+
+    def summary(self):
+        p50, p95, p99 = np.percentile(self.recent, [50, 95, 99]) * 1000 if self.recent else (0., 0., 0.)
+        wall_time = self.last - self.first if self.count else 0.
+        return {
+            'count': self.count,
+            'images': self.n_images,
+            'mean_ms': 1000 * self.total_time / self.count if self.count else 0.,
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'images_per_s': self.n_images / self.total_time if self.total_time else 0.,
+            'wall_images_per_s': self.n_images / wall_time if wall_time else 0.,
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())}
+        }
+
+
+
+class Instrumentation(object):
+    """
+    Latency histograms of named operations (Ex. 'predict', 'classify', 'stage_encoder').
+
+    ...
+
+    Attributes
+    ----------
+    labels: dict
+        Prometheus labels added to every metric (Ex. {'model': 'MNIST'})
+
+    Methods
+    -------
+    record(name, seconds, n_images)
+        add a call of the operation name
+    to_dict()
+        summaries of all operations
+    to_json()
+        summaries of all operations as a JSON string
+    to_prometheus(prefix)
+        histograms in the Prometheus text exposition format
+    reset()
+        forget all recorded calls
+    """
+    def __init__(self, labels=None, window=10000):
+        self.labels = labels or {}
+        self.window = window
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, name, seconds, n_images):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram(self.window)
+            self.histograms[name].record(seconds, n_images)
+
+
+    def to_dict(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+
+    def to_prometheus(self, prefix='capsnet'):
+        lines = [f'# HELP {prefix}_latency_seconds latency of the inference operations',
+                 f'# TYPE {prefix}_latency_seconds histogram']
+        images = [f'# HELP {prefix}_images_total images processed by the inference operations',
+                  f'# TYPE {prefix}_images_total counter']
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                labels = dict(self.labels, operation=name)
+                cumulative = np.cumsum(histogram.bucket_counts)
+                for bound, count in zip(BUCKETS, cumulative):
+                    lines.append(f'{prefix}_latency_seconds_bucket{format_labels(labels, le=f"{bound:.6g}")} {count}')
+                lines.append(f'{prefix}_latency_seconds_bucket{format_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{prefix}_latency_seconds_sum{format_labels(labels)} {histogram.total_time:.9g}')
+                lines.append(f'{prefix}_latency_seconds_count{format_labels(labels)} {histogram.count}')
+                images.append(f'{prefix}_images_total{format_labels(labels)} {histogram.n_images}')
+        return '\n'.join(lines + images) + '\n'
+
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+def average(tensors):
+    return tensors[0] if len(tensors) == 1 else tf.keras.layers.Average()(tensors)
+
+
+def find_decoders(model):
+    """
+    (Mask layer, generator) of the decoder of model, or of every member network of an ensemble, in order. Generators
+    are the nested models named 'Generator'.
+    """
+    if 'Generator' in [layer.name for layer in model.layers]:
+        mask = next(layer for layer in model.layers if type(layer).__name__ == 'Mask')
+        return [(mask, model.get_layer('Generator'))]
+    return [decoder for layer in model.layers if isinstance(layer, tf.keras.Model) for decoder in find_decoders(layer)]
+
+
+def split_stages(model, capsnet):
+    """
+    Sub-models of the stages of a test graph (model) and of its capsule network (capsnet), sharing their layers:
+        encoder   images -> input of the routing layer (primary capsules)
+        routing   primary capsules -> [digit_caps, digit_caps_len] (FCCaps or DigitCaps and Length)
+        decoder   digit_caps -> reconstructions (masking and generator)
+    For an ensemble (models.ensemble_graph) every stage runs all the members: the primary capsules and digit capsules
+    are lists with those of every member, while the class scores and the reconstructions are averaged over them.
+    """
+    members = [layer for layer in capsnet.layers if isinstance(layer, tf.keras.Model)] or [capsnet]
+    routing_layers = [member.outputs[-2]._keras_history.layer for member in members]
+    length_layers = [member.outputs[-1]._keras_history.layer for member in members]
+    images = tf.keras.Input(capsnet.input_shape[1:])
+    primary_caps = [tf.keras.Model(member.input, routing_layer.input)(images)
+                    for member, routing_layer in zip(members, routing_layers)]
+    encoder = tf.keras.Model(images, primary_caps[0] if len(members) == 1 else primary_caps, name='encoder')
+
+    # the layers of every member are wrapped in a model of their own, members share the layer names
+    primary_caps, digit_caps, lengths = [], [], []
+    for i, (routing_layer, length_layer) in enumerate(zip(routing_layers, length_layers)):
+        x = tf.keras.Input(routing_layer.input_shape[1:])
+        member_digit_caps = routing_layer(x)
+        member_routing = tf.keras.Model(x, [member_digit_caps, length_layer(member_digit_caps)], name=f'routing_{i}')
+        primary_caps.append(tf.keras.Input(routing_layer.input_shape[1:]))
+        member_digit_caps, member_lengths = member_routing(primary_caps[-1])
+        digit_caps.append(member_digit_caps)
+        lengths.append(member_lengths)
+    lengths = average(lengths)
+    if len(members) == 1:
+        routing = tf.keras.Model(primary_caps[0], [digit_caps[0], lengths], name='routing')
+    else:
+        routing = tf.keras.Model(primary_caps, [digit_caps, lengths], name='routing')
+
+    decoders = find_decoders(model)
+    digit_caps = [tf.keras.Input(routing_layer.output_shape[1:]) for routing_layer in routing_layers]
+    n_reconstructions = len(model.outputs) - 1
+    reconstructions = []
+    for i, ((mask, generator), x) in enumerate(zip(decoders, digit_caps)):
+        member_digit_caps = tf.keras.Input(x.shape[1:])
+        masked = mask(member_digit_caps, double_mask=True) if n_reconstructions == 2 else [mask(member_digit_caps)]
+        member_decoder = tf.keras.Model(member_digit_caps, [generator(m) for m in masked], name=f'decoder_{i}')
+        reconstructions.append(tf.nest.flatten(member_decoder(x)))
+    decoder = tf.keras.Model(digit_caps[0] if len(members) == 1 else digit_caps,
+                             [average(list(r)) for r in zip(*reconstructions)], name='decoder')
+    return encoder, routing, decoder
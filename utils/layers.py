@@ -40,8 +40,9 @@ class SquashHinton(tf.keras.layers.Layer):
         self.eps = eps
 
     def call(self, s):
-        n = tf.norm(s,axis=-1,keepdims=True)
-        return tf.multiply(n**2/(1+n**2)/(n+self.eps), s)
+        with tf.name_scope('squash'):
+            n = tf.norm(s,axis=-1,keepdims=True)
+            return tf.multiply(n**2/(1+n**2)/(n+self.eps), s)
 
     def get_config(self):
         base_config = super().get_config()
@@ -74,8 +75,9 @@ class Squash(tf.keras.layers.Layer):
         self.eps = eps
 
     def call(self, s):
-        n = tf.norm(s,axis=-1,keepdims=True)
-        return (1 - 1/(tf.math.exp(n)+self.eps))*(s/(n+self.eps))
+        with tf.name_scope('squash'):
+            n = tf.norm(s,axis=-1,keepdims=True)
+            return (1 - 1/(tf.math.exp(n)+self.eps))*(s/(n+self.eps))
 
     def get_config(self):
         base_config = super().get_config()
@@ -122,11 +124,13 @@ class PrimaryCaps(tf.keras.layers.Layer):
     def build(self, input_shape):    
         self.DW_Conv2D = tf.keras.layers.Conv2D(self.F, self.K, self.s,
                                              activation='linear', groups=self.F, padding='valid')
-
+        with tf.name_scope(self.DW_Conv2D.name): # weights are created outside the 'depthwise_conv' name scope of call
+            self.DW_Conv2D.build(input_shape)
         self.built = True
     
     def call(self, inputs):      
-        x = self.DW_Conv2D(inputs)      
+        with tf.name_scope('depthwise_conv'): # named trace annotation of the profiler
+            x = self.DW_Conv2D(inputs)      
         x = tf.keras.layers.Reshape((self.N, self.D))(x)
         x = Squash()(x)
         
@@ -149,17 +153,22 @@ class FCCaps(tf.keras.layers.Layer):
         primary capsules dimension (number of properties)
     kernel_initilizer: str
         matrix W initialization strategy
+    recompute: bool
+        in training, do not keep the votes u and the coupling coefficients c for the backward pass but recompute them
  
     Methods
     -------
-    call(inputs)
+    call(inputs, training)
         compute the primary capsule layer
+    route(inputs)
+        votes and routing of call, wrapped in tf.recompute_grad when recompute is set in training
     """
-    def __init__(self, N, D, kernel_initializer='he_normal', **kwargs):
+    def __init__(self, N, D, kernel_initializer='he_normal', recompute=False, **kwargs):
         super(FCCaps, self).__init__(**kwargs)
         self.N = N
         self.D = D
         self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+        self.recompute = recompute
         
     def build(self, input_shape):
         input_N = input_shape[-2]
@@ -170,14 +179,23 @@ class FCCaps(tf.keras.layers.Layer):
         self.built = True
     
     def call(self, inputs, training=None):
-        
-        u = tf.einsum('...ji,kjiz->...kjz',inputs,self.W)    # u shape=(None,N,H*W*input_N,D)
+        if self.recompute and training:
+            return tf.recompute_grad(self.route)(inputs)
+        return self.route(inputs)
+
+    def route(self, inputs):
+        # name scopes are the trace annotations of the profiler
+        with tf.name_scope('votes_einsum'):
+            u = tf.einsum('...ji,kjiz->...kjz',inputs,self.W)    # u shape=(None,N,H*W*input_N,D)
              
-        c = tf.einsum('...ij,...kj->...i', u, u)[...,None]        # b shape=(None,N,H*W*input_N,1) -> (None,j,i,1)
-        c = c/tf.sqrt(tf.cast(self.D, tf.float32))
-        c = tf.nn.softmax(c, axis=1)                             # c shape=(None,N,H*W*input_N,1) -> (None,j,i,1)
-        c = c + self.b
-        s = tf.reduce_sum(tf.multiply(u, c),axis=-2)             # s shape=(None,N,D)
+        with tf.name_scope('agreement_einsum'):
+            c = tf.einsum('...ij,...kj->...i', u, u)[...,None]        # b shape=(None,N,H*W*input_N,1) -> (None,j,i,1)
+            c = c/tf.sqrt(tf.cast(self.D, tf.float32))
+        with tf.name_scope('routing_softmax'):
+            c = tf.nn.softmax(c, axis=1)                             # c shape=(None,N,H*W*input_N,1) -> (None,j,i,1)
+            c = c + self.b
+        with tf.name_scope('weighted_sum'):
+            s = tf.reduce_sum(tf.multiply(u, c),axis=-2)             # s shape=(None,N,D)
         v = Squash()(s)       # v shape=(None,N,D)
         
         return v
@@ -188,7 +206,8 @@ class FCCaps(tf.keras.layers.Layer):
     def get_config(self):
         config = {
             'N': self.N,
-            'D': self.D
+            'D': self.D,
+            'recompute': self.recompute
         }
         base_config = super(FCCaps, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -269,4 +288,62 @@ class Mask(tf.keras.layers.Layer):
     def get_config(self):
         config = super(Mask, self).get_config()
         return config
+
+
+
+@tf.custom_gradient
+def scale_gradient(x, scale):
+    return tf.identity(x), lambda dy: (dy * scale, None)
+
+
+
+class DecoderSubsample(tf.keras.layers.Layer):
+    """
+    Run the decoder (generator) only on a subset of the batch during training. The reconstruction branch is computed
+    on ceil(fraction*batch_size) samples drawn at random at every step (the pipelines do not shuffle every dataset, Ex.
+    SMALLNORB) and only with probability 1/every, i.e. every 'every' steps on average. The output keeps the batch size:
+    the rows of the samples that were not decoded are NaN. The gradients of the branch are multiplied by 'every', so
+    the reconstruction loss stays unbiased. In inference the decoder runs on the full batch.
+    Use it with reconstructionLoss, which computes the error on the decoded rows only.
     
+    ...
+    
+    Attributes
+    ----------
+    generator: tf.keras.Model
+        decoder network
+    fraction: float
+        fraction of the batch fed to the decoder
+    every: int
+        average number of train steps between two decoder runs
+ 
+    Methods
+    -------
+    call(inputs, training)
+        decode the selected masked capsules
+    """
+    def __init__(self, generator, fraction=1., every=1, **kwargs):
+        super(DecoderSubsample, self).__init__(**kwargs)
+        self.generator = generator
+        self.fraction = fraction
+        self.every = every
+
+    def call(self, inputs, training=None):
+        if not training:
+            return self.generator(inputs, training=training)
+        batch_size = tf.shape(inputs)[0]
+        n = tf.cast(tf.math.ceil(self.fraction * tf.cast(batch_size, tf.float32)), tf.int32)
+        if self.every > 1:
+            n = tf.where(tf.random.uniform(()) < 1. / self.every, n, 0)
+        indices = tf.random.shuffle(tf.range(batch_size))[:n]
+        x = scale_gradient(self.generator(tf.gather(inputs, indices), training=training), float(self.every))
+        shape = tf.concat([[batch_size], tf.shape(x)[1:]], axis=0)
+        return tf.tensor_scatter_nd_update(tf.fill(shape, tf.constant(float('nan'), x.dtype)), indices[:, None], x)
+
+    def get_config(self):
+        config = {
+            'fraction': self.fraction,
+            'every': self.every
+        }
+        base_config = super(DecoderSubsample, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
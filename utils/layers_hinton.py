@@ -104,18 +104,24 @@ class DigitCaps(tf.keras.layers.Layer):
         number of routing iterations
     kernel_initializer:
         matrix W kernel initializer
+    recompute: bool
+        in training, do not keep the predictions u and the tensors of every routing iteration for the backward pass
+        but recompute them
  
     Methods
     -------
-    call(inputs)
+    call(inputs, training)
         compute the primary capsule layer
+    route(inputs)
+        votes and routing of call, wrapped in tf.recompute_grad when recompute is set in training
     """
-    def __init__(self, C, L, routing=None, kernel_initializer='glorot_uniform', **kwargs):
+    def __init__(self, C, L, routing=None, kernel_initializer='glorot_uniform', recompute=False, **kwargs):
         super(DigitCaps, self).__init__(**kwargs)
         self.C = C
         self.L = L
         self.routing = routing
         self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+        self.recompute = recompute
         
     def build(self, input_shape):
         assert len(input_shape) >= 5, "The input Tensor should have shape=[None,H,W,input_C,input_L]"
@@ -128,23 +134,33 @@ class DigitCaps(tf.keras.layers.Layer):
         self.biases = self.add_weight(shape=[self.C,self.L], initializer='zeros', name='biases')
         self.built = True
     
-    def call(self, inputs):
+    def call(self, inputs, training=None):
+        if self.recompute and training:
+            return tf.recompute_grad(self.route)(inputs)
+        return self.route(inputs)
+
+    def route(self, inputs):
         H,W,input_C,input_L = inputs.shape[1:]          # input shape=(None,H,W,input_C,input_L)
         x = tf.reshape(inputs,(-1, H*W*input_C, input_L)) #     x shape=(None,H*W*input_C,input_L)
         
-        u = tf.einsum('...ji,jik->...jk', x, self.W)      #     u shape=(None,H*W*input_C,C*L)
-        u = tf.reshape(u,(-1, H*W*input_C, self.C, self.L))#     u shape=(None,H*W*input_C,C,L)
+        # name scopes are the trace annotations of the profiler, as in FCCaps
+        with tf.name_scope('votes_einsum'):
+            u = tf.einsum('...ji,jik->...jk', x, self.W)      #     u shape=(None,H*W*input_C,C*L)
+            u = tf.reshape(u,(-1, H*W*input_C, self.C, self.L))#     u shape=(None,H*W*input_C,C,L)
         
         if self.routing:
             #Hinton's routing
             b = tf.zeros(tf.shape(u)[:-1])[...,None]                       # b shape=(None,H*W*input_C,C,1) -> (None,i,j,1)
             for r in range(self.routing):
-                c = tf.nn.softmax(b,axis=2)                                # c shape=(None,H*W*input_C,C,1) -> (None,i,j,1)
-                s = tf.reduce_sum(tf.multiply(u,c),axis=1,keepdims=True)   # s shape=(None,1,C,L)
-                s += self.biases       
+                with tf.name_scope('routing_softmax'):
+                    c = tf.nn.softmax(b,axis=2)                            # c shape=(None,H*W*input_C,C,1) -> (None,i,j,1)
+                with tf.name_scope('weighted_sum'):
+                    s = tf.reduce_sum(tf.multiply(u,c),axis=1,keepdims=True) # s shape=(None,1,C,L)
+                    s += self.biases       
                 v = squash(s)                                              # v shape=(None,1,C,L)
                 if r < self.routing-1:
-                    b += tf.reduce_sum(tf.multiply(u, v), axis=-1, keepdims=True)
+                    with tf.name_scope('agreement'):
+                        b += tf.reduce_sum(tf.multiply(u, v), axis=-1, keepdims=True)
             v = v[:,0,...]      # v shape=(None,C,L)
         else:
             s = tf.reduce_sum(u, axis=1, keepdims=True) 
@@ -160,7 +176,8 @@ class DigitCaps(tf.keras.layers.Layer):
         config = {
             'C': self.C,
             'L': self.L,
-            'routing': self.routing
+            'routing': self.routing,
+            'recompute': self.recompute
         }
         base_config = super(DigitCaps, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
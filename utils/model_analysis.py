@@ -0,0 +1,297 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Analytic FLOP and memory estimates of the graphs, without running them. The layers of a model (and of its nested
+models, Ex. the capsule network and the generator) are walked in topological order and every call is costed with an
+explicit model of its operations, including the einsums and routing of FCCaps, the routing iterations of DigitCaps and
+the Mask and decoder branches. A multiply-add counts as 2 FLOPs, as in the TensorFlow profiler. Einsums are costed as
+the TensorFlow kernel runs them: labels of a single operand that are not in the output are summed first, then the
+operands are contracted.
+"""
+
+import math
+import numpy as np
+import tensorflow as tf
+from utils import layers, layers_hinton
+
+
+def _elements(shape):
+    return int(np.prod([d for d in shape])) if None not in shape else 0
+
+
+def _activation(activation, n):
+    # one operation per element for every non-linearity
+    return 0 if activation in (None, tf.keras.activations.linear) else n
+
+
+def squash_flops(n_caps, D, hinton=False):
+    """
+    FLOPs of the squash of n_caps capsules of dimension D: norm (2D + 1) and scaling of the capsule (D), plus the
+    scalar factor of 'Dynamic routing between capsules' (Hinton) or of Efficient-CapsNet
+    """
+    return n_caps * (3*D + 6 if hinton else 4*D + 6)
+
+
+def conv2d_cost(layer, inputs, outputs, training):
+    out = _elements(outputs[0])
+    flops = 2 * out * np.prod(layer.kernel_size) * inputs[0][-1] // layer.groups
+    return flops + out * layer.use_bias + _activation(layer.activation, out), out, 0
+
+
+def dense_cost(layer, inputs, outputs, training):
+    out = _elements(outputs[0])
+    flops = 2 * out * inputs[0][-1]
+    return flops + out * layer.use_bias + _activation(layer.activation, out), out, 0
+
+
+def batch_normalization_cost(layer, inputs, outputs, training):
+    # scale and shift, plus the batch moments in training
+    out = _elements(outputs[0])
+    return (5 if training else 2) * out, out, 0
+
+
+def elementwise_cost(layer, inputs, outputs, training):
+    out = _elements(outputs[0])
+    return max(len(inputs) - 1, 1) * out, out, 0
+
+
+def free_cost(layer, inputs, outputs, training):
+    return 0, _elements(outputs[0]), 0
+
+
+def op_lambda_cost(layer, inputs, outputs, training):
+    # TensorFlow functions called on Keras tensors (Ex. tf.reshape in the original CapsNet graph)
+    if any(name in getattr(layer, 'symbol', '') for name in ('reshape', 'identity', 'expand_dims', 'squeeze')):
+        return free_cost(layer, inputs, outputs, training)
+    return elementwise_cost(layer, inputs, outputs, training)
+
+
+def squash_cost(layer, inputs, outputs, training):
+    *caps, D = inputs[0]
+    return squash_flops(int(np.prod(caps)), D, isinstance(layer, layers.SquashHinton)), _elements(inputs[0]), 0
+
+
+def primary_caps_cost(layer, inputs, outputs, training):
+    H, W, C_in = inputs[0]
+    conv = ((H - layer.K) // layer.s + 1) * ((W - layer.K) // layer.s + 1) * layer.F
+    flops = 2 * conv * layer.K**2 * C_in // layer.F + conv + squash_flops(layer.N, layer.D)
+    return flops, layer.N * layer.D, conv
+
+
+def primary_caps_hinton_cost(layer, inputs, outputs, training):
+    H, W, C_in = inputs[0]
+    n_caps = ((H - layer.k) // layer.s + 1) * ((W - layer.k) // layer.s + 1) * layer.C
+    flops = 2 * n_caps * layer.L * layer.k**2 * C_in + 2 * n_caps * layer.L + squash_flops(n_caps, layer.L, hinton=True)
+    return flops, n_caps * layer.L, n_caps * layer.L
+
+
+def fc_caps_cost(layer, inputs, outputs, training):
+    N_in, D_in = inputs[0]
+    N, D = layer.N, layer.D
+    votes = 2 * N * N_in * D_in * D                  # u = einsum(inputs, W)
+    # einsum('...ij,...kj->...i', u, u) / sqrt(D): the Einsum kernel first sums u over k, the label of a single
+    # operand, then contracts the (N, N_in, D) and (N, D) operands
+    agreement = N * N_in * D + 2 * N * N_in * D + N * N_in
+    routing = 3 * N * N_in + N * N_in                # softmax + b
+    weighted_sum = 2 * N * N_in * D
+    flops = votes + agreement + routing + weighted_sum + squash_flops(N, D)
+    return flops, N * D, 2 * N * N_in * D + 2 * N * N_in
+
+
+def digit_caps_cost(layer, inputs, outputs, training):
+    H, W, C_in, L_in = inputs[0]
+    n, C, L = H * W * C_in, layer.C, layer.L
+    flops = 2 * n * L_in * C * L                     # predictions u
+    workspace = n * C * L
+    if layer.routing:
+        # u * c, logits and coupling coefficients (and u * v) of every iteration are kept for the backward
+        for r in range(layer.routing):
+            flops += 3 * n * C + 2 * n * C * L + C * L + squash_flops(C, L, hinton=True)
+            workspace += n * C * L + 2 * n * C
+            if r < layer.routing - 1:
+                flops += 2 * n * C * L + n * C       # agreement update of the logits b
+                workspace += n * C * L
+    else:
+        flops += n * C * L + C * L + squash_flops(C, L, hinton=True)
+    return flops, C * L, workspace
+
+
+def length_cost(layer, inputs, outputs, training):
+    *caps, D = inputs[0]
+    n_caps = int(np.prod(caps))
+    return n_caps * (2*D + 1), n_caps, 0
+
+
+def mask_cost(layer, inputs, outputs, training, double_mask=False):
+    N, D = inputs[0]
+    n_masks = 2 if double_mask else 1
+    flops = n_masks * N * D
+    if len(inputs) == 1: # masks from the capsule lengths
+        flops += 2 * N * D + (2 * N * math.ceil(math.log2(N)) if double_mask else N)
+    return flops, n_masks * N * D, 0
+
+
+COST_MODELS = {
+    tf.keras.layers.Conv2D: conv2d_cost,
+    tf.keras.layers.Dense: dense_cost,
+    tf.keras.layers.BatchNormalization: batch_normalization_cost,
+    tf.keras.layers.Add: elementwise_cost,
+    tf.keras.layers.Multiply: elementwise_cost,
+    tf.keras.layers.ReLU: elementwise_cost,
+    tf.keras.layers.LeakyReLU: elementwise_cost,
+    tf.keras.layers.Activation: elementwise_cost,
+    tf.keras.layers.Reshape: free_cost,
+    tf.keras.layers.Flatten: free_cost,
+    tf.keras.layers.Dropout: free_cost,
+    layers.Squash: squash_cost,
+    layers.SquashHinton: squash_cost,
+    layers.PrimaryCaps: primary_caps_cost,
+    layers.FCCaps: fc_caps_cost,
+    layers.Length: length_cost,
+    layers.Mask: mask_cost,
+    layers_hinton.PrimaryCaps: primary_caps_hinton_cost,
+    layers_hinton.DigitCaps: digit_caps_cost,
+    layers_hinton.Length: length_cost,
+    layers_hinton.Mask: mask_cost,
+}
+
+
+def _shapes(shapes):
+    # a single shape or a list/tuple of shapes (Ex. the two outputs of Mask with double_mask)
+    if not (isinstance(shapes, (list, tuple)) and shapes and isinstance(shapes[0], (list, tuple, tf.TensorShape))):
+        shapes = [shapes]
+    return [tuple(tf.TensorShape(s).as_list()[1:]) for s in shapes]
+
+
+def _cost_model(layer):
+    if type(layer).__name__ == 'TFOpLambda':
+        return op_lambda_cost
+    return next((COST_MODELS[cls] for cls in type(layer).__mro__ if cls in COST_MODELS), None)
+
+
+def _walk(model, training, scale, fraction, prefix, rows, seen):
+    # scale: average runs per step of the calls (FLOPs), fraction: part of the batch they process (memory)
+    for depth in sorted(model._nodes_by_depth, reverse=True):
+        for node in model._nodes_by_depth[depth]:
+            layer = node.layer
+            if isinstance(layer, tf.keras.layers.InputLayer):
+                continue
+            if isinstance(layer, tf.keras.Model):
+                _walk(layer, training, scale, fraction, f'{prefix}{layer.name}/', rows, seen)
+                continue
+            if isinstance(layer, layers.DecoderSubsample):
+                # in training the decoder runs on a fraction of the batch once every 'every' steps on average
+                decoder_fraction = layer.fraction if training else 1.
+                decoder_scale = decoder_fraction / layer.every if training else 1.
+                _walk(layer.generator, training, scale * decoder_scale, fraction * decoder_fraction,
+                      f'{prefix}{layer.name}/', rows, seen)
+                continue
+
+            inputs, outputs = _shapes(node.input_shapes), _shapes(node.output_shapes)
+            cost_model = _cost_model(layer)
+            kwargs = {'double_mask': True} if node.call_kwargs.get('double_mask') else {}
+            flops, output, workspace = cost_model(layer, inputs, outputs, training, **kwargs) if cost_model else \
+                (0, sum(_elements(s) for s in outputs), 0)
+            new = id(layer) not in seen # shared layers (Ex. a generator called twice) own their weights once
+            seen.add(id(layer))
+            rows.append({
+                'name': prefix + layer.name,
+                'type': type(layer).__name__,
+                'modeled': cost_model is not None,
+                'flops': int(scale * flops),
+                'params': layer.count_params() if new else 0,
+                'trainable_params': sum(int(np.prod(w.shape)) for w in layer.trainable_weights) if new else 0,
+                'input_elements': sum(_elements(s) for s in inputs),
+                'output_elements': output,
+                'workspace_elements': workspace,
+                'recomputed': bool(training and getattr(layer, 'recompute', False)),
+                'batch_fraction': fraction
+            })
+
+
+def analyze(model, batch_size=1, training=False, dtype_bytes=4):
+    """
+    Per-layer and total estimates of a Keras model at batch_size:
+        flops                    FLOPs per image of a forward pass (training selects the train behaviour of
+                                 BatchNormalization and DecoderSubsample)
+        train_step_flops         FLOPs per image of a train step, forward plus backward (~2x forward) plus the forward
+                                 of the capsule layers built with recompute
+        params, param_bytes      parameters and their size
+        activation_bytes         layer outputs and capsule-layer temporaries of a forward pass, kept for the backward
+                                 (the temporaries of layers built with recompute are not)
+        peak_activation_bytes    largest inputs + outputs + temporaries of a single layer (inference with buffer reuse)
+        inference_bytes          param_bytes + peak_activation_bytes
+        train_bytes              weights, gradients and two Adam slots of the trainable parameters + activation_bytes
+    and 'layers', with the flops, params and bytes of every layer call. Layers without a cost model ('modeled' False)
+    count their outputs only.
+    """
+    rows = []
+    _walk(model, training, 1., 1., '', rows, set())
+    for row in rows:
+        batch = math.ceil(row.pop('batch_fraction') * batch_size)
+        for key in ('input', 'output', 'workspace'):
+            row[f'{key}_bytes'] = row.pop(f'{key}_elements') * batch * dtype_bytes
+        row['param_bytes'] = row['params'] * dtype_bytes
+
+    flops = sum(row['flops'] for row in rows)
+    params = sum(row['params'] for row in rows)
+    trainable = sum(row['trainable_params'] for row in rows)
+    activation_bytes = sum(row['output_bytes'] + row['workspace_bytes'] * (not row['recomputed']) for row in rows)
+    recomputed_flops = sum(row['flops'] for row in rows if row['recomputed'])
+    peak_activation_bytes = max((row['input_bytes'] + row['output_bytes'] + row['workspace_bytes'] for row in rows), default=0)
+    return {
+        'model': model.name,
+        'batch_size': batch_size,
+        'training': training,
+        'flops': flops,
+        'train_step_flops': 3 * flops + recomputed_flops,
+        'params': params,
+        'param_bytes': params * dtype_bytes,
+        'activation_bytes': activation_bytes,
+        'peak_activation_bytes': peak_activation_bytes,
+        'inference_bytes': params * dtype_bytes + peak_activation_bytes,
+        'train_bytes': (params + 3 * trainable) * dtype_bytes + activation_bytes,
+        'layers': rows
+    }
+
+
+def format_layers(analysis):
+    """
+    Per-layer table of an analysis
+    """
+    lines = [f"{'layer':<48}{'type':<20}{'MFLOPs/img':>12}{'params':>11}{'act. MB':>9}{'temp MB':>9}",
+             '-' * 109]
+    for row in analysis['layers']:
+        lines.append(f"{row['name'] + ('' if row['modeled'] else ' *'):<48}{row['type']:<20}{row['flops']/1e6:>12.3f}"
+                     f"{row['params']:>11,}{row['output_bytes']/2**20:>9.2f}{row['workspace_bytes']/2**20:>9.2f}")
+    lines.append('-' * 109)
+    lines.append(f"{'total':<68}{analysis['flops']/1e6:>12.3f}{analysis['params']:>11,}"
+                 f"{analysis['activation_bytes']/2**20:>18.2f}")
+    lines.append(f"batch_size {analysis['batch_size']}, {'train' if analysis['training'] else 'test'} behaviour"
+                 + (", * no cost model (outputs only)" if not all(r['modeled'] for r in analysis['layers']) else ''))
+    return '\n'.join(lines)
+
+
+def format_totals(analyses):
+    """
+    Table of the totals of several analyses (dict name -> analysis), Ex. the train and test graphs of a model
+    """
+    lines = [f"{'graph':<28}{'params':>11}{'param MB':>10}{'MFLOPs/img':>12}{'train MFLOPs/img':>18}"
+             f"{'act. MB':>9}{'infer MB':>10}{'train MB':>10}"]
+    for name, a in analyses.items():
+        lines.append(f"{name:<28}{a['params']:>11,}{a['param_bytes']/2**20:>10.2f}{a['flops']/1e6:>12.2f}"
+                     f"{a['train_step_flops']/1e6:>18.2f}{a['activation_bytes']/2**20:>9.2f}"
+                     f"{a['inference_bytes']/2**20:>10.2f}{a['train_bytes']/2**20:>10.2f}")
+    return '\n'.join(lines)
@@ -16,7 +16,6 @@
 import numpy as np
 import tensorflow as tf
 import os
-import cv2
 tf2 = tf.compat.v2
 
 # constants
@@ -61,6 +60,7 @@ def image_shift_rand(image, label):
     return image, label
 
 def image_rotate_random_py_func(image, angle):
+    import cv2 # imported only when the augmentation runs
     rot_mat = cv2.getRotationMatrix2D(
         (MNIST_IMG_SIZE/2, MNIST_IMG_SIZE/2), int(angle), 1.0)
     rotated = cv2.warpAffine(image.numpy(), rot_mat,
@@ -110,26 +110,26 @@ def image_squish_random(image, label):
 def generator(image, label):
     return (image, label), (label, image)
 
-def generate_tf_data(X_train, y_train, X_test, y_test, batch_size):
+def generate_tf_data(X_train, y_train, X_test, y_test, batch_size, parallel_calls=PARALLEL_INPUT_CALLS):
 	dataset_train = tf.data.Dataset.from_tensor_slices((X_train,y_train))
 	dataset_train = dataset_train.shuffle(buffer_size=MNIST_TRAIN_IMAGE_COUNT)
 	dataset_train = dataset_train.map(image_rotate_random, 
-	    num_parallel_calls=PARALLEL_INPUT_CALLS)
+	    num_parallel_calls=parallel_calls)
 	dataset_train = dataset_train.map(image_shift_rand,
-	    num_parallel_calls=PARALLEL_INPUT_CALLS)
+	    num_parallel_calls=parallel_calls)
 	dataset_train = dataset_train.map(image_squish_random,
-	    num_parallel_calls=PARALLEL_INPUT_CALLS)
+	    num_parallel_calls=parallel_calls)
 	dataset_train = dataset_train.map(image_erase_random,
-	   num_parallel_calls=PARALLEL_INPUT_CALLS)
+	   num_parallel_calls=parallel_calls)
 	dataset_train = dataset_train.map(generator, 
-	   num_parallel_calls=PARALLEL_INPUT_CALLS)
+	   num_parallel_calls=parallel_calls)
 	dataset_train = dataset_train.batch(batch_size)
 	dataset_train = dataset_train.prefetch(-1)
 
 	dataset_test = tf.data.Dataset.from_tensor_slices((X_test, y_test))
 	dataset_test = dataset_test.cache()
 	dataset_test = dataset_test.map(generator,
-	    num_parallel_calls=PARALLEL_INPUT_CALLS)
+	    num_parallel_calls=parallel_calls)
 	dataset_test = dataset_test.batch(batch_size)
 	dataset_test = dataset_test.prefetch(-1)
     
@@ -16,7 +16,6 @@
 import numpy as np
 import tensorflow as tf
 import os
-import cv2
 
 # constants
 MULTIMNIST_IMG_SIZE = 36
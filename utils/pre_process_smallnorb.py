@@ -16,7 +16,6 @@
 import numpy as np
 import tensorflow as tf
 import os
-from tqdm.notebook import tqdm
 
 
 # constants
@@ -28,9 +27,11 @@ MAX_DELTA = 2.0
 LOWER_CONTRAST = 0.5
 UPPER_CONTRAST = 1.5
 PARALLEL_INPUT_CALLS = 16
+CROP_OFFSETS = [(.5,.5), (0,0), (0,1), (1,0), (1,1), (0,.5), (.5,0), (.5,1), (1,.5)] # fractions of the free margin
 
 
 def pre_process(ds):
+    from tqdm.notebook import tqdm
     X = np.empty((SAMPLES, INPUT_SHAPE, INPUT_SHAPE, 2))
     y = np.empty((SAMPLES,))
         
@@ -55,6 +56,21 @@ def test_patches(x, y, config):
     res = (config['scale_smallnorb'] - config['patch_smallnorb']) // 2
     return x[:,res:-res,res:-res,:], y
 
+def test_crops(x, config, n_crops=5, flip=False):
+    """
+    n_crops patches of every rescaled image of x (center, corners, then edge centers, at most 9) and, with flip, their
+    horizontal flips, stacked into a single batch of shape (len(x)*n_crops*(1+flip), patch, patch, 2) with the crops of
+    an image contiguous. n_crops=1 is the center crop of test_patches.
+    """
+    if not 1 <= n_crops <= len(CROP_OFFSETS):
+        raise ValueError(f"n_crops must be between 1 and {len(CROP_OFFSETS)}, not {n_crops}")
+    patch = config['patch_smallnorb']
+    res = config['scale_smallnorb'] - patch
+    crops = tf.stack([x[:,int(i*res):int(i*res)+patch,int(j*res):int(j*res)+patch,:] for i, j in CROP_OFFSETS[:n_crops]], axis=1)
+    if flip:
+        crops = tf.concat([crops, tf.reverse(crops, axis=[3])], axis=1)
+    return tf.reshape(crops, (-1, patch, patch, crops.shape[-1]))
+
 
 def generator(image, label):
     return (image, label), (label, image)
@@ -69,24 +85,24 @@ def random_contrast(x, y):
     return tf.image.random_contrast(x, lower=LOWER_CONTRAST, upper=UPPER_CONTRAST), y
 
 
-def generate_tf_data(X_train, y_train, X_test_patch, y_test, batch_size):
+def generate_tf_data(X_train, y_train, X_test_patch, y_test, batch_size, parallel_calls=PARALLEL_INPUT_CALLS):
     dataset_train = tf.data.Dataset.from_tensor_slices((X_train, y_train))
     # dataset_train = dataset_train.shuffle(buffer_size=SAMPLES) not needed if imported with tfds
     dataset_train = dataset_train.map(random_patches,
-        num_parallel_calls=PARALLEL_INPUT_CALLS)
+        num_parallel_calls=parallel_calls)
     dataset_train = dataset_train.map(random_brightness,
-        num_parallel_calls=PARALLEL_INPUT_CALLS)
+        num_parallel_calls=parallel_calls)
     dataset_train = dataset_train.map(random_contrast,
-        num_parallel_calls=PARALLEL_INPUT_CALLS)
+        num_parallel_calls=parallel_calls)
     dataset_train = dataset_train.map(generator,
-        num_parallel_calls=PARALLEL_INPUT_CALLS)
+        num_parallel_calls=parallel_calls)
     dataset_train = dataset_train.batch(batch_size)
     dataset_train = dataset_train.prefetch(-1)
 
     dataset_test = tf.data.Dataset.from_tensor_slices((X_test_patch, y_test))
     dataset_test = dataset_test.cache()
     dataset_test = dataset_test.map(generator,
-        num_parallel_calls=PARALLEL_INPUT_CALLS)
+        num_parallel_calls=parallel_calls)
     dataset_test = dataset_test.batch(1)
     dataset_test = dataset_test.prefetch(-1)
     
@@ -0,0 +1,180 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Content-addressed cache of the classification results of single samples, used by Model.classify when
+'prediction_cache_size' is set in the configuration file. A sample is identified by the hash of its preprocessed bytes
+within a namespace made of the model name and a checksum of its weights, so results of other weights are never served.
+Entries live in a bounded in-memory LRU and, with 'prediction_cache_dir', in a directory that several processes can
+share.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def weights_checksum(model):
+    """
+    Hash of the weights of model (tf.keras.Model)
+    """
+    h = hashlib.sha256()
+    for w in model.get_weights():
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()[:16]
+
+
+class PredictionCache(object):
+    """
+    LRU cache of per-sample class scores (and optionally digit capsules) with an optional on-disk tier.
+
+    ...
+
+    Attributes
+    ----------
+    namespace: str
+        model name and weights checksum (Ex. 'Efficient_CapsNet-1a2b3c4d5e6f7a8b')
+    max_entries: int
+        maximum number of samples kept in memory
+    disk_dir: str
+        directory of the on-disk tier (None for memory only)
+    store_vectors: bool
+        cache the digit capsules too, so that classify(X, return_vectors=True) is served from the cache
+
+    Methods
+    -------
+    classify(classify_batch, X, return_vectors)
+        results of classify_batch(X, return_vectors) computed for the samples that are not cached only
+    stats()
+        hit-rate and latency counters
+    clear()
+        empty the in-memory tier
+    """
+    def __init__(self, namespace, max_entries=10000, disk_dir=None, store_vectors=False):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.disk_dir = os.path.join(disk_dir, namespace) if disk_dir else None
+        self.store_vectors = store_vectors
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+        self.n_bypassed = 0
+        self.lookup_time = 0.
+        self.compute_time = 0.
+        self.n_calls = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+
+    def key(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return hashlib.sha256(str(x.shape).encode() + x.tobytes()).hexdigest()
+
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.npy')
+
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.n_hits += 1
+                return self.entries[key]
+        if self.disk_dir:
+            try:
+                value = np.load(self.disk_path(key), allow_pickle=False)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.put(key, value, disk=False)
+                with self.lock:
+                    self.n_hits += 1
+                    self.n_disk_hits += 1
+                return value
+        with self.lock:
+            self.n_misses += 1
+        return None
+
+
+    def put(self, key, value, disk=True):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if disk and self.disk_dir:
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path[:-len(".npy")]}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+            np.save(tmp_path, value)
+            os.replace(tmp_path, path) # readers never see a partial entry
+
+
+    def classify(self, classify_batch, X, return_vectors=False):
+        if return_vectors and not self.store_vectors:
+            with self.lock:
+                self.n_bypassed += len(X)
+            return classify_batch(X, return_vectors)
+
+        start = time.perf_counter()
+        X = np.asarray(X, dtype=np.float32)
+        keys = [self.key(x) for x in X]
+        values = [self.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        lookup_end = time.perf_counter()
+
+        if missing:
+            scores, vectors = classify_batch(X[missing], return_vectors=True)
+            for j, i in enumerate(missing):
+                # with vectors, an entry holds the score of every class followed by its digit capsule
+                values[i] = np.concatenate([scores[j][:, None], vectors[j]], -1) if self.store_vectors else scores[j]
+                self.put(keys[i], values[i])
+        with self.lock:
+            self.n_calls += 1
+            self.lookup_time += lookup_end - start
+            self.compute_time += time.perf_counter() - lookup_end
+
+        values = np.stack(values)
+        if not self.store_vectors:
+            return values
+        if return_vectors:
+            return values[..., 0], values[..., 1:]
+        return values[..., 0]
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.n_hits + self.n_misses
+            return {
+                'namespace': self.namespace,
+                'entries': len(self.entries),
+                'hits': self.n_hits,
+                'disk_hits': self.n_disk_hits,
+                'misses': self.n_misses,
+                'bypassed': self.n_bypassed,
+                'hit_rate': self.n_hits / lookups if lookups else 0.,
+                'mean_lookup_ms': 1000 * self.lookup_time / self.n_calls if self.n_calls else 0.,
+                'mean_compute_ms': 1000 * self.compute_time / self.n_calls if self.n_calls else 0.
+            }
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
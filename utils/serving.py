@@ -0,0 +1,292 @@
+# Copyright 2021 Vittorio Mazzia & Francesco Salvetti. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Local HTTP inference server. Concurrent requests are coalesced in micro-batches (at most max_batch samples, waiting at
+most max_wait_ms after the first queued request) that run through the compiled classification function of the model.
+
+Endpoints:
+    POST /predict   {"inputs": [image, ...]} -> {"classes": [...], "scores": [[...], ...]}
+    GET  /stats     queue depth and batch-size statistics (and prediction cache counters, if enabled)
+    GET  /metrics   latency histograms in the Prometheus text format (if 'instrumentation' is enabled)
+
+Usage: python -m utils.serving [--model MNIST] [--original] [--port 8000] [--max-batch 64] [--max-wait-ms 5]
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+class MicroBatcher(object):
+    """
+    Queue of classification requests served in micro-batches by a background thread.
+
+    ...
+
+    Attributes
+    ----------
+    classify: function
+        batch of samples -> class scores (Ex. Model.classify)
+    max_batch: int
+        maximum number of samples in a micro-batch (a larger request runs alone)
+    max_wait_ms: float
+        maximum time to wait for other requests after the first one of a micro-batch
+
+    Methods
+    -------
+    submit(X)
+        queue a batch of samples and return a Future of its scores
+    stats()
+        queue depth and batch-size statistics
+    close()
+        stop the background thread
+    """
+    def __init__(self, classify, max_batch=64, max_wait_ms=5.):
+        self.classify = classify
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_samples = 0
+        self.n_batches = 0
+        self.batch_sizes = {}
+        self.pending = None
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, X):
+        future = Future()
+        self.queue.put((np.asarray(X, dtype=np.float32), future))
+        return future
+
+
+    def next_batch(self):
+        if self.pending is not None: # request that did not fit the previous micro-batch
+            requests, self.pending = [self.pending], None
+        else:
+            requests = [self.queue.get()]
+        if requests[0][0] is None: # stop signal
+            return None
+        n_samples = len(requests[0][0])
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while n_samples < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                X, future = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if X is None or n_samples + len(X) > self.max_batch:
+                self.pending = (X, future)
+                break
+            requests.append((X, future))
+            n_samples += len(X)
+        return requests
+
+
+    def serve(self):
+        while True:
+            requests = self.next_batch()
+            if requests is None:
+                break
+            X = np.concatenate([X for X, _ in requests])
+            try:
+                scores = self.classify(X)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for X_request, future in requests:
+                future.set_result(scores[start:start+len(X_request)])
+                start += len(X_request)
+            with self.lock:
+                self.n_requests += len(requests)
+                self.n_samples += len(X)
+                self.n_batches += 1
+                self.batch_sizes[len(X)] = self.batch_sizes.get(len(X), 0) + 1
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize() + (self.pending is not None),
+                'requests': self.n_requests,
+                'samples': self.n_samples,
+                'batches': self.n_batches,
+                'mean_batch_size': self.n_samples / self.n_batches if self.n_batches else 0.,
+                'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())}
+            }
+
+
+    def close(self):
+        self.queue.put((None, None))
+        self.thread.join()
+
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # concurrent clients are expected
+
+
+
+def make_handler(batcher, input_shape, extra_stats=dict, metrics=None):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, content):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_text(self, code, text):
+            body = text.encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, dict(batcher.stats(), **extra_stats()))
+            elif self.path == '/metrics' and metrics is not None:
+                self.send_text(200, metrics())
+            else:
+                self.send_json(404, {'error': f'unknown endpoint {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': f'unknown endpoint {self.path}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                X = np.asarray(request['inputs'], dtype=np.float32).reshape([-1] + list(input_shape))
+            except Exception as e:
+                self.send_json(400, {'error': f'bad request: {e}'})
+                return
+            try:
+                scores = batcher.submit(X).result()
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'classes': np.argmax(scores, -1).tolist(), 'scores': scores.tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+
+class InferenceServer(object):
+    """
+    HTTP server that wraps a loaded EfficientCapsNet or CapsNet (Model) and serves it with a MicroBatcher.
+
+    ...
+
+    Attributes
+    ----------
+    model: Model
+        loaded model (Ex. EfficientCapsNet('MNIST', mode='test') with its weights)
+    host: str
+    port: int
+        port 0 selects a free one
+    max_batch: int
+        maximum micro-batch size
+    max_wait_ms: float
+        maximum micro-batch waiting time
+
+    Methods
+    -------
+    start()
+        serve in a background thread
+    serve_forever()
+        serve in the current thread
+    stop()
+        stop the server and the batcher
+    """
+    def __init__(self, model, host='localhost', port=8000, max_batch=64, max_wait_ms=5.):
+        self.model = model
+        input_shape = model.get_capsnet().input_shape[1:]
+        # trace the classification function before serving (bypassing the prediction cache)
+        model.classify_batch(np.zeros((1,) + input_shape, dtype=np.float32))
+        model.classify_batch(np.zeros((max_batch,) + input_shape, dtype=np.float32))
+        self.batcher = MicroBatcher(model.classify, max_batch, max_wait_ms)
+        metrics = (lambda: model.get_metrics('prometheus')) if model.instrumentation is not None else None
+        self.httpd = HTTPServer((host, port), make_handler(self.batcher, input_shape, self.cache_stats, metrics))
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = None
+
+
+    def cache_stats(self):
+        cache = self.model.get_prediction_cache()
+        return {'prediction_cache': cache.stats()} if cache is not None else {}
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.batcher.close()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='MNIST', help="'MNIST', 'SMALLNORB' or 'MULTIMNIST'")
+    parser.add_argument('--original', action='store_true', help='serve the original CapsNet (MNIST only)')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--custom-path', default=None, help='custom weights path')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    args = parser.parse_args()
+
+    from models.model import EfficientCapsNet, CapsNet
+    model_class = CapsNet if args.original else EfficientCapsNet
+    model = model_class(args.model, mode='test', config_path=args.config, custom_path=args.custom_path, verbose=False)
+    model.load_graph_weights()
+
+    server = InferenceServer(model, args.host, args.port, args.max_batch, args.max_wait_ms)
+    print(f"[INFO] Serving {model_class.__name__} {args.model} on http://{server.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,26 +15,344 @@
 
 import numpy as np
 import tensorflow as tf
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
 
-def learn_scheduler(lr_dec, lr):
+def learn_scheduler(lr_dec, lr, warmup_epochs=0, warmup_lr=None):
     def learning_scheduler_fn(epoch):
-        lr_new = lr * (lr_dec ** epoch)
+        if epoch < warmup_epochs: # linear warmup from warmup_lr to lr
+            lr_start = lr if warmup_lr is None else warmup_lr
+            return lr_start + (lr - lr_start) * epoch / warmup_epochs
+        lr_new = lr * (lr_dec ** (epoch - warmup_epochs))
         return lr_new if lr_new >= 5e-5 else 5e-5
     return learning_scheduler_fn
 
 
-def get_callbacks(tb_log_save_path, saved_model_path, lr_dec, lr):
-    tb = tf.keras.callbacks.TensorBoard(log_dir=tb_log_save_path, histogram_freq=0)
+def scale_learning_rate(lr, batch_size, effective_batch_size, scaling='linear'):
+    """
+    Scale the learning rate tuned for batch_size to effective_batch_size ('linear', 'sqrt' or 'none' scaling rule)
+    """
+    if scaling == 'linear':
+        return lr * effective_batch_size / batch_size
+    elif scaling == 'sqrt':
+        return lr * np.sqrt(effective_batch_size / batch_size)
+    elif scaling == 'none':
+        return lr
+    else:
+        raise ValueError(f'lr scaling rule {scaling} not recognized')
 
-    model_checkpoint = tf.keras.callbacks.ModelCheckpoint(saved_model_path, monitor='val_Efficient_CapsNet_accuracy',
+
+def get_callbacks(tb_log_save_path, saved_model_path, lr_dec, lr, warmup_epochs=0, warmup_lr=None, is_chief=True,
+                  backup_dir=None, backup_freq=None, backup_async=True, throughput_freq=100, profile_batch=0,
+                  monitor='val_Efficient_CapsNet_accuracy'):
+    backup_save_dir = backup_dir
+    worker_dir_cleanup = None
+    if not is_chief: # every worker runs the callbacks, but only the chief keeps logs and checkpoints
+        worker_dir_cleanup = TemporaryDirectoryCleanup()
+        worker_dir = worker_dir_cleanup.path
+        tb_log_save_path = os.path.join(worker_dir, 'logs')
+        saved_model_path = os.path.join(worker_dir, os.path.basename(saved_model_path))
+        if backup_dir is not None: # all workers restore the shared backup, only the chief writes it
+            backup_save_dir = os.path.join(worker_dir, 'backup')
+
+    # profile_batch: profiler trace of a step (int) or of a window of steps ([start, stop]), 0 disables profiling
+    tb = tf.keras.callbacks.TensorBoard(log_dir=tb_log_save_path, histogram_freq=0,
+                                        profile_batch=tuple(profile_batch) if isinstance(profile_batch, list) else profile_batch)
+
+    model_checkpoint = tf.keras.callbacks.ModelCheckpoint(saved_model_path, monitor=monitor,
                                            save_best_only=True, save_weights_only=True, verbose=1)
 
-    lr_decay = tf.keras.callbacks.LearningRateScheduler(learn_scheduler(lr_dec, lr))
+    lr_decay = tf.keras.callbacks.LearningRateScheduler(learn_scheduler(lr_dec, lr, warmup_epochs, warmup_lr))
 
     reduce_lr = tf.keras.callbacks.ReduceLROnPlateau(monitor='val_CapsNet_accuracy', factor=0.9,
                               patience=4, min_lr=0.00001, min_delta=0.0001, mode='max')
 
-    return [tb, model_checkpoint, lr_decay]
+    callbacks = [tb, model_checkpoint, lr_decay]
+    if backup_dir is not None:
+        callbacks.append(BackupCheckpoint(backup_dir, backup_async, model_checkpoint, backup_save_dir, backup_freq))
+    if throughput_freq:
+        callbacks.append(ThroughputMonitor(tb_log_save_path, throughput_freq))
+    if worker_dir_cleanup is not None: # last, after the other callbacks are done with the directory
+        callbacks.append(worker_dir_cleanup)
+
+    return callbacks
+
+
+class BackupCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Back up the full training state (weights, optimizer state, epoch and step inside the epoch, best value of
+    model_checkpoint and numpy/TF global RNG states) at the end of every epoch and, if save_freq is set, every save_freq
+    steps, so that an interrupted training can be resumed from the last checkpoint. On resume the first epoch starts at
+    the saved step (keras 'fit' and TrainEngine both read it from the model, as keras BackupAndRestore does) and
+    skip_consumed drops the batches of that epoch that were already trained on. Checkpoints are written with
+    tf.train.CheckpointManager, which updates the pointer to the latest checkpoint only after all its files are written,
+    optionally in a background thread. The backup is deleted when training ends
+    normally. The state variables are plain (not distributed) variables, created with the callback outside the strategy
+    scope: every worker restores them from backup_dir and saves them to its own save_dir.
+    
+    ...
+    
+    Attributes
+    ----------
+    backup_dir: str
+        checkpoint directory the training state is restored from
+    async_save: bool
+        write checkpoints asynchronously
+    model_checkpoint: tf.keras.callbacks.ModelCheckpoint
+        callback whose best monitored value is backed up, if any
+    save_dir: str
+        checkpoint directory the training state is written to (default: backup_dir), Ex. a temporary directory on
+        non-chief workers
+    save_freq: int
+        steps between checkpoints inside an epoch (None: at the end of every epoch only)
+    initial_step: int
+        step of the epoch at which training restarts, set by restore
+    
+    Methods
+    -------
+    restore(model, optimizer)
+        restore the latest checkpoint, if any, and return the epoch at which training must restart
+    skip_consumed(dataset, steps_per_epoch, batches_per_step=1)
+        dataset without the batches consumed before initial_step, and the steps per epoch to train it with
+    """
+    def __init__(self, backup_dir, async_save=True, model_checkpoint=None, save_dir=None, save_freq=None, max_to_keep=2):
+        super(BackupCheckpoint, self).__init__()
+        self.backup_dir = backup_dir
+        self.save_dir = save_dir or backup_dir
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+        self.model_checkpoint = model_checkpoint
+        self.save_freq = save_freq
+        self.max_to_keep = max_to_keep
+        self.checkpoint = None
+        self.initial_step = 0
+        self.last_saved_step = 0
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False) # steps of epoch already trained on
+        # MT19937 keys, position, has_gauss and the bits of cached_gaussian (string variables cannot be broadcast by
+        # the collectives of multi-worker strategies)
+        self.numpy_rng = tf.Variable(tf.zeros(627, tf.int64), trainable=False)
+        self.best = tf.Variable(np.nan if model_checkpoint is None else model_checkpoint.best, dtype=tf.float64, trainable=False)
+        self.tf_rng = tf.random.get_global_generator()
+
+    def build(self, model, optimizer):
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch, step=self.step,
+                                              numpy_rng=self.numpy_rng, best=self.best, tf_rng=self.tf_rng)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.save_dir, max_to_keep=self.max_to_keep)
+
+    def restore(self, model, optimizer):
+        if self.checkpoint is None:
+            self.build(model, optimizer)
+        latest_checkpoint = tf.train.latest_checkpoint(self.backup_dir)
+        if latest_checkpoint is None:
+            return 0
+        self.checkpoint.restore(latest_checkpoint)
+        state = self.numpy_rng.numpy()
+        if state[:624].any(): # saved state
+            np.random.set_state(('MT19937', state[:624].astype(np.uint32), int(state[624]), int(state[625]),
+                                 float(state[626:].view(np.float64)[0])))
+        if self.model_checkpoint is not None and not np.isnan(self.best.numpy()):
+            self.model_checkpoint.best = float(self.best.numpy())
+        self.initial_step = int(self.step)
+        print(f"[INFO] Training state restored from {latest_checkpoint} (epoch {int(self.epoch)}, step {self.initial_step})")
+        return int(self.epoch)
+
+    def skip_consumed(self, dataset, steps_per_epoch, batches_per_step=1):
+        """
+        dataset (tf.data.Dataset) without the batches consumed by the initial_step steps of the restored epoch, and the
+        steps per epoch to train it with. A dataset iterated once per epoch (steps_per_epoch None) becomes a single
+        stream of the rest of the epoch followed by the next ones, so that only the first epoch is shortened.
+        Distributed datasets cannot be skipped and are returned unchanged.
+        """
+        if not self.initial_step:
+            return dataset, steps_per_epoch
+        if not isinstance(dataset, tf.data.Dataset):
+            print(f"[WARNING] The {self.initial_step} steps already trained on in the restored epoch are trained on again: "
+                  "batches cannot be skipped on a distributed dataset")
+            return dataset, steps_per_epoch
+        skip = self.initial_step * batches_per_step
+        if steps_per_epoch is None:
+            cardinality = int(dataset.cardinality())
+            if cardinality < 0:
+                raise ValueError('steps_per_epoch must be provided to resume datasets with infinite or unknown cardinality')
+            steps_per_epoch = cardinality // batches_per_step
+            dataset = dataset.take(steps_per_epoch * batches_per_step) # trailing batches of an incomplete step are not trained on
+            return dataset.skip(skip).concatenate(dataset.repeat()), steps_per_epoch
+        return dataset.skip(skip), steps_per_epoch
+
+    def maybe_load_initial_counters_from_ckpt(self, steps_per_epoch, initial_epoch, mode=None):
+        # read by keras 'fit' (and TrainEngine.fit) through model._training_state after on_train_begin
+        return initial_epoch, self.initial_step
+
+    def save(self):
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        self.numpy_rng.assign(np.concatenate([keys.astype(np.int64), [pos, has_gauss],
+                                              np.array([cached_gaussian], np.float64).view(np.int64)]))
+        if self.model_checkpoint is not None:
+            self.best.assign(self.model_checkpoint.best)
+        self.manager.save(options=self.options) # numbered by the save counter of the checkpoint, restored with it
+
+    def on_train_begin(self, logs=None):
+        if self.checkpoint is None:
+            self.build(self.model, self.model.optimizer)
+        if self.initial_step:
+            self.model._training_state = self
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch.assign(epoch)
+        self.last_saved_step = self.initial_step
+
+    def on_train_batch_end(self, batch, logs=None):
+        # batch is the index of the last step run, also with steps fused by steps_per_execution. The last step of an
+        # epoch is left to on_epoch_end
+        steps = self.params.get('steps') or np.inf
+        if not self.save_freq or batch + 1 - self.last_saved_step < self.save_freq or batch + 1 >= steps:
+            return
+        self.step.assign(batch + 1)
+        self.save()
+        self.last_saved_step = batch + 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.initial_step = 0
+        if getattr(self.model, '_training_state', None) is self:
+            self.model._training_state = None
+        self.epoch.assign(epoch + 1)
+        self.step.assign(0)
+        self.save()
+
+    def on_train_end(self, logs=None):
+        self.checkpoint.sync()
+        shutil.rmtree(self.save_dir, ignore_errors=True)
+
+
+class TemporaryDirectoryCleanup(tf.keras.callbacks.Callback):
+    """
+    Temporary directory (Ex. for the logs and checkpoints of a non-chief worker) removed when training ends, or when the
+    callback is garbage collected if training fails.
+    """
+    def __init__(self):
+        super(TemporaryDirectoryCleanup, self).__init__()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def on_train_end(self, logs=None):
+        self.directory.cleanup()
+
+
+class ThroughputMonitor(tf.keras.callbacks.Callback):
+    """
+    Log step time, examples/s, time spent waiting for the input pipeline and process RSS every log_freq steps, as
+    TensorBoard scalars (in the 'throughput' subdirectory of log_dir) and as lines of log_dir/throughput.jsonl. The input
+    wait is measured only on datasets wrapped with wrap(dataset), which Model.train_graph does for tf.data pipelines: it
+    is the time the training loop blocks on the iterator, so a large input fraction means that training is input-bound.
+    
+    ...
+    
+    Attributes
+    ----------
+    log_dir: str
+        TensorBoard log directory of the run
+    log_freq: int
+        number of steps (calls of the train function) averaged in a log entry
+    
+    Methods
+    -------
+    wrap(dataset)
+        dataset whose iterator reports the time spent waiting for every batch
+    """
+    def __init__(self, log_dir, log_freq=100):
+        super(ThroughputMonitor, self).__init__()
+        self.log_dir = log_dir
+        self.log_freq = log_freq
+        self.lock = threading.Lock()
+        self.waits = [] # (seconds, examples) of the batches fetched since the last step
+        self.window = []
+        self.epoch_window = []
+        self.writer = None
+        self.epoch = 0
+
+    def record_wait(self, seconds, examples):
+        with self.lock:
+            self.waits.append((float(seconds), int(examples)))
+        return np.int32(0)
+
+    def wrap(self, dataset):
+        # zip fetches the timestamp first, then blocks on dataset until its next batch is ready
+        stamps = tf.data.Dataset.from_tensors(tf.constant(0., tf.float64)).repeat().map(lambda _: tf.timestamp())
+
+        def report(start, element):
+            examples = tf.shape(tf.nest.flatten(element)[0])[0]
+            done = tf.numpy_function(self.record_wait, [tf.timestamp() - start, examples], tf.int32)
+            with tf.control_dependencies([done]):
+                return tf.nest.map_structure(tf.identity, element)
+
+        return tf.data.Dataset.zip((stamps, dataset)).map(report)
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'throughput'))
+        self.jsonl_path = os.path.join(self.log_dir, 'throughput.jsonl')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_window = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_time = time.perf_counter() - self.step_start
+        with self.lock:
+            waits, self.waits = self.waits, []
+        # keras may fetch batches ahead of the step that uses them, so waits are aggregated over windows of steps
+        step = (step_time, sum(w for w, _ in waits), sum(n for _, n in waits), bool(waits))
+        self.window.append(step)
+        self.epoch_window.append(step)
+        if len(self.window) >= self.log_freq:
+            self.log(self.window, 'step')
+            self.window = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        entry = self.log(self.epoch_window, 'epoch')
+        if entry is not None and entry['input_fraction'] is not None:
+            print(f"[INFO] Epoch {epoch + 1}: {entry['examples_per_s']:.1f} examples/s, "
+                  f"{entry['input_fraction']:.1%} of the step time waiting for input")
+
+    def on_train_end(self, logs=None):
+        if self.window:
+            self.log(self.window, 'step')
+            self.window = []
+        self.writer.close()
+
+    def summarize(self, window):
+        step_time = sum(s[0] for s in window)
+        measured = any(s[3] for s in window)
+        input_wait = sum(s[1] for s in window) if measured else None
+        return {
+            'steps': len(window),
+            'step_time_ms': 1000 * step_time / len(window),
+            'examples_per_s': sum(s[2] for s in window) / step_time if measured and step_time else None,
+            'input_wait_ms': 1000 * input_wait / len(window) if measured else None,
+            'compute_ms': 1000 * (step_time - input_wait) / len(window) if measured else None,
+            'input_fraction': input_wait / step_time if measured and step_time else None,
+            'rss_mb': process_rss_mb()
+        }
+
+    def log(self, window, kind):
+        if not window:
+            return None
+        iterations = int(self.model.optimizer.iterations) if self.model.optimizer is not None else None
+        entry = dict(self.summarize(window), kind=kind, epoch=self.epoch, iterations=iterations, time=time.time())
+        with open(self.jsonl_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        with self.writer.as_default():
+            for key in ['step_time_ms', 'examples_per_s', 'input_wait_ms', 'compute_ms', 'input_fraction', 'rss_mb']:
+                if entry[key] is not None:
+                    tf.summary.scalar(f'{kind}/{key}', entry[key], step=iterations if kind == 'step' else self.epoch)
+        return entry
 
 
 def marginLoss(y_true, y_pred):
@@ -48,6 +366,15 @@ def marginLoss(y_true, y_pred):
     return tf.reduce_mean(tf.reduce_sum(L, axis=1))
 
 
+def reconstructionLoss(y_true, y_pred):
+    # mse on the samples decoded by DecoderSubsample (the other rows are NaN and get 0), scaled by batch/decoded so that
+    # the mean over the batch is the mean over the decoded samples. Plain mse if the batch is complete
+    decoded = tf.reduce_all(tf.math.is_finite(y_pred), axis=list(range(1, len(y_pred.shape))), keepdims=True)
+    mse = tf.reduce_mean(tf.square(tf.where(decoded, y_pred, y_true) - y_true), axis=-1)
+    weight = tf.cast(decoded[..., 0], mse.dtype)
+    return mse * weight * tf.math.divide_no_nan(tf.cast(tf.size(weight), mse.dtype), tf.reduce_sum(weight))
+
+
 def multiAccuracy(y_true, y_pred):
     label_pred = tf.argsort(y_pred,axis=-1)[:,-2:]
     label_true = tf.argsort(y_true,axis=-1)[:,-2:]
@@ -56,3 +383,76 @@ def multiAccuracy(y_true, y_pred):
           tf.reduce_sum(tf.cast(label_pred[:,1:]==label_true,tf.int8),axis=-1)
     acc /= 2
     return tf.reduce_mean(acc,axis=-1)
+
+
+
+def process_rss_mb():
+    """
+    Resident set size of the current process in MB
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class PeakMemory(object):
+    """
+    Context manager that measures the peak memory allocated inside its scope. GPU allocator statistics are used when a
+    GPU is available, otherwise the process resident set size is sampled by a background thread.
+    
+    ...
+    
+    Attributes
+    ----------
+    interval: float
+        RSS sampling interval in seconds
+    baseline_mb: float
+        reference memory usage. If None, the usage measured entering the scope
+    peak_mb: float
+        peak memory above baseline_mb
+    
+    Methods
+    -------
+    current_mb()
+        memory currently in use
+    """
+    def __init__(self, interval=1e-3, baseline_mb=None):
+        self.interval = interval
+        self.baseline_mb = baseline_mb
+        self.peak_mb = 0.
+        self.gpu = bool(tf.config.list_physical_devices('GPU'))
+
+    def current_mb(self):
+        if self.gpu:
+            return tf.config.experimental.get_memory_info('GPU:0')['current'] / 2**20
+        return process_rss_mb()
+
+    def __enter__(self):
+        if self.baseline_mb is None:
+            self.baseline_mb = self.current_mb()
+        if self.gpu:
+            tf.config.experimental.reset_memory_stats('GPU:0')
+        else:
+            self.peak = process_rss_mb()
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, process_rss_mb())
+            self.stop.wait(self.interval)
+
+    def __exit__(self, *exc):
+        if self.gpu:
+            peak = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20
+        else:
+            self.stop.set()
+            self.thread.join()
+            peak = max(self.peak, process_rss_mb())
+        self.peak_mb = peak - self.baseline_mb
+        return False